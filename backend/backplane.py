@@ -0,0 +1,268 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from event_codecs import *
+from chat_logging import get_logger, configure_logging
+
+log = get_logger("backplane")
+
+# Namespaces for cluster wide reservations
+USERNAME_NAMESPACE = "user"
+ROOM_NAMESPACE = "room"
+
+# Lines on the broker socket carry whole events, so the default 64 KiB line limit is too small
+BROKER_LINE_LIMIT = 16 * 1024 * 1024
+DEFAULT_BROKER_PATH = "/tmp/chat-backplane.sock"
+# Backoff between attempts to reconnect to a broker that went away
+BROKER_RECONNECT_MIN_SECONDS = 0.1
+BROKER_RECONNECT_MAX_SECONDS = 5.0
+
+# Called with (room_name, frame) for every published event, room_name is None for events that go
+# to every room. Events published together with publish_batch() come as a list of frames.
+DeliveryHandler = Callable[[str | None, EncodedEvent | List[EncodedEvent]], Awaitable[None]]
+
+class Backplane:
+    """Pub/sub channel shared by every worker serving the chat.
+
+    Room events are not delivered by the worker that produced them, they are published and every
+    worker (the publisher included) delivers them to its local connections through the handler.
+    Reservations make usernames and room names unique across all workers."""
+    def __init__(self):
+        self.handler: DeliveryHandler | None = None
+
+    def set_handler(self, handler: DeliveryHandler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+    async def stop(self):
+        pass
+
+    async def publish(self, room_name: str | None, frame: EncodedEvent):
+        raise NotImplementedError
+    async def publish_batch(self, room_name: str, frames: List[EncodedEvent]):
+        """Publishes several events of one room, they are delivered together and in order"""
+        raise NotImplementedError
+    async def reserve(self, namespace: str, key: str) -> bool:
+        """Returns True if the key was free and is now held by this worker"""
+        raise NotImplementedError
+    async def release(self, namespace: str, key: str):
+        raise NotImplementedError
+
+class InProcessBackplane(Backplane):
+    """Single worker backplane, events are handed straight to the handler"""
+    def __init__(self):
+        super().__init__()
+        self.reservations: Set[Tuple[str, str]] = set()
+
+    async def publish(self, room_name: str | None, frame: EncodedEvent):
+        await self.handler(room_name, frame)
+    async def publish_batch(self, room_name: str, frames: List[EncodedEvent]):
+        await self.handler(room_name, frames)
+    async def reserve(self, namespace: str, key: str) -> bool:
+        if (namespace, key) in self.reservations:
+            return False
+        self.reservations.add((namespace, key))
+        return True
+    async def release(self, namespace: str, key: str):
+        self.reservations.discard((namespace, key))
+
+class BrokerBackplane(Backplane):
+    """Connects a worker to a BackplaneBroker over a Unix socket.
+
+    Events travel as their JSON frame, which receivers reuse as the pre-encoded JSON frame. The
+    broker forwards published events to every worker in one order, so all workers see the same
+    room history.
+
+    If the broker goes away the worker keeps reconnecting, and publishing fails with a
+    ConnectionError until it is back. After reconnecting, the reservations of this worker are
+    claimed again, since the broker dropped them with the old connection."""
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.read_task: asyncio.Task | None = None
+        self.request_ids = itertools.count()
+        self.pending_reservations: Dict[int, asyncio.Future] = {}
+        # Reservations held by this worker
+        self.held: Set[Tuple[str, str]] = set()
+        self.connected = False
+        self.stopping = False
+
+    async def start(self):
+        await self.connect()
+        self.read_task = asyncio.create_task(self.read_loop())
+    async def stop(self):
+        self.stopping = True
+        if self.read_task:
+            self.read_task.cancel()
+        if self.writer:
+            self.writer.close()
+        self.connected = False
+
+    async def connect(self):
+        (self.reader, self.writer) = await asyncio.open_unix_connection(self.path, limit=BROKER_LINE_LIMIT)
+        self.connected = True
+
+    def send(self, request: Dict):
+        if not self.connected:
+            raise ConnectionError(f"Not connected to the backplane broker at {self.path}")
+        self.writer.write(json.dumps(request).encode() + b"\n")
+
+    async def publish(self, room_name: str | None, frame: EncodedEvent):
+        self.send({"op": "publish", "room_name": room_name, "event": frame.encode(JSON_CODEC)})
+    async def publish_batch(self, room_name: str, frames: List[EncodedEvent]):
+        # One line, so the broker keeps the events together
+        self.send({"op": "publish", "room_name": room_name, "events": [frame.encode(JSON_CODEC) for frame in frames]})
+    async def reserve(self, namespace: str, key: str) -> bool:
+        ok = await self.request_reservation(namespace, key)
+        if ok:
+            self.held.add((namespace, key))
+        return ok
+    def request_reservation(self, namespace: str, key: str) -> asyncio.Future:
+        request_id = next(self.request_ids)
+        reply = asyncio.get_running_loop().create_future()
+        self.pending_reservations[request_id] = reply
+        self.send({"op": "reserve", "id": request_id, "namespace": namespace, "key": key})
+        return reply
+    async def release(self, namespace: str, key: str):
+        self.held.discard((namespace, key))
+        if self.connected:
+            self.send({"op": "release", "namespace": namespace, "key": key})
+
+    async def read_loop(self):
+        try:
+            while True:
+                try:
+                    await self.read_messages()
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    log.debug("Broker connection failed: %s", e)
+                if self.stopping:
+                    return
+                self.connected = False
+                log.error("Disconnected from broker, reconnecting", path=self.path)
+                self.fail_pending_reservations()
+                await self.reconnect()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.connected = False
+            self.fail_pending_reservations()
+
+    async def read_messages(self):
+        async for line in self.reader:
+            message = json.loads(line)
+            if message["op"] == "publish" and "events" in message:
+                frames = [EncodedEvent.from_frame(JSON_CODEC, event) for event in message["events"]]
+                try:
+                    await self.handler(message["room_name"], frames)
+                except Exception as e:
+                    log.error("Failed delivering a batch of %d events: %s", len(frames), e)
+            elif message["op"] == "publish":
+                frame = EncodedEvent.from_frame(JSON_CODEC, message["event"])
+                try:
+                    await self.handler(message["room_name"], frame)
+                except Exception as e:
+                    log.error("Failed delivering %s: %s", frame.event.event_type, e)
+            elif message["op"] == "reserved":
+                reply = self.pending_reservations.pop(message["id"], None)
+                if reply and not reply.done():
+                    reply.set_result(message["ok"])
+
+    def fail_pending_reservations(self):
+        for reply in self.pending_reservations.values():
+            if not reply.done():
+                reply.set_result(False)
+        self.pending_reservations.clear()
+
+    async def reconnect(self):
+        delay = BROKER_RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                await self.connect()
+                break
+            except OSError as e:
+                log.warning("Reconnecting to broker failed: %s", e, path=self.path)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BROKER_RECONNECT_MAX_SECONDS)
+        log.info("Reconnected to broker", path=self.path)
+        for (namespace, key) in list(self.held):
+            reply = self.request_reservation(namespace, key)
+            reply.add_done_callback(lambda reply, namespace=namespace, key=key: self.reclaimed(reply, namespace, key))
+
+    def reclaimed(self, reply: asyncio.Future, namespace: str, key: str):
+        if not reply.result():
+            # Another worker took it while the broker was gone
+            log.warning("Lost reservation %s/%s after reconnecting", namespace, key)
+            self.held.discard((namespace, key))
+
+class BackplaneBroker:
+    """Local broker that relays events between workers and owns the reservations.
+
+    Reservations belong to the worker connection that made them and are dropped if that worker
+    goes away."""
+    def __init__(self, path: str):
+        self.path = path
+        self.clients: Set[asyncio.StreamWriter] = set()
+        self.reservations: Dict[Tuple[str, str], asyncio.StreamWriter] = {}
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, self.path, limit=BROKER_LINE_LIMIT)
+    async def stop(self):
+        self.server.close()
+        for client in list(self.clients):
+            client.close()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            async for line in reader:
+                request = json.loads(line)
+                if request["op"] == "publish":
+                    # Forwarded as is, including back to the publisher
+                    for client in self.clients:
+                        client.write(line)
+                elif request["op"] == "reserve":
+                    key = (request["namespace"], request["key"])
+                    ok = key not in self.reservations
+                    if ok:
+                        self.reservations[key] = writer
+                    writer.write(json.dumps({"op": "reserved", "id": request["id"], "ok": ok}).encode() + b"\n")
+                elif request["op"] == "release":
+                    key = (request["namespace"], request["key"])
+                    if self.reservations.get(key) is writer:
+                        self.reservations.pop(key)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            for key in [key for key, owner in self.reservations.items() if owner is writer]:
+                self.reservations.pop(key)
+            writer.close()
+
+def run_broker(path: str):
+    configure_logging()
+    async def serve():
+        broker = BackplaneBroker(path)
+        await broker.start()
+        log.info("Broker listening on %s", path)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def backplane_from_env() -> Backplane:
+    """Workers share a broker when CHAT_BACKPLANE points at its Unix socket"""
+    path = os.environ.get("CHAT_BACKPLANE")
+    if path:
+        return BrokerBackplane(path)
+    return InProcessBackplane()
+
+if __name__ == "__main__":
+    run_broker(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_BROKER_PATH)
@@ -0,0 +1,137 @@
+import asyncio
+from backplane import BackplaneBroker, BrokerBackplane, USERNAME_NAMESPACE
+from message_types import *
+from websocket_handlers import Storage, EncodedEvent
+
+class RecordingConnection:
+    def __init__(self, username: str):
+        self.username = username
+        self.user_uuid = username
+        self.resumable = False
+        self.frames = []
+    async def queue_message(self, frame: EncodedEvent):
+        self.frames.append(frame.event)
+    async def queue_messages(self, frames: List[EncodedEvent]):
+        self.frames += [frame.event for frame in frames]
+    def free_slots(self) -> int:
+        return 1000
+
+def test_broker_backplane_fans_out_across_workers(tmp_path):
+    async def run():
+        path = str(tmp_path / "backplane.sock")
+        broker = BackplaneBroker(path)
+        await broker.start()
+
+        workers = [Storage(backplane=BrokerBackplane(path)) for _ in range(2)]
+        users = []
+        for i, worker in enumerate(workers):
+            await worker.backplane.start()
+            (manager, _) = worker.get_manager("shared_room")
+            users.append(RecordingConnection(f"user{i}"))
+            manager.websockets[users[-1].user_uuid] = users[-1]
+
+        # Usernames are unique across workers
+        assert await workers[0].reserve_username("alice")
+        assert not await workers[1].reserve_username("alice")
+
+        await workers[0].backplane.publish("shared_room", EncodedEvent(WsMessage(username="alice", message="hello")))
+        await workers[1].backplane.publish(None, EncodedEvent(WsRoomCreate(room=RoomInfo(room_name="new_room", room_creator="bob", connected_users=["bob"]))))
+        await asyncio.sleep(0.2)
+
+        # Both workers deliver both events, in the same order
+        for (worker, user) in zip(workers, users):
+            assert [type(event) for event in user.frames] == [WsMessage, WsRoomCreate]
+            assert worker.managers["new_room"].creator == "bob"
+
+        # A worker going away releases its reservations
+        await workers[0].backplane.stop()
+        await asyncio.sleep(0.1)
+        assert await workers[1].backplane.reserve(USERNAME_NAMESPACE, "alice")
+
+        await workers[1].backplane.stop()
+        await broker.stop()
+        await asyncio.sleep(0.1)
+    asyncio.run(run())
+
+def test_batches_are_delivered_together_on_every_worker(tmp_path):
+    async def run():
+        path = str(tmp_path / "backplane.sock")
+        broker = BackplaneBroker(path)
+        await broker.start()
+        workers = [Storage(backplane=BrokerBackplane(path)) for _ in range(2)]
+        users = []
+        for i, worker in enumerate(workers):
+            await worker.backplane.start()
+            (manager, _) = worker.get_manager("batched_room")
+            users.append(RecordingConnection(f"user{i}"))
+            manager.websockets[users[-1].user_uuid] = users[-1]
+
+        frames = [EncodedEvent(WsMessage(username="bot", message=str(i))) for i in range(40)]
+        await workers[0].backplane.publish_batch("batched_room", frames)
+        await asyncio.sleep(0.2)
+        for (worker, user) in zip(workers, users):
+            assert [event.message for event in user.frames] == [str(i) for i in range(40)]
+
+        for worker in workers:
+            await worker.backplane.stop()
+        await broker.stop()
+    asyncio.run(run())
+
+def test_chat_clear_applies_on_every_worker(tmp_path):
+    async def run():
+        path = str(tmp_path / "backplane.sock")
+        broker = BackplaneBroker(path)
+        await broker.start()
+        workers = [Storage(backplane=BrokerBackplane(path)) for _ in range(2)]
+        for worker in workers:
+            await worker.backplane.start()
+            worker.add_to_chat("cleared_room", {"username": "alice", "message": "hello", "timestamp": ""})
+
+        await workers[0].backplane.publish("cleared_room", EncodedEvent(WsRoomChatClear(room_name="cleared_room", username="alice")))
+        await asyncio.sleep(0.2)
+        for worker in workers:
+            assert worker.get_chat_messages("cleared_room") == []
+            assert worker.get_history("cleared_room").next_seq == 2
+
+        for worker in workers:
+            await worker.backplane.stop()
+        await broker.stop()
+    asyncio.run(run())
+
+def test_broker_backplane_reconnects(tmp_path):
+    async def run():
+        path = str(tmp_path / "backplane.sock")
+        broker = BackplaneBroker(path)
+        await broker.start()
+        worker = BrokerBackplane(path)
+        received = []
+        async def handler(room_name, frame):
+            received.append(frame.event)
+        worker.set_handler(handler)
+        await worker.start()
+        assert await worker.reserve(USERNAME_NAMESPACE, "alice")
+
+        await broker.stop()
+        await asyncio.sleep(0.1)
+        # Publishing fails loudly while the broker is gone
+        try:
+            await worker.publish("room", EncodedEvent(WsMessage(username="alice", message="lost")))
+            assert False, "publish should fail"
+        except ConnectionError:
+            pass
+
+        broker = BackplaneBroker(path)
+        await broker.start()
+        for _ in range(50):
+            if worker.connected:
+                break
+            await asyncio.sleep(0.1)
+        await worker.publish("room", EncodedEvent(WsMessage(username="alice", message="back")))
+        await asyncio.sleep(0.2)
+        assert [event.message for event in received] == ["back"]
+        # The reservation was claimed again on the new broker
+        assert ("user", "alice") in broker.reservations
+
+        await worker.stop()
+        await broker.stop()
+    asyncio.run(run())
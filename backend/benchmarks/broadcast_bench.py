@@ -0,0 +1,84 @@
+"""Micro-benchmark for WebSocketManager.server_broadcast.
+
+Measures the time spent per broadcast and the number of serializations per broadcast for
+growing room sizes. With encode-once fan-out the number of encodes stays at 1 regardless of
+how many users are in the room.
+
+Run from the backend directory:
+    python benchmarks/broadcast_bench.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from message_types import *
+from event_codecs import EncodedEvent, JSON_CODEC
+from websocket_handlers import storage
+
+class NullConnection:
+    """Stands in for a WebSocketConnection, it only keeps the last queued frame"""
+    def __init__(self, index: int):
+        self.username = f"user{index}"
+        self.user_uuid = str(index)
+        self.last_frame = None
+        # Plain frames and every join and leave, like a client without optional features
+        self.resumable = False
+        self.presence_sync = False
+
+    async def queue_message(self, frame: EncodedEvent):
+        # Touch the frame the same way the sender loop would
+        frame.encode(JSON_CODEC)
+        self.last_frame = frame
+
+def count_encodes():
+    """Wraps the JSON codec so that actual serializations can be counted"""
+    counter = {"encodes": 0}
+    original = JSON_CODEC.encode
+    def encode(event):
+        counter["encodes"] += 1
+        return original(event)
+    JSON_CODEC.encode = encode
+    return counter
+
+async def bench_room(room_size: int, broadcasts: int, counter) -> dict:
+    (manager, _) = storage.get_manager(f"bench_{room_size}")
+    for i in range(room_size):
+        connection = NullConnection(i)
+        manager.websockets[connection.user_uuid] = connection
+
+    # Typing events are coalesced by the typing tick and never fanned out directly, a chat message
+    # is (it is also appended to the room's history, like in production)
+    message = WsMessage(username="user0", message="hello")
+    counter["encodes"] = 0
+    start = time.perf_counter()
+    for _ in range(broadcasts):
+        await manager.server_broadcast(message)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "room_size": room_size,
+        "encodes_per_broadcast": counter["encodes"] / broadcasts,
+        "us_per_broadcast": elapsed / broadcasts * 1e6,
+        "us_per_recipient": elapsed / broadcasts / room_size * 1e6,
+    }
+
+async def main(room_sizes, broadcasts: int):
+    counter = count_encodes()
+    results = []
+    for room_size in room_sizes:
+        results.append(await bench_room(room_size, broadcasts, counter))
+
+    print(f"{'room size':>10} {'encodes/bcast':>14} {'us/bcast':>12} {'us/recipient':>13}")
+    for r in results:
+        print(f"{r['room_size']:>10} {r['encodes_per_broadcast']:>14.2f} {r['us_per_broadcast']:>12.1f} {r['us_per_recipient']:>13.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000, 2000, 5000])
+    parser.add_argument("--broadcasts", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.broadcasts))
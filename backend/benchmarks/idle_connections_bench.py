@@ -0,0 +1,87 @@
+"""Memory per idle connection and fan-out time, with per-connection senders and shared writers.
+
+Creates idle WebSocketConnections on stand-in sockets and measures the memory they allocate with
+tracemalloc, then the time until one broadcast has been sent on every socket. With a sender task
+per connection every idle connection holds a task, its coroutine and an event. With shared
+writers (CHAT_WRITERS) it only holds its delivery queue.
+
+Run from the backend directory:
+    python benchmarks/idle_connections_bench.py
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from message_types import *
+from event_codecs import EncodedEvent, JSON_CODEC
+from websocket_handlers import GLOBAL_ROOM_NAME, WebSocketConnection, WriterPool, storage
+
+class NullSocket:
+    """Stands in for a WebSocket, it only counts the frames sent on it"""
+    __slots__ = ()
+    client = None
+    sent = 0
+
+    async def send_text(self, data: str):
+        NullSocket.sent += 1
+
+    async def send_bytes(self, data: bytes):
+        NullSocket.sent += 1
+
+async def bench(connections: int, writers: int) -> dict:
+    storage.writers = WriterPool(writers)
+    storage.writers.start()
+    sockets = [NullSocket() for _ in range(connections)]
+    uuids = [str(uuid.uuid4()) for _ in range(connections)]
+    names = [f"user{i}" for i in range(connections)]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = [WebSocketConnection(sockets[i], uuids[i], names[i], GLOBAL_ROOM_NAME, JSON_CODEC, []) for i in range(connections)]
+    # Let the sender tasks start and wait for their first event
+    await asyncio.sleep(0)
+    gc.collect()
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / connections
+    tracemalloc.stop()
+
+    frame = EncodedEvent(WsMessage(username="user0", message="hello"))
+    NullSocket.sent = 0
+    started = time.perf_counter()
+    for user in users:
+        await user.queue_message(frame)
+    while NullSocket.sent < connections:
+        await asyncio.sleep(0)
+    fan_out = time.perf_counter() - started
+
+    for user in users:
+        user.closed = True
+        if user.sender_task:
+            user.sender_task.cancel()
+    await storage.writers.stop()
+    return {
+        "engine": f"{writers} writers" if writers else "sender per connection",
+        "bytes_per_connection": per_connection,
+        "fan_out_ms": fan_out * 1e3,
+    }
+
+async def main(connections: int, writers: int):
+    results = [await bench(connections, 0), await bench(connections, writers)]
+    print(f"{connections} idle connections")
+    print(f"{'engine':>22} {'bytes/conn':>11} {'fan-out ms':>11}")
+    for r in results:
+        print(f"{r['engine']:>22} {r['bytes_per_connection']:>11.0f} {r['fan_out_ms']:>11.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--writers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.connections, args.writers))
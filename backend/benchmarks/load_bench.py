@@ -0,0 +1,237 @@
+"""Load generator and fan-out benchmark for the chat server.
+
+Starts the real server in a subprocess, opens many concurrent WebSocket clients spread over a
+number of rooms and lets them chat, type, switch rooms and create rooms at the configured rates.
+Reports end-to-end delivery latency percentiles, throughput, join latency and server RSS, and
+writes the results as JSON so runs can be compared across releases.
+
+Run from the backend directory:
+    python benchmarks/load_bench.py --clients 2000 --rooms 20 --duration 30 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List
+
+from websockets.asyncio.client import connect
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+class Stats:
+    def __init__(self):
+        self.delivery_latencies: List[float] = []
+        self.join_latencies: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.typing_sent = 0
+        self.switches = 0
+        self.rooms_created = 0
+        self.disconnects = 0
+        self.connect_failures = 0
+
+def percentile(values: List[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def latency_summary(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "p999_ms": ms(percentile(values, 0.999)),
+        "max_ms": ms(max(values) if values else None),
+    }
+
+def ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def server_rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def start_server(port: int) -> subprocess.Popen:
+    env = {**os.environ, "CHAT_LOG_LEVEL": os.environ.get("CHAT_LOG_LEVEL", "WARNING")}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/rooms", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+def next_delay(rate: float) -> float:
+    """Poisson arrivals, a rate of 0 disables the action"""
+    return random.expovariate(rate) if rate > 0 else float("inf")
+
+class BenchClient:
+    def __init__(self, index: int, url: str, rooms: List[str], args, stats: Stats, stop: asyncio.Event):
+        self.username = f"bench{index}"
+        self.url = url
+        self.rooms = rooms
+        self.room = rooms[index % len(rooms)]
+        self.args = args
+        self.stats = stats
+        self.stop = stop
+        self.join_started = 0.0
+
+    async def run(self):
+        try:
+            async with connect(f"{self.url}/ws/{self.room}", max_size=None, open_timeout=60) as ws:
+                self.join_started = time.perf_counter()
+                await ws.send(json.dumps({"event_type": "connection_request", "username": self.username}))
+                await asyncio.gather(self.receive_loop(ws), self.action_loop(ws))
+        except Exception:
+            if not self.stop.is_set():
+                self.stats.connect_failures += 1
+
+    async def receive_loop(self, ws):
+        try:
+            async for frame in ws:
+                event = json.loads(frame)
+                event_type = event["event_type"]
+                if event_type == "message":
+                    (sent_at, _) = event["message"].split("|", 1)
+                    self.stats.delivery_latencies.append(time.perf_counter() - float(sent_at))
+                    self.stats.received += 1
+                elif event_type == "message_history" and self.join_started:
+                    # The join is complete once the history of the room has arrived
+                    self.stats.join_latencies.append(time.perf_counter() - self.join_started)
+                    self.join_started = 0.0
+                if self.stop.is_set():
+                    return
+        except Exception:
+            if not self.stop.is_set():
+                self.stats.disconnects += 1
+
+    async def action_loop(self, ws):
+        args = self.args
+        now = time.perf_counter()
+        due = {
+            "chat": now + next_delay(args.chat_rate),
+            "typing": now + next_delay(args.typing_rate),
+            "switch": now + next_delay(args.switch_rate),
+            "create": now + next_delay(args.create_rate),
+        }
+        while not self.stop.is_set():
+            (action, at) = min(due.items(), key=lambda item: item[1])
+            if at == float("inf"):
+                await self.stop.wait()
+                return
+            await asyncio.sleep(max(at - time.perf_counter(), 0))
+            if self.stop.is_set():
+                return
+            if action == "chat":
+                await ws.send(json.dumps({"event_type": "message", "username": self.username, "message": f"{time.perf_counter()}|hello"}))
+                self.stats.sent += 1
+                due[action] = time.perf_counter() + next_delay(args.chat_rate)
+            elif action == "typing":
+                await ws.send(json.dumps({"event_type": "typing", "username": self.username, "is_typing": True}))
+                self.stats.typing_sent += 1
+                due[action] = time.perf_counter() + next_delay(args.typing_rate)
+            elif action == "switch":
+                self.room = random.choice(self.rooms)
+                self.join_started = time.perf_counter()
+                await ws.send(json.dumps({"event_type": "room_switch_request", "room_name": self.room}))
+                self.stats.switches += 1
+                due[action] = time.perf_counter() + next_delay(args.switch_rate)
+            elif action == "create":
+                room_name = f"r{self.stats.rooms_created}_{self.username}"[:20]
+                await ws.send(json.dumps({"event_type": "room_create", "room": {"room_name": room_name, "room_creator": self.username, "connected_users": [self.username]}}))
+                self.stats.rooms_created += 1
+                due[action] = time.perf_counter() + next_delay(args.create_rate)
+
+async def run_load(args, port: int, server_pid: int) -> Dict:
+    url = f"ws://127.0.0.1:{port}"
+    rooms = [f"bench_room_{i}" for i in range(args.rooms)]
+    stats = Stats()
+    stop = asyncio.Event()
+    rss_samples: List[int] = [server_rss_bytes(server_pid)]
+
+    clients = [BenchClient(i, url, rooms, args, stats, stop) for i in range(args.clients)]
+    tasks = []
+    for start in range(0, len(clients), args.connect_batch):
+        tasks += [asyncio.create_task(client.run()) for client in clients[start:start + args.connect_batch]]
+        await asyncio.sleep(0.05)
+    # Wait for every client to finish its handshake before measuring
+    deadline = time.perf_counter() + 60
+    while len(stats.join_latencies) + stats.connect_failures < args.clients and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    rss_samples.append(server_rss_bytes(server_pid))
+
+    # Only measure steady state, connection setup is covered by the join latency
+    stats.delivery_latencies.clear()
+    (sent_before, received_before) = (stats.sent, stats.received)
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.duration:
+        await asyncio.sleep(1)
+        rss_samples.append(server_rss_bytes(server_pid))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    (sent, received) = (stats.sent - sent_before, stats.received - received_before)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "duration_s": round(elapsed, 3),
+        "messages_sent_per_s": round(sent / elapsed, 2),
+        "messages_delivered_per_s": round(received / elapsed, 2),
+        "delivery_latency": latency_summary(stats.delivery_latencies),
+        "join_latency": latency_summary(stats.join_latencies),
+        "server_rss_bytes": {"idle": rss_samples[0], "connected": rss_samples[1], "peak": max(rss_samples)},
+        "typing_events_sent": stats.typing_sent,
+        "room_switches": stats.switches,
+        "rooms_created": stats.rooms_created,
+        "client_disconnects": stats.disconnects,
+        "connect_failures": stats.connect_failures,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of steady state load")
+    parser.add_argument("--chat-rate", type=float, default=0.2, help="Messages per second per client")
+    parser.add_argument("--typing-rate", type=float, default=0.5, help="Typing events per second per client")
+    parser.add_argument("--switch-rate", type=float, default=0.01, help="Room switches per second per client")
+    parser.add_argument("--create-rate", type=float, default=0.0, help="Room creations per second per client")
+    parser.add_argument("--connect-batch", type=int, default=200, help="Clients connected at a time during ramp up")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--output", default="load_bench_results.json")
+    args = parser.parse_args()
+
+    # Every client needs a file descriptor, on both sides
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = start_server(args.port)
+    try:
+        results = asyncio.run(run_load(args, args.port, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+from collections import deque
+from itertools import islice
+from typing import Dict, List, Tuple
+
+from pydantic_core import to_json
+
+from event_codecs import *
+
+# Default caps for the in-memory history of a single room, the oldest messages are evicted first
+HISTORY_MAX_MESSAGES = 10000
+HISTORY_MAX_BYTES = 4 * 1024 * 1024
+# Number of messages sent to a user when joining a room, older ones are fetched page by page
+JOIN_HISTORY_SIZE = 100
+HISTORY_PAGE_MAX_SIZE = 200
+
+# Rough per-message bookkeeping cost on top of the string contents
+ENTRY_OVERHEAD_BYTES = 64
+
+class RoomHistory:
+    """Bounded chat history for one room.
+
+    Every message gets a sequence number that increases for as long as the room exists, also
+    across clear() calls, so clients can use it as a stable cursor. Messages are kept as compact
+    tuples and only turned into dicts when they are read.
+
+    Each entry also keeps its message rendered as JSON. The join snapshot and the HTTP body are
+    put together from those, so a message is serialized once when it is added rather than on
+    every join. Both are cached until the history changes, joiners in between share them."""
+    __slots__ = ("entries", "next_seq", "size_bytes", "max_messages", "max_bytes", "version", "join_snapshot", "http_body")
+
+    def __init__(self, max_messages: int = HISTORY_MAX_MESSAGES, max_bytes: int = HISTORY_MAX_BYTES):
+        # (seq, username, message, timestamp, json), seqs are contiguous from left to right
+        self.entries: deque = deque()
+        self.next_seq = 1
+        self.size_bytes = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        # Bumped on every change, the caches below belong to one version
+        self.version = 0
+        self.join_snapshot: EncodedEvent | None = None
+        self.http_body: bytes | None = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, message: Dict) -> Dict:
+        """Stores a message and returns it with its sequence number"""
+        entry = make_entry(self.next_seq, message["username"], message["message"], message["timestamp"])
+        self.next_seq += 1
+        self.entries.append(entry)
+        self.size_bytes += entry_size(entry)
+        while self.entries and (len(self.entries) > self.max_messages or self.size_bytes > self.max_bytes):
+            self.size_bytes -= entry_size(self.entries.popleft())
+        self.changed()
+        return entry_to_dict(entry)
+
+    def extend(self, messages: List[Dict]) -> List[Dict]:
+        """Stores several messages in one pass, the caches are dropped once"""
+        added = []
+        for message in messages:
+            entry = make_entry(self.next_seq, message["username"], message["message"], message["timestamp"])
+            self.next_seq += 1
+            self.entries.append(entry)
+            self.size_bytes += entry_size(entry)
+            added.append(entry)
+        while self.entries and (len(self.entries) > self.max_messages or self.size_bytes > self.max_bytes):
+            self.size_bytes -= entry_size(self.entries.popleft())
+        self.changed()
+        return [entry_to_dict(entry) for entry in added]
+
+    def restore(self, messages: List[Dict], next_seq: int):
+        """Replaces the contents with messages loaded from persistent storage"""
+        self.clear()
+        for message in messages:
+            entry = make_entry(message["seq"], message["username"], message["message"], message["timestamp"])
+            self.entries.append(entry)
+            self.size_bytes += entry_size(entry)
+        self.next_seq = next_seq
+
+    def clear(self):
+        self.entries.clear()
+        self.size_bytes = 0
+        self.changed()
+
+    def changed(self):
+        self.version += 1
+        self.join_snapshot = None
+        self.http_body = None
+
+    def first_seq(self) -> int:
+        """Sequence number of the oldest message still kept"""
+        return self.entries[0][0] if self.entries else self.next_seq
+
+    def all(self) -> List[Dict]:
+        return [entry_to_dict(entry) for entry in self.entries]
+
+    def latest(self, limit: int) -> Tuple[List[Dict], bool]:
+        """Returns the newest `limit` messages in chronological order, and whether there are
+        older ones"""
+        return self.before(self.next_seq, limit)
+
+    def before(self, cursor: int, limit: int) -> Tuple[List[Dict], bool]:
+        """Returns up to `limit` messages with a sequence number below `cursor` in chronological
+        order, and whether there are older ones"""
+        (start, stop) = self.slice_before(cursor, limit)
+        return ([entry_to_dict(entry) for entry in islice(self.entries, start, stop)], start > 0)
+
+    def entries_after(self, cursor: int, limit: int) -> Tuple[List[Tuple], bool]:
+        """Returns up to `limit` entries with a sequence number above `cursor` in chronological
+        order, and whether there are newer ones. Polling for new messages walks from the newest
+        end, so it costs what is new rather than the whole history."""
+        count = min(max(self.next_seq - 1 - cursor, 0), len(self.entries))
+        start = len(self.entries) - count
+        limit = max(limit, 0)
+        if count <= start:
+            entries = list(islice(reversed(self.entries), count))[::-1][:limit]
+        else:
+            entries = list(islice(self.entries, start, start + limit))
+        return (entries, count > limit)
+
+    def etag(self) -> str:
+        """HTTP validator of the history, changes whenever a message is added or the history is
+        cleared. The newest timestamp tells apart histories of a restarted server."""
+        newest = self.entries[-1][3] if self.entries else ""
+        return f'"{self.first_seq()}-{self.next_seq}-{newest}"'
+
+    def slice_before(self, cursor: int, limit: int) -> Tuple[int, int]:
+        stop = min(max(cursor - self.first_seq(), 0), len(self.entries))
+        return (max(stop - max(limit, 0), 0), stop)
+
+    def get_join_snapshot(self) -> EncodedEvent:
+        """The WsMessageHistory sent on joining, shared until the history changes"""
+        if self.join_snapshot is None:
+            (start, stop) = self.slice_before(self.next_seq, JOIN_HISTORY_SIZE)
+            entries = list(islice(self.entries, start, stop))
+            has_more = start > 0
+            # Not validated, the entries were when they were added
+            event = WsMessageHistory.model_construct(messages=[entry_to_dict(entry) for entry in entries], has_more=has_more)
+            self.join_snapshot = EncodedEvent.from_json(event,
+                '{"event_type":"message_history","messages":' + render_entries(entries) + ',"has_more":' + ("true" if has_more else "false") + "}")
+        return self.join_snapshot
+
+    def get_http_body(self) -> bytes:
+        """The body of the HTTP messages endpoints, all kept messages"""
+        if self.http_body is None:
+            self.http_body = ('{"messages":' + render_entries(self.entries) + "}").encode()
+        return self.http_body
+
+def make_entry(seq: int, username: str, message: str, timestamp: str) -> Tuple:
+    rendered = to_json({"seq": seq, "username": username, "message": message, "timestamp": timestamp}).decode()
+    return (seq, username, message, timestamp, rendered)
+
+def render_entries(entries) -> str:
+    return "[" + ",".join(entry[4] for entry in entries) + "]"
+
+def entry_size(entry: Tuple) -> int:
+    return ENTRY_OVERHEAD_BYTES + len(entry[1]) + len(entry[2]) + len(entry[3]) + len(entry[4])
+
+def entry_to_dict(entry: Tuple) -> Dict:
+    return {
+        "seq": entry[0],
+        "username": entry[1],
+        "message": entry[2],
+        "timestamp": entry[3],
+    }
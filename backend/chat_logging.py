@@ -0,0 +1,131 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict
+
+from logging import DEBUG, INFO, WARNING, ERROR
+
+LOG_ROOT = "chat"
+DEFAULT_LOG_LEVEL = "INFO"
+
+# Reserved attributes of a LogRecord, everything else passed as extra is a structured field
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class ChatLogger:
+    """Logger for one category (e.g. "broadcast").
+
+    Disabled levels return before anything is formatted, and a category can be sampled so that
+    only one in `sample_every` enabled log calls is written. Keyword arguments are emitted as
+    structured fields."""
+    __slots__ = ("logger", "sample_every", "counter")
+
+    def __init__(self, category: str):
+        self.logger = logging.getLogger(f"{LOG_ROOT}.{category}")
+        self.sample_every = 1
+        self.counter = 0
+
+    def enabled(self, level: int) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+        if self.sample_every == 1:
+            return True
+        self.counter += 1
+        return self.counter % self.sample_every == 0
+
+    def log(self, level: int, msg: str, *args, **fields):
+        if self.enabled(level):
+            self.logger.log(level, msg, *args, extra=fields)
+    def debug(self, msg: str, *args, **fields):
+        self.log(DEBUG, msg, *args, **fields)
+    def info(self, msg: str, *args, **fields):
+        self.log(INFO, msg, *args, **fields)
+    def warning(self, msg: str, *args, **fields):
+        self.log(WARNING, msg, *args, **fields)
+    def error(self, msg: str, *args, **fields):
+        self.log(ERROR, msg, *args, **fields)
+
+loggers: Dict[str, ChatLogger] = {}
+sample_rates: Dict[str, int] = {}
+
+def get_logger(category: str) -> ChatLogger:
+    if category not in loggers:
+        loggers[category] = ChatLogger(category)
+        loggers[category].sample_every = sample_rates.get(category, 1)
+    return loggers[category]
+
+def set_sample_rate(category: str, every: int):
+    """Only write one in `every` log lines of the category"""
+    sample_rates[category] = max(every, 1)
+    if category in loggers:
+        loggers[category].sample_every = sample_rates[category]
+
+def structured_fields(record: logging.LogRecord) -> Dict:
+    return {key: value for key, value in vars(record).items() if key not in RECORD_FIELDS}
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = structured_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log pipelines"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "category": record.name.removeprefix(f"{LOG_ROOT}."),
+            "message": record.getMessage(),
+        }
+        entry.update(structured_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+listener: logging.handlers.QueueListener | None = None
+
+def configure_logging(level: str | None = None, json_output: bool | None = None, sampling: str | None = None):
+    """Sets up the chat loggers, defaults come from the environment:
+        CHAT_LOG_LEVEL   DEBUG, INFO, WARNING or ERROR (default INFO)
+        CHAT_LOG_FORMAT  "text" or "json"
+        CHAT_LOG_SAMPLE  per category sampling, e.g. "delivery=1000,broadcast=100"
+
+    Log lines are handed to a queue and written by a background thread, so a slow stdout does
+    not block the event loop."""
+    global listener
+    level = level or os.environ.get("CHAT_LOG_LEVEL", DEFAULT_LOG_LEVEL)
+    if json_output is None:
+        json_output = os.environ.get("CHAT_LOG_FORMAT", "text") == "json"
+    sampling = sampling if sampling is not None else os.environ.get("CHAT_LOG_SAMPLE", "")
+
+    for rule in filter(None, sampling.split(",")):
+        (category, every) = rule.split("=")
+        set_sample_rate(category.strip(), int(every))
+
+    if listener:
+        listener.stop()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if json_output else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+
+    root = logging.getLogger(LOG_ROOT)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level.upper())
+    root.propagate = False
+
+@atexit.register
+def stop_logging():
+    # Writes out whatever is still queued
+    if listener:
+        listener.stop()
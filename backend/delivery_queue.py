@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from event_codecs import *
+
+# What a connection's queue does when it is full
+OVERFLOW_DISCONNECT = "disconnect"
+# Drop the oldest queued events (never control events)
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+# Drop queued typing events first, then disconnect if that was not enough
+OVERFLOW_DROP_EPHEMERAL = "drop_ephemeral"
+# Keep only the newest of events that replace each other (e.g. room lists), then drop ephemeral
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_POLICIES = (OVERFLOW_DISCONNECT, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_EPHEMERAL, OVERFLOW_COALESCE)
+
+# Control events go through their own lane, they are sent before anything else and never dropped.
+# The lane has its own small limits, a client that lets them fill up (e.g. by sending requests
+# without reading the responses) is disconnected whatever its overflow policy.
+CONTROL_MAX_ITEMS = 16
+CONTROL_MAX_BYTES = 64 * 1024
+CONTROL_EVENT_TYPES = {
+    "connection_response",
+    "connection_reject",
+    "room_switch_response",
+    "room_switch_reject",
+    "room_create_reject",
+}
+# Events that are fine to lose, the next one carries the full state anyway
+EPHEMERAL_EVENT_TYPES = {"typing", "typing_users"}
+# Events that are snapshots, a newer one makes an older queued one useless
+SNAPSHOT_EVENT_TYPES = {"typing_users", "users_online", "presence", "all_rooms"}
+
+def coalesce_key(event: WsEvent) -> Tuple | None:
+    if event.event_type in SNAPSHOT_EVENT_TYPES:
+        return (event.event_type,)
+    if isinstance(event, WsTypingEvent):
+        return (event.event_type, event.username)
+    return None
+
+class DeliveryQueue:
+    """Outgoing events of one connection, with a priority lane for control events and limits in
+    both events and bytes.
+
+    Items are (frame, queued_at, size). The frame is encoded when it is queued, which is free for
+    broadcasts since the encoding is shared by every recipient.
+
+    Events can be queued from any thread (room shards), the reader is woken up on `loop`, the loop
+    of the connection's sender. With `notify` that is called there instead of waking up get(), for
+    writers that serve many queues.
+
+    The lanes are plain lists, they are short and an empty deque costs several times more, which
+    adds up over many idle connections."""
+    __slots__ = ("codec", "max_items", "max_bytes", "policy", "control", "control_bytes", "normal", "size_bytes", "dropped", "not_empty", "notify", "lock", "loop")
+
+    def __init__(self, codec: EventCodec, max_items: int, max_bytes: int, policy: str = OVERFLOW_DISCONNECT,
+                 loop: asyncio.AbstractEventLoop | None = None, notify: Callable[[], Any] | None = None):
+        self.codec = codec
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.control: List[Tuple] = []
+        self.control_bytes = 0
+        self.normal: List[Tuple] = []
+        self.size_bytes = 0
+        # Events dropped by the overflow policy
+        self.dropped = 0
+        self.notify = notify
+        self.not_empty = asyncio.Event() if notify is None else None
+        self.lock = threading.Lock()
+        self.loop = loop
+
+    def qsize(self) -> int:
+        return len(self.control) + len(self.normal)
+    def empty(self) -> bool:
+        return not self.control and not self.normal
+    def free_slots(self) -> int:
+        """Normal events that can be queued before the overflow policy kicks in"""
+        return self.max_items - len(self.normal)
+
+    def put(self, frame: EncodedEvent) -> bool:
+        """Queues the frame, returns False if the overflow policy says the connection must go"""
+        item = (frame, time.perf_counter(), len(frame.encode(self.codec)))
+        with self.lock:
+            if not self.put_locked(item):
+                return False
+        self.wake()
+        return True
+
+    def put_many(self, frames: List[EncodedEvent]) -> bool:
+        """Queues the frames in order, taking the lock and waking the reader once. Returns False
+        as soon as one does not fit, the ones after it are not queued."""
+        queued_at = time.perf_counter()
+        items = [(frame, queued_at, len(frame.encode(self.codec))) for frame in frames]
+        with self.lock:
+            accepted = all(self.put_locked(item) for item in items)
+        self.wake()
+        return accepted
+
+    def put_locked(self, item: Tuple) -> bool:
+        if item[0].event.event_type in CONTROL_EVENT_TYPES:
+            if len(self.control) >= CONTROL_MAX_ITEMS or self.control_bytes + item[2] > CONTROL_MAX_BYTES:
+                return False
+            self.control.append(item)
+            self.control_bytes += item[2]
+        else:
+            if not self.make_room(item):
+                return False
+            self.normal.append(item)
+            self.size_bytes += item[2]
+        return True
+
+    def wake(self):
+        callback = self.notify or self.not_empty.set
+        if self.loop is None or running_loop() is self.loop:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    def get_nowait(self) -> Tuple:
+        with self.lock:
+            if self.control:
+                item = self.control.pop(0)
+                self.control_bytes -= item[2]
+                return item
+            item = self.normal.pop(0)
+            self.size_bytes -= item[2]
+            return item
+
+    async def get(self) -> Tuple:
+        while self.empty():
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        return self.get_nowait()
+
+    def drop_where(self, should_drop) -> int:
+        """Removes queued normal events for which should_drop(event) is true"""
+        with self.lock:
+            return self.drop_where_locked(should_drop)
+
+    def drop_where_locked(self, should_drop) -> int:
+        kept = []
+        dropped = 0
+        for item in self.normal:
+            if should_drop(item[0].event):
+                self.size_bytes -= item[2]
+                dropped += 1
+            else:
+                kept.append(item)
+        self.normal = kept
+        self.dropped += dropped
+        return dropped
+
+    def fits(self, item: Tuple) -> bool:
+        return len(self.normal) < self.max_items and self.size_bytes + item[2] <= self.max_bytes
+
+    def make_room(self, item: Tuple) -> bool:
+        """Applies the overflow policy, called with the lock held"""
+        if self.fits(item):
+            return True
+        if self.policy == OVERFLOW_DISCONNECT:
+            return False
+        if self.policy == OVERFLOW_DROP_OLDEST:
+            while self.normal and not self.fits(item):
+                self.size_bytes -= self.normal.pop(0)[2]
+                self.dropped += 1
+            return self.fits(item)
+        if self.policy == OVERFLOW_COALESCE:
+            self.coalesce(coalesce_key(item[0].event))
+            if self.fits(item):
+                return True
+        # OVERFLOW_DROP_EPHEMERAL, and what coalescing falls back to
+        self.drop_where_locked(lambda event: event.event_type in EPHEMERAL_EVENT_TYPES)
+        return self.fits(item)
+
+    def coalesce(self, incoming_key: Tuple | None):
+        """Keeps only the newest queued event per coalesce key, including the incoming event"""
+        seen: Dict[Tuple, bool] = {}
+        if incoming_key is not None:
+            seen[incoming_key] = True
+        kept = []
+        for item in reversed(self.normal):
+            key = coalesce_key(item[0].event)
+            if key is not None and key in seen:
+                self.size_bytes -= item[2]
+                self.dropped += 1
+                continue
+            if key is not None:
+                seen[key] = True
+            kept.append(item)
+        kept.reverse()
+        self.normal = kept
+
+def running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
@@ -0,0 +1,83 @@
+from delivery_queue import *
+
+def frame(event):
+    return EncodedEvent(event)
+
+def chat(text: str):
+    return frame(WsMessage(username="user", message=text))
+
+def typing(username: str = "user"):
+    return frame(WsTypingEvent(username=username, is_typing=True))
+
+def drain(queue: DeliveryQueue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait()[0].event)
+    return events
+
+def test_control_events_skip_the_line():
+    queue = DeliveryQueue(JSON_CODEC, 10, 1024 * 1024)
+    queue.put(chat("first"))
+    queue.put(frame(WsRoomSwitchResponse(room_name="other")))
+    assert [event.event_type for event in drain(queue)] == ["room_switch_response", "message"]
+
+def test_disconnect_policy():
+    queue = DeliveryQueue(JSON_CODEC, 2, 1024 * 1024, OVERFLOW_DISCONNECT)
+    assert queue.put(chat("1")) and queue.put(chat("2"))
+    assert not queue.put(chat("3"))
+    # Control events have their own lane
+    assert queue.put(frame(WsConnectionResponse(username="user", user_id="1")))
+
+def test_control_lane_is_bounded():
+    queue = DeliveryQueue(JSON_CODEC, 2, 1024 * 1024, OVERFLOW_DROP_OLDEST)
+    for _ in range(CONTROL_MAX_ITEMS):
+        assert queue.put(frame(WsRoomSwitchReject(response="Room x not found")))
+    # A client that never reads its responses is disconnected, whatever the policy
+    assert not queue.put(frame(WsRoomSwitchReject(response="Room x not found")))
+    queue.get_nowait()
+    assert queue.put(frame(WsRoomSwitchReject(response="Room x not found")))
+    assert queue.control_bytes == sum(size for (_, _, size) in queue.control)
+
+def test_drop_oldest_policy():
+    queue = DeliveryQueue(JSON_CODEC, 2, 1024 * 1024, OVERFLOW_DROP_OLDEST)
+    for text in ["1", "2", "3"]:
+        assert queue.put(chat(text))
+    assert [event.message for event in drain(queue)] == ["2", "3"]
+    assert queue.dropped == 1
+
+def test_drop_ephemeral_policy():
+    queue = DeliveryQueue(JSON_CODEC, 3, 1024 * 1024, OVERFLOW_DROP_EPHEMERAL)
+    queue.put(typing())
+    queue.put(chat("1"))
+    queue.put(chat("2"))
+    assert queue.put(chat("3"))
+    assert [event.event_type for event in drain(queue)] == ["message"] * 3
+    # Without anything ephemeral left the connection has to go
+    for text in ["4", "5", "6"]:
+        queue.put(chat(text))
+    assert not queue.put(chat("7"))
+
+def test_coalesce_policy_keeps_newest_snapshot():
+    queue = DeliveryQueue(JSON_CODEC, 3, 1024 * 1024, OVERFLOW_COALESCE)
+    queue.put(frame(WsTypingUsers(usernames=["a"])))
+    queue.put(chat("1"))
+    queue.put(frame(WsTypingUsers(usernames=["a", "b"])))
+    assert queue.put(frame(WsTypingUsers(usernames=["b"])))
+    events = drain(queue)
+    assert [event.event_type for event in events] == ["message", "typing_users"]
+    assert events[1].usernames == ["b"]
+
+def test_byte_limit():
+    size = len(chat("x" * 100).encode(JSON_CODEC))
+    queue = DeliveryQueue(JSON_CODEC, 100, size * 2, OVERFLOW_DISCONNECT)
+    assert queue.put(chat("x" * 100)) and queue.put(chat("x" * 100))
+    assert not queue.put(chat("x" * 100))
+    queue.get_nowait()
+    assert queue.size_bytes == size
+
+def test_put_many_stops_at_the_first_overflow():
+    queue = DeliveryQueue(JSON_CODEC, 3, 1024 * 1024, OVERFLOW_DISCONNECT)
+    assert queue.put_many([chat("1"), chat("2")])
+    assert queue.free_slots() == 1
+    assert not queue.put_many([chat("3"), chat("4"), chat("5")])
+    assert [event.message for event in drain(queue)] == ["1", "2", "3"]
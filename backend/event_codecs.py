@@ -0,0 +1,214 @@
+from pydantic import BaseModel, TypeAdapter
+from typing import Dict, List, Tuple, Type
+import os
+import time
+import zlib
+
+from message_types import *
+from metrics import counter, histogram
+
+# msgpack is optional, the binary subprotocol is only offered when it is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+encode_seconds = histogram("chat_encode_seconds", "Time spent serializing one event", ("codec",))
+deflate_input_bytes = counter("chat_deflate_input_bytes_total", "Bytes of frames passed to the deflate codecs")
+deflate_output_bytes = counter("chat_deflate_output_bytes_total", "Bytes of frames produced by the deflate codecs")
+
+# Compression for the "+deflate" subprotocols. Frames smaller than the threshold (most chat
+# messages) are not worth the CPU and are sent as they are.
+DEFLATE_LEVEL = int(os.environ.get("CHAT_DEFLATE_LEVEL", "6"))
+DEFLATE_WBITS = int(os.environ.get("CHAT_DEFLATE_WBITS", "15"))
+DEFLATE_THRESHOLD = int(os.environ.get("CHAT_DEFLATE_THRESHOLD", "512"))
+# First byte of every frame of a deflate codec
+# Client events are small (a chat message is at most 1000 characters), a deflated frame that
+# inflates to more than this is rejected before it is inflated any further
+MAX_INBOUND_FRAME_BYTES = 64 * 1024
+FRAME_PLAIN = b"\x00"
+FRAME_DEFLATED = b"\x01"
+
+# Building a TypeAdapter is expensive, so it is done once for the whole process
+WS_EVENT_ADAPTER = TypeAdapter(WsEvent)
+
+class EventCodec:
+    """Encodes and decodes WsEvents for one WebSocket subprotocol.
+
+    decode() raises ValueError (pydantic's ValidationError is one) for malformed frames."""
+    name = ""
+    binary = False
+
+    def encode(self, event: BaseModel) -> str | bytes:
+        raise NotImplementedError
+    def decode(self, frame: str | bytes, model: Type[BaseModel] | None = None) -> WsEvent:
+        raise NotImplementedError
+    def encode_batch(self, frames: List[str | bytes]) -> str | bytes:
+        """Wraps already encoded events in a WsBatch frame without encoding them again, the frames
+        are encoded with batch_codec"""
+        raise NotImplementedError
+    def add_seq(self, frame: str | bytes, seq: int) -> str | bytes:
+        """Adds an event_seq field to an already encoded event"""
+        raise NotImplementedError
+    @property
+    def batch_codec(self) -> "EventCodec":
+        return self
+
+class JsonCodec(EventCodec):
+    """The default text codec. Both directions run inside pydantic-core, without an
+    intermediate Python dict."""
+    name = "chat.json"
+
+    def encode(self, event: BaseModel) -> str:
+        return event.model_dump_json()
+    def decode(self, frame: str | bytes, model: Type[BaseModel] | None = None) -> WsEvent:
+        if model is not None:
+            return model.model_validate_json(frame)
+        return WS_EVENT_ADAPTER.validate_json(frame)
+    def encode_batch(self, frames: List[str]) -> str:
+        return '{"event_type":"batch","events":[' + ",".join(frames) + "]}"
+    def add_seq(self, frame: str, seq: int) -> str:
+        return '{"event_seq":' + str(seq) + "," + frame[1:]
+
+class MsgPackCodec(EventCodec):
+    """Binary codec, events are sent as MessagePack maps with the same fields as the JSON
+    representation"""
+    name = "chat.msgpack"
+    binary = True
+
+    def encode(self, event: BaseModel) -> bytes:
+        return msgpack.packb(event.model_dump(mode="json"))
+    def decode(self, frame: str | bytes, model: Type[BaseModel] | None = None) -> WsEvent:
+        if isinstance(frame, str):
+            raise ValueError("Expected a binary frame")
+        try:
+            data = msgpack.unpackb(frame)
+        except Exception as e:
+            raise ValueError(f"Invalid MessagePack frame: {e}")
+        if model is not None:
+            return model.model_validate(data)
+        return WS_EVENT_ADAPTER.validate_python(data)
+    def encode_batch(self, frames: List[bytes]) -> bytes:
+        packer = msgpack.Packer()
+        header = packer.pack_map_header(2) + packer.pack("event_type") + packer.pack("batch") + packer.pack("events")
+        return header + packer.pack_array_header(len(frames)) + b"".join(frames)
+    def add_seq(self, frame: bytes, seq: int) -> bytes:
+        # Events are small maps, the field count is in the first byte of their header
+        if 0x80 <= frame[0] < 0x8f:
+            return bytes([frame[0] + 1]) + msgpack.packb("event_seq") + msgpack.packb(seq) + frame[1:]
+        return msgpack.packb({**msgpack.unpackb(frame), "event_seq": seq})
+
+class DeflateCodec(EventCodec):
+    """Wraps another codec and compresses its frames with raw deflate.
+
+    Every frame is binary, a FRAME_PLAIN or FRAME_DEFLATED byte followed by the (UTF-8) frame of
+    the inner codec. Unlike permessage-deflate there is no compression context shared between
+    frames, so a frame is compressed once and the result is shared by every connection that
+    receives it, e.g. the room list snapshot sent to everyone joining after a deploy."""
+    binary = True
+
+    def __init__(self, inner: EventCodec, level: int = DEFLATE_LEVEL, wbits: int = DEFLATE_WBITS, threshold: int = DEFLATE_THRESHOLD):
+        self.inner = inner
+        self.name = inner.name + "+deflate"
+        self.level = level
+        self.wbits = wbits
+        self.threshold = threshold
+
+    @property
+    def batch_codec(self) -> EventCodec:
+        # Batches are built from the inner frames and compressed as a whole
+        return self.inner
+
+    def compress(self, frame: str | bytes) -> bytes:
+        data = frame.encode() if isinstance(frame, str) else frame
+        if len(data) < self.threshold:
+            return FRAME_PLAIN + data
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits)
+        compressed = compressor.compress(data) + compressor.flush()
+        deflate_input_bytes.inc(len(data))
+        deflate_output_bytes.inc(len(compressed) + 1)
+        if len(compressed) >= len(data):
+            return FRAME_PLAIN + data
+        return FRAME_DEFLATED + compressed
+
+    def decompress(self, frame: bytes) -> str | bytes:
+        if not frame:
+            raise ValueError("Empty frame")
+        (kind, data) = (frame[:1], frame[1:])
+        if kind == FRAME_DEFLATED:
+            try:
+                decompressor = zlib.decompressobj(-self.wbits)
+                data = decompressor.decompress(data, MAX_INBOUND_FRAME_BYTES)
+            except zlib.error as e:
+                raise ValueError(f"Invalid deflate frame: {e}")
+            if decompressor.unconsumed_tail:
+                raise ValueError(f"Deflated frame inflates to more than {MAX_INBOUND_FRAME_BYTES} bytes")
+        elif kind != FRAME_PLAIN:
+            raise ValueError("Unknown frame type")
+        return data if self.inner.binary else data.decode()
+
+    def encode(self, event: BaseModel) -> bytes:
+        return self.compress(self.inner.encode(event))
+    def decode(self, frame: str | bytes, model: Type[BaseModel] | None = None) -> WsEvent:
+        # Clients may also send plain text frames of the inner codec
+        if isinstance(frame, bytes):
+            frame = self.decompress(frame)
+        return self.inner.decode(frame, model)
+    def encode_batch(self, frames: List[str | bytes]) -> bytes:
+        return self.compress(self.inner.encode_batch(frames))
+
+JSON_CODEC = JsonCodec()
+DEFAULT_CODEC = JSON_CODEC
+
+# Maps subprotocol name to codec, in order of server preference
+CODECS: Dict[str, EventCodec] = { JSON_CODEC.name: JSON_CODEC }
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec()
+# Every codec is also offered compressed, e.g. "chat.json+deflate"
+CODECS.update({deflate.name: deflate for deflate in [DeflateCodec(codec) for codec in CODECS.values()]})
+
+def negotiate_codec(requested_subprotocols: List[str]) -> Tuple[EventCodec, str | None]:
+    """Picks the first subprotocol offered by the client that the server supports.
+    Returns the codec and the subprotocol to accept with (None if nothing was agreed on)."""
+    for subprotocol in requested_subprotocols:
+        if subprotocol in CODECS:
+            return (CODECS[subprotocol], subprotocol)
+    return (DEFAULT_CODEC, None)
+
+class EncodedEvent:
+    """A WsEvent together with its serialized frames.
+
+    Each codec encodes the event at most once, so the same EncodedEvent can be shared between
+    the delivery queues of every connection in a room (or every room, for global events)."""
+    __slots__ = ("event", "_frames")
+
+    def __init__(self, event: WsEvent):
+        self.event = event
+        self._frames: Dict[str, str | bytes] = {}
+
+    @classmethod
+    def from_json(cls, event: WsEvent, frame: str) -> "EncodedEvent":
+        """For events whose JSON frame was put together without encoding the event"""
+        encoded = cls(event)
+        encoded._frames[JSON_CODEC.name] = frame
+        return encoded
+
+    @classmethod
+    def from_frame(cls, codec: EventCodec, frame: str | bytes) -> "EncodedEvent":
+        """Decodes a received frame, keeping it as the already encoded form for that codec"""
+        encoded = cls(codec.decode(frame))
+        encoded._frames[codec.name] = frame
+        return encoded
+
+    def encode(self, codec: EventCodec) -> str | bytes:
+        frame = self._frames.get(codec.name)
+        if frame is None:
+            if isinstance(codec, DeflateCodec):
+                # Compresses the frame of the inner codec, which may already be there
+                frame = self._frames[codec.name] = codec.compress(self.encode(codec.inner))
+                return frame
+            started = time.perf_counter()
+            frame = codec.encode(self.event)
+            encode_seconds.labels(codec.name).observe(time.perf_counter() - started)
+            self._frames[codec.name] = frame
+        return frame
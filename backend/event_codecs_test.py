@@ -0,0 +1,41 @@
+import zlib
+
+import pytest
+
+from event_codecs import *
+
+def test_deflate_codec_skips_small_frames():
+    codec = CODECS["chat.json+deflate"]
+    frame = codec.encode(WsMessage(username="alice", message="hi"))
+    assert frame[:1] == FRAME_PLAIN
+    assert codec.decode(frame) == WsMessage(username="alice", message="hi")
+
+def test_deflate_codec_compresses_large_frames():
+    codec = DeflateCodec(JSON_CODEC, level=9, wbits=12, threshold=64)
+    history = WsMessageHistory(messages=[{"username": "alice", "message": f"message {i}", "seq": i} for i in range(200)])
+    frame = codec.encode(history)
+    assert frame[:1] == FRAME_DEFLATED
+    assert len(frame) < len(JSON_CODEC.encode(history)) / 4
+    assert zlib.decompress(frame[1:], -12).decode() == JSON_CODEC.encode(history)
+    assert codec.decode(frame) == history
+    # Plain text frames of the inner codec are accepted from clients
+    assert codec.decode(JSON_CODEC.encode(history)) == history
+
+def test_deflate_frame_is_compressed_once_per_event():
+    codec = CODECS["chat.json+deflate"]
+    encoded = EncodedEvent(WsAllRooms(rooms=[RoomInfo(room_name=f"room{i}", room_creator="alice", connected_users=["bob"] * 20) for i in range(20)]))
+    assert encoded.encode(codec) is encoded.encode(codec)
+
+def test_deflate_batches_compress_inner_frames():
+    codec = CODECS["chat.json+deflate"]
+    frames = [JSON_CODEC.encode(WsMessage(username="alice", message="hello " * 20)) for _ in range(10)]
+    batch = codec.encode_batch(frames)
+    assert batch[:1] == FRAME_DEFLATED
+    assert len(codec.decode(batch, WsBatch).events) == 10
+
+def test_deflate_codec_limits_inflated_size():
+    codec = CODECS["chat.json+deflate"]
+    frame = DeflateCodec(JSON_CODEC, threshold=0).compress(JSON_CODEC.encode(WsMessage(username="alice", message="x" * MAX_INBOUND_FRAME_BYTES)))
+    assert frame[:1] == FRAME_DEFLATED
+    with pytest.raises(ValueError, match="inflates to more than"):
+        codec.decode(frame)
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from typing import Dict, List
+
+from pydantic_core import to_json
+
+from delivery_queue import running_loop
+from event_codecs import *
+
+# Chunks buffered for a listener that is not reading. Beyond that it is dropped, and catches up
+# from the history with Last-Event-ID when its client reconnects.
+EVENT_STREAM_MAX_QUEUED = 256
+# Chat messages replayed to a new listener, after its Last-Event-ID or the newest ones
+EVENT_STREAM_REPLAY_MAX = 1000
+# A comment is sent when nothing happened for this long, so proxies keep the stream open
+EVENT_STREAM_KEEPALIVE_SECONDS = 15.0
+# How long clients wait before reconnecting
+EVENT_STREAM_RETRY_MS = 3000
+
+def event_stream_frame(frame: EncodedEvent) -> str:
+    """The SSE event of an encoded frame other than a chat message. Built once per frame and
+    shared by every listener, the data is the JSON frame."""
+    return f"data: {frame.encode(JSON_CODEC)}\n\n"
+
+def event_stream_messages(messages: List[Dict]) -> str:
+    """SSE events of stored chat messages, the same as their replay, with seq and timestamp"""
+    return "".join(event_stream_message(message["seq"], to_json(message).decode()) for message in messages)
+
+def event_stream_replay(entries: List[Tuple]) -> str:
+    """SSE events of history entries, their rendered JSON plus the event_type"""
+    return "".join(event_stream_message(entry[0], entry[4]) for entry in entries)
+
+def event_stream_message(seq: int, rendered: str) -> str:
+    # The seq is the event id, for resuming with Last-Event-ID
+    return f'id: {seq}\ndata: {{"event_type":"message",{rendered[1:]}\n\n'
+
+class EventStreamListener:
+    """Read-only subscriber of a room for Server-Sent Events.
+
+    Fed by the same fan-out as the WebSocket connections, with the SSE text of each event built
+    once for all listeners. It holds no username, task or receive loop, only the text that was not
+    sent yet. Events are pushed from the room's shard and read on the server's loop."""
+    __slots__ = ("listener_id", "pending", "overflowed", "wakeup", "loop", "lock")
+
+    def __init__(self, listener_id: int):
+        self.listener_id = listener_id
+        self.pending: List[str] = []
+        self.overflowed = False
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.lock = threading.Lock()
+
+    def push(self, text: str, replay: bool = False):
+        """Queues the text of an event, a replay is never dropped"""
+        with self.lock:
+            if self.overflowed:
+                return
+            if len(self.pending) >= EVENT_STREAM_MAX_QUEUED and not replay:
+                self.overflowed = True
+            else:
+                self.pending.append(text)
+        if running_loop() is self.loop:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def read(self) -> str | None:
+        """Waits for what was queued since the last read. Returns a keepalive comment when nothing
+        was, and None once the listener fell too far behind."""
+        while True:
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+                overflowed = self.overflowed
+            if pending:
+                return "".join(pending)
+            if overflowed:
+                return None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), EVENT_STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                return ": keepalive\n\n"
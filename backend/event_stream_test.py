@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from websocket_handlers import *
+
+def test_listener_is_dropped_when_it_falls_behind():
+    async def main():
+        listener = EventStreamListener(0)
+        listener.push("replay\n\n" * 1000, replay=True)
+        for i in range(EVENT_STREAM_MAX_QUEUED + 1):
+            listener.push(f"data: {i}\n\n")
+        text = await listener.read()
+        assert text.startswith("replay") and text.endswith(f"data: {EVENT_STREAM_MAX_QUEUED - 2}\n\n")
+        assert await listener.read() is None
+    asyncio.run(main())
+
+def test_event_stream_resumes_after_last_event_id():
+    async def main():
+        (manager, _) = storage.get_manager("sse_room")
+        for i in range(3):
+            await manager.deliver(EncodedEvent(WsMessage(username="sse_user", message=f"old {i}")))
+        stream = event_stream(manager, 1)
+        assert await anext(stream) == f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+        replay = await anext(stream)
+        assert [line for line in replay.splitlines() if line.startswith("id: ")] == ["id: 2", "id: 3"]
+        assert '"message":"old 2"' in replay
+
+        # Live messages look like replayed ones, other events share the frame of the WebSocket fan-out
+        await manager.deliver(EncodedEvent(WsMessage(username="sse_user", message="live")))
+        await manager.deliver(EncodedEvent(WsUserJoinEvent(username="someone")))
+        (live, join) = (await anext(stream)).split("\n\n")[:2]
+        (entries, _) = storage.get_entries_after("sse_room", 3, 1)
+        assert live == event_stream_replay(entries).removesuffix("\n\n")
+        assert json.loads(live.removeprefix("id: 4\ndata: ")).keys() == {"event_type", "seq", "username", "message", "timestamp"}
+        assert join == 'data: {"event_type":"user_join","username":"someone"}'
+        assert len(manager.listeners) == 1
+        await stream.aclose()
+        assert manager.listeners == {}
+    asyncio.run(main())
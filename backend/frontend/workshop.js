@@ -39,6 +39,7 @@ globalThis.websocket = null;
 globalThis.lastActivity = performance.now();
 globalThis.isTyping = false;
 globalThis.GLOBAL_ROOM_NAME = "Global";
+globalThis.typingUsers = new Set();
 
 const WS_EVENT_TYPES = {
     connection_request: 'connection_request',
@@ -47,6 +48,7 @@ const WS_EVENT_TYPES = {
     message: 'message',
     message_history: 'message_history',
     typing: 'typing',
+    typing_users: 'typing_users',
     system: 'system',
     users_online: 'users_online',
     user_join: 'user_join',
@@ -180,6 +182,17 @@ function wsReceiveMessage(message, username) {
         case WS_EVENT_TYPES.typing:
             updateMemberStatus(message.username, message.is_typing ? 'typing' : 'online');
             break;
+        // The server sends everyone that is typing a few times per second, instead of every typing event
+        case WS_EVENT_TYPES.typing_users:
+            const typingNow = new Set(message.usernames);
+            globalThis.typingUsers.forEach((user) => {
+                if (!typingNow.has(user)) {
+                    updateMemberStatus(user, 'online');
+                }
+            });
+            typingNow.forEach((user) => updateMemberStatus(user, 'typing'));
+            globalThis.typingUsers = typingNow;
+            break;
 
         // ASSIGNMENT 5: Room management
         case WS_EVENT_TYPES.all_rooms:
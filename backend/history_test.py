@@ -0,0 +1,97 @@
+import json
+
+from chat_history import *
+
+def chat(text: str, username: str = "user"):
+    return {"username": username, "message": text, "timestamp": "2025-09-26T10:30:00.123456"}
+
+def test_history_assigns_sequence_numbers():
+    history = RoomHistory()
+    first = history.append(chat("one"))
+    second = history.append(chat("two"))
+    assert (first["seq"], second["seq"]) == (1, 2)
+    assert [m["message"] for m in history.all()] == ["one", "two"]
+
+def test_history_extend_appends_in_one_pass():
+    history = RoomHistory(max_messages=3)
+    history.append(chat("zero"))
+    snapshot = history.get_join_snapshot()
+    added = history.extend([chat("one"), chat("two"), chat("three")])
+    assert [message["seq"] for message in added] == [2, 3, 4]
+    assert [message["message"] for message in history.all()] == ["one", "two", "three"]
+    assert history.get_join_snapshot() is not snapshot
+
+def test_entries_after_cursor():
+    history = RoomHistory()
+    for i in range(10):
+        history.append(chat(str(i)))
+    etag = history.etag()
+    # Near the newest end and near the oldest end
+    assert [(entry[0], entry[2]) for entry in history.entries_after(8, 5)[0]] == [(9, "8"), (10, "9")]
+    assert history.entries_after(8, 5)[1] is False
+    (entries, has_more) = history.entries_after(0, 3)
+    assert ([entry[0] for entry in entries], has_more) == ([1, 2, 3], True)
+    (entries, has_more) = history.entries_after(5, 2)
+    assert ([entry[0] for entry in entries], has_more) == ([6, 7], True)
+    assert history.entries_after(10, 5) == ([], False)
+    assert history.etag() == etag
+    history.append(chat("10"))
+    assert history.etag() != etag
+
+def test_history_evicts_oldest_by_count():
+    history = RoomHistory(max_messages=3)
+    for i in range(10):
+        history.append(chat(str(i)))
+    assert [m["seq"] for m in history.all()] == [8, 9, 10]
+
+def test_history_evicts_oldest_by_bytes():
+    size = entry_size(make_entry(1, "user", "x" * 10, chat("")["timestamp"]))
+    history = RoomHistory(max_bytes=size * 2)
+    for _ in range(5):
+        history.append(chat("x" * 10))
+    assert len(history) == 2
+    assert history.size_bytes == size * 2
+
+def test_history_paging_by_cursor():
+    history = RoomHistory()
+    for i in range(10):
+        history.append(chat(str(i)))
+    (latest, has_more) = history.latest(4)
+    assert [m["seq"] for m in latest] == [7, 8, 9, 10] and has_more
+    (page, has_more) = history.before(latest[0]["seq"], 4)
+    assert [m["seq"] for m in page] == [3, 4, 5, 6] and has_more
+    (page, has_more) = history.before(page[0]["seq"], 4)
+    assert [m["seq"] for m in page] == [1, 2] and not has_more
+
+def test_history_sequence_survives_clear():
+    history = RoomHistory()
+    history.append(chat("before"))
+    history.clear()
+    assert history.latest(10) == ([], False)
+    assert history.append(chat("after"))["seq"] == 2
+
+def test_join_snapshot_is_shared_until_history_changes():
+    history = RoomHistory()
+    for i in range(JOIN_HISTORY_SIZE + 1):
+        history.append(chat(f"message \"{i}\""))
+    snapshot = history.get_join_snapshot()
+    assert history.get_join_snapshot() is snapshot
+    # The assembled frame is what encoding the event would have produced
+    expected = WsMessageHistory(messages=history.latest(JOIN_HISTORY_SIZE)[0], has_more=True)
+    assert snapshot.encode(JSON_CODEC) == expected.model_dump_json()
+    deflate = CODECS[JSON_CODEC.name + "+deflate"]
+    assert deflate.decode(snapshot.encode(deflate)) == expected
+    history.append(chat("newer"))
+    assert history.get_join_snapshot() is not snapshot
+    assert history.get_join_snapshot().event.messages[-1]["message"] == "newer"
+    history.clear()
+    assert history.get_join_snapshot().encode(JSON_CODEC) == WsMessageHistory(messages=[], has_more=False).model_dump_json()
+
+def test_http_body_is_rendered_once_per_version():
+    history = RoomHistory()
+    history.append(chat("one"))
+    body = history.get_http_body()
+    assert history.get_http_body() is body
+    assert json.loads(body) == {"messages": history.all()}
+    history.clear()
+    assert json.loads(history.get_http_body()) == {"messages": []}
@@ -0,0 +1,26 @@
+import json
+import logging
+from chat_logging import JsonFormatter, get_logger, set_sample_rate
+
+class Unprintable:
+    def __str__(self):
+        raise AssertionError("formatted a disabled log line")
+
+def test_disabled_level_skips_formatting():
+    log = get_logger("logging_test_disabled")
+    log.logger.setLevel(logging.INFO)
+    log.debug("never formatted %s", Unprintable())
+
+def test_sampling_keeps_one_in_n():
+    log = get_logger("logging_test_sampled")
+    log.logger.setLevel(logging.DEBUG)
+    set_sample_rate("logging_test_sampled", 100)
+    assert sum(log.enabled(logging.DEBUG) for _ in range(1000)) == 10
+
+def test_json_output_includes_structured_fields():
+    record = logging.LogRecord("chat.delivery", logging.INFO, __file__, 1, "Delivering %s", ("message",), None)
+    record.user_uuid = "1234"
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["category"] == "delivery"
+    assert entry["message"] == "Delivering message"
+    assert entry["user_uuid"] == "1234"
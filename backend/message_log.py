@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+from chat_logging import get_logger
+
+log = get_logger("storage")
+
+# Appends are collected for this long and then committed (and fsynced) as one transaction,
+# so a crash loses at most one batch window of messages
+LOG_BATCH_WINDOW_SECONDS = 0.05
+LOG_BATCH_MAX_SIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    room_name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (room_name, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS truncations (
+    room_name TEXT PRIMARY KEY,
+    before_seq INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rooms (
+    room_name TEXT PRIMARY KEY,
+    creator TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+class MessageLog:
+    """Durable, append-only chat history backed by SQLite in WAL mode.
+
+    Writes never touch the disk on the calling thread: they are queued and a background writer
+    thread commits them in batches (group commit). Clearing a room only stores a truncation
+    marker, messages below the marker are ignored when reading."""
+    def __init__(self, path: str, batch_window: float = LOG_BATCH_WINDOW_SECONDS):
+        self.path = path
+        self.batch_window = batch_window
+        self.writer = self.connect()
+        self.writer.executescript(SCHEMA)
+        # Reads go through their own connection, from a thread pool, one at a time
+        self.reader = self.connect()
+        self.reader_lock = threading.Lock()
+
+        self.pending: List[Tuple[str, Tuple]] = []
+        self.condition = threading.Condition()
+        self.committed_batches = 0
+        self.queued_batches = 0
+        self.stopping = False
+        self.writer_thread = threading.Thread(target=self.writer_loop, name="message-log-writer", daemon=True)
+        self.writer_thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # FULL makes every commit fsync the WAL, which is what makes a batch durable
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def append(self, room_name: str, message: Dict):
+        """Queues a message (including its "seq") for the next batch"""
+        self.enqueue("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+            (room_name, message["seq"], message["username"], message["message"], message["timestamp"]))
+    def truncate(self, room_name: str, before_seq: int):
+        """Logically removes every message of the room with a sequence number below before_seq"""
+        self.enqueue("INSERT OR REPLACE INTO truncations VALUES (?, ?)", (room_name, before_seq))
+    def add_room(self, room_name: str, creator: str):
+        self.enqueue("INSERT OR IGNORE INTO rooms VALUES (?, ?)", (room_name, creator))
+    def add_user(self, username: str, password_hash: bytes):
+        self.enqueue("INSERT OR IGNORE INTO users VALUES (?, ?)", (username, password_hash))
+
+    def enqueue(self, statement: str, parameters: Tuple):
+        with self.condition:
+            if not self.pending:
+                self.queued_batches += 1
+            self.pending.append((statement, parameters))
+            if len(self.pending) == 1 or len(self.pending) >= LOG_BATCH_MAX_SIZE:
+                self.condition.notify()
+
+    def writer_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending and self.stopping:
+                    return
+                # Let the batch fill up for one window, unless it is already large
+                if not self.stopping and len(self.pending) < LOG_BATCH_MAX_SIZE:
+                    self.condition.wait(self.batch_window)
+                batch = self.pending
+                self.pending = []
+            try:
+                self.writer.execute("BEGIN")
+                for (statement, parameters) in batch:
+                    self.writer.execute(statement, parameters)
+                self.writer.execute("COMMIT")
+            except sqlite3.Error as e:
+                log.error("Failed to commit batch of %d: %s", len(batch), e)
+                if self.writer.in_transaction:
+                    self.writer.execute("ROLLBACK")
+            with self.condition:
+                self.committed_batches += 1
+                self.condition.notify_all()
+
+    def flush(self):
+        """Blocks until everything queued so far is committed"""
+        with self.condition:
+            target = self.queued_batches
+            self.condition.notify()
+            while self.committed_batches < target and self.writer_thread.is_alive():
+                self.condition.wait(0.1)
+
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.writer_thread.join()
+        self.writer.close()
+        self.reader.close()
+
+    def load_rooms(self, max_messages_per_room: int) -> Dict[str, Tuple[str, int, List[Dict]]]:
+        """Rebuilds state at startup, returns room_name -> (creator, next_seq, newest messages).
+        Finding the last seq of every room is one pass over the primary key index, only the newest
+        messages of each room are read."""
+        rooms: Dict[str, Tuple[str, int, List[Dict]]] = {}
+        with self.reader_lock:
+            last_seqs = dict(self.reader.execute("SELECT room_name, MAX(seq) FROM messages GROUP BY room_name"))
+            truncations = dict(self.reader.execute("SELECT room_name, before_seq FROM truncations"))
+            creators = dict(self.reader.execute("SELECT room_name, creator FROM rooms"))
+        for room_name in set(last_seqs) | set(truncations) | set(creators):
+            next_seq = max(last_seqs.get(room_name, 0) + 1, truncations.get(room_name, 1))
+            (messages, _) = self.read_before(room_name, next_seq, max_messages_per_room)
+            rooms[room_name] = (creators.get(room_name, ""), next_seq, messages)
+        return rooms
+
+    def load_users(self) -> List[Tuple[str, bytes]]:
+        with self.reader_lock:
+            return self.reader.execute("SELECT username, password_hash FROM users").fetchall()
+    def read_user(self, username: str) -> bytes | None:
+        """The password hash of a user, e.g. one registered on another worker. Blocks on disk."""
+        with self.reader_lock:
+            row = self.reader.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def read_before(self, room_name: str, cursor: int, limit: int) -> Tuple[List[Dict], bool]:
+        """Returns up to `limit` messages below `cursor` in chronological order, and whether
+        there are older ones. Blocks on disk, so it should not be called on the event loop."""
+        with self.reader_lock:
+            row = self.reader.execute("SELECT before_seq FROM truncations WHERE room_name = ?", (room_name,)).fetchone()
+            first_seq = row[0] if row else 0
+            rows = self.reader.execute(
+                "SELECT seq, username, message, timestamp FROM messages "
+                "WHERE room_name = ? AND seq >= ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (room_name, first_seq, cursor, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        messages = [
+            {"seq": seq, "username": username, "message": message, "timestamp": timestamp}
+            for (seq, username, message, timestamp) in reversed(rows[:limit])
+        ]
+        return (messages, has_more)
+
+    def read_after(self, room_name: str, cursor: int, before: int, limit: int) -> Tuple[List[Dict], bool]:
+        """Returns up to `limit` messages above `cursor` and below `before` in chronological order,
+        and whether there are more of them. Blocks on disk, so it should not be called on the
+        event loop."""
+        with self.reader_lock:
+            row = self.reader.execute("SELECT before_seq FROM truncations WHERE room_name = ?", (room_name,)).fetchone()
+            first_seq = row[0] if row else 0
+            rows = self.reader.execute(
+                "SELECT seq, username, message, timestamp FROM messages "
+                "WHERE room_name = ? AND seq >= ? AND seq > ? AND seq < ? ORDER BY seq LIMIT ?",
+                (room_name, first_seq, cursor, before, limit + 1)).fetchall()
+        messages = [
+            {"seq": seq, "username": username, "message": message, "timestamp": timestamp}
+            for (seq, username, message, timestamp) in rows[:limit]
+        ]
+        return (messages, len(rows) > limit)
+
+def message_log_from_env() -> MessageLog | None:
+    """Persistence is enabled by pointing CHAT_DB_PATH at a database file"""
+    path = os.environ.get("CHAT_DB_PATH")
+    if not path:
+        return None
+    return MessageLog(path, float(os.environ.get("CHAT_DB_BATCH_WINDOW", LOG_BATCH_WINDOW_SECONDS)))
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import subprocess
+import sys
+import textwrap
+from message_log import MessageLog
+from websocket_handlers import Storage
+
+def chat(text: str):
+    return {"username": "user", "message": text, "timestamp": "2025-09-26T10:30:00.123456"}
+
+def test_storage_restores_history_from_log(tmp_path):
+    path = str(tmp_path / "chat.db")
+    storage = Storage(message_log=MessageLog(path))
+    (manager, _) = storage.get_manager("durable_room")
+    storage.set_room_creator(manager, "creator")
+    for i in range(5):
+        storage.add_to_chat("durable_room", chat(str(i)))
+    storage.message_log.close()
+
+    restored = Storage(message_log=MessageLog(path))
+    assert [m["message"] for m in restored.get_chat_messages("durable_room")] == ["0", "1", "2", "3", "4"]
+    assert restored.managers["durable_room"].creator == "creator"
+    # Sequence numbers continue where they left off
+    assert restored.add_to_chat("durable_room", chat("5"))["seq"] == 6
+    restored.message_log.close()
+
+def test_clear_chat_is_a_truncation_marker(tmp_path):
+    path = str(tmp_path / "chat.db")
+    storage = Storage(message_log=MessageLog(path))
+    for i in range(3):
+        storage.add_to_chat("cleared_room", chat(str(i)))
+    storage.clear_chat("cleared_room")
+    storage.add_to_chat("cleared_room", chat("after clear"))
+    storage.message_log.close()
+
+    restored = Storage(message_log=MessageLog(path))
+    messages = restored.get_chat_messages("cleared_room")
+    assert [(m["seq"], m["message"]) for m in messages] == [(4, "after clear")]
+    assert asyncio.run(restored.get_history_page("cleared_room", 4, 10)) == ([], False)
+    restored.message_log.close()
+
+def test_history_paging_falls_back_to_log(tmp_path):
+    storage = Storage(history_max_messages=3, message_log=MessageLog(str(tmp_path / "chat.db")))
+    for i in range(10):
+        storage.add_to_chat("paged_room", chat(str(i)))
+    storage.flush()
+    (page, has_more) = asyncio.run(storage.get_history_page("paged_room", 11, 5))
+    assert [m["seq"] for m in page] == [6, 7, 8, 9, 10] and has_more
+    (page, has_more) = asyncio.run(storage.get_history_page("paged_room", 6, 10))
+    assert [m["seq"] for m in page] == [1, 2, 3, 4, 5] and not has_more
+    storage.message_log.close()
+
+def test_polling_falls_back_to_log(tmp_path):
+    storage = Storage(history_max_messages=3, message_log=MessageLog(str(tmp_path / "chat.db")))
+    for i in range(10):
+        storage.add_to_chat("polled_room", chat(str(i)))
+    storage.flush()
+    (entries, has_more) = asyncio.run(storage.get_page_after("polled_room", 2, 4))
+    assert [entry[0] for entry in entries] == [3, 4, 5, 6] and has_more
+    (entries, has_more) = asyncio.run(storage.get_page_after("polled_room", 5, 10))
+    assert [entry[0] for entry in entries] == [6, 7, 8, 9, 10] and not has_more
+    assert entries[0][4] == '{"seq":6,"username":"user","message":"5","timestamp":"2025-09-26T10:30:00.123456"}'
+    storage.message_log.close()
+
+def test_crash_loses_at_most_one_batch_window(tmp_path):
+    path = str(tmp_path / "chat.db")
+    # Write from a separate process and kill it without flushing or closing the log
+    script = textwrap.dedent(f"""
+        import os, time
+        from message_log import MessageLog
+        log = MessageLog({path!r}, batch_window=0.05)
+        for i in range(100):
+            log.append("crash_room", {{"seq": i + 1, "username": "user", "message": str(i), "timestamp": ""}})
+        time.sleep(0.5)
+        log.append("crash_room", {{"seq": 101, "username": "user", "message": "in flight", "timestamp": ""}})
+        os._exit(1)
+    """)
+    subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)), check=False)
+
+    log = MessageLog(path)
+    (_, next_seq, messages) = log.load_rooms(1000)["crash_room"]
+    # Everything older than one batch window survived, only the in-flight batch may be lost
+    assert [m["seq"] for m in messages][:100] == list(range(1, 101))
+    assert next_seq in (101, 102)
+    log.close()
+
+def test_registered_users_are_persisted(tmp_path):
+    path = str(tmp_path / "chat.db")
+    storage = Storage(message_log=MessageLog(path))
+    storage.user_database.rounds = 4
+    asyncio.run(storage.register("member", "secret"))
+    storage.message_log.close()
+
+    restored = Storage(message_log=MessageLog(path))
+    assert asyncio.run(restored.login("member", "secret"))
+    assert not asyncio.run(restored.login("member", "wrong"))
+    # Users registered by another worker are found in the log
+    other_worker = Storage(message_log=MessageLog(path))
+    other_worker.user_database.users.clear()
+    assert asyncio.run(other_worker.is_registered("member"))
+    restored.message_log.close()
+    other_worker.message_log.close()
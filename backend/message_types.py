@@ -11,13 +11,58 @@ class WsUserStatus(BaseModel):
 class WsConnectionRequest(BaseModel):
     event_type: Literal["connection_request"] = "connection_request"
     username: str
+    # Optional protocol features the client supports, e.g. "batch"
+    features: List[str] = []
+    # What to do when the client can not keep up: "disconnect", "drop_oldest", "drop_ephemeral"
+    # or "coalesce", the server default is used if unset
+    overflow_policy: Literal["disconnect", "drop_oldest", "drop_ephemeral", "coalesce"] | None = None
+    # With the "presence" feature, the presence of the room the client already holds, see WsPresence
+    presence_epoch: str | None = None
+    presence_version: int | None = None
+    # With the "resume" feature, the resume_token of a previous connection and the last event_seq
+    # it received, to get its username back and only the events it missed
+    resume_token: str | None = None
+    last_event_seq: int | None = None
 class WsConnectionResponse(BaseModel):
     event_type: Literal["connection_response"] = "connection_response"
     username: str
     user_id: str
+    # The requested features that the server enabled for this connection
+    features: List[str] = []
+    # With the "resume" feature, the token to present when reconnecting, valid once
+    resume_token: str | None = None
+    # Whether the missed events were replayed, no message history and user list follow then
+    resumed: bool = False
 class WsConnectionReject(BaseModel):
     event_type: Literal["connection_reject"] = "connection_reject"
     response: str
+#### Accounts, optional. A register or login request is sent before the WsConnectionRequest, which
+#### must then have the same username. Registered usernames can only be used after logging in.
+class WsRegisterRequest(BaseModel):
+    event_type: Literal["register_request"] = "register_request"
+    username: str
+    password: str
+class WsRegisterResponse(BaseModel):
+    event_type: Literal["register_response"] = "register_response"
+    response: str
+    # Logs in again without the password, see WsLoginRequest
+    session_token: str
+class WsRegisterReject(BaseModel):
+    event_type: Literal["register_reject"] = "register_reject"
+    response: str
+class WsLoginRequest(BaseModel):
+    event_type: Literal["login_request"] = "login_request"
+    username: str
+    # Either the password or the session_token of an earlier login, which skips checking the password
+    password: str | None = None
+    session_token: str | None = None
+class WsLoginResponse(BaseModel):
+    event_type: Literal["login_response"] = "login_response"
+    response: str
+    session_token: str
+class WsLoginReject(BaseModel):
+    event_type: Literal["login_reject"] = "login_reject"
+    response: str
 class WsSystemMessage(BaseModel):
     event_type: Literal["system"] = "system"
     severity: Literal["success", "info", "warning", "error"]
@@ -26,6 +71,37 @@ class WsSystemMessage(BaseModel):
 class WsMessageHistory(BaseModel):
     event_type: Literal["message_history"] = "message_history"
     messages: List[Dict]
+    # True if the room has older messages that can be fetched with a WsHistoryRequest
+    has_more: bool = False
+#### History paging, each message in the history has a "seq" number that is used as cursor
+class WsHistoryRequest(BaseModel):
+    event_type: Literal["history_request"] = "history_request"
+    before_seq: int
+    limit: int = 50
+class WsHistoryPage(BaseModel):
+    event_type: Literal["history_page"] = "history_page"
+    room_name: str
+    messages: List[Dict]
+    has_more: bool
+#### Full-text search, results come newest first and "id" of the last one is the cursor for the next page
+class WsSearchRequest(BaseModel):
+    event_type: Literal["search_request"] = "search_request"
+    # Words a message must all contain, a word ending in "*" matches as a prefix
+    query: str
+    # Searches the room of the connection unless set
+    all_rooms: bool = False
+    username: str | None = None
+    # ISO timestamps
+    since: str | None = None
+    until: str | None = None
+    before_id: int | None = None
+    limit: int = 20
+class WsSearchResults(BaseModel):
+    event_type: Literal["search_results"] = "search_results"
+    query: str
+    results: List[Dict]
+    # None once there are no more results
+    next_cursor: int | None = None
 class WsMessage(BaseModel):
     event_type: Literal["message"] = "message"
     username: str
@@ -35,6 +111,11 @@ class WsTypingEvent(BaseModel):
     event_type: Literal["typing"] = "typing"
     username: str
     is_typing: bool
+# Sent by the server at a fixed tick instead of forwarding every WsTypingEvent, it holds everyone
+# in the room that is currently typing
+class WsTypingUsers(BaseModel):
+    event_type: Literal["typing_users"] = "typing_users"
+    usernames: List[str]
 class WsUsersOnline(BaseModel):
     event_type: Literal["users_online"] = "users_online"
     users: List[WsUserStatus]
@@ -44,6 +125,23 @@ class WsUserJoinEvent(BaseModel):
 class WsUserLeaveEvent(BaseModel):
     event_type: Literal["user_leave"] = "user_leave"
     username: str
+# Only sent to clients that enabled the "presence" feature, instead of WsUsersOnline, WsUserJoinEvent
+# and WsUserLeaveEvent. The full user list of the room at a version, sent on joining when the client
+# held no version of this epoch or one too old to catch up from.
+class WsPresence(BaseModel):
+    event_type: Literal["presence"] = "presence"
+    epoch: str
+    version: int
+    users: List[WsUserStatus]
+# The joins and leaves between from_version and version, batched over a short window. Applies to a
+# list at any version from from_version on, deltas whose version is at or below it are already in it.
+class WsPresenceDelta(BaseModel):
+    event_type: Literal["presence_delta"] = "presence_delta"
+    epoch: str
+    from_version: int
+    version: int
+    joined: List[WsUserStatus] = []
+    left: List[str] = []
 
 ### Room info and management
 class RoomInfo(BaseModel):
@@ -53,6 +151,17 @@ class RoomInfo(BaseModel):
 class WsAllRooms(BaseModel):
     event_type: Literal["all_rooms"] = "all_rooms"
     rooms: List[RoomInfo]
+    # Version of the room directory this snapshot was taken from
+    version: int = 0
+# Only sent to clients that enabled the "room_updates" feature, the change to one room's user list
+# since the previous version. Updates with a version at or below the one of the WsAllRooms snapshot
+# are already contained in it.
+class WsRoomUsersUpdate(BaseModel):
+    event_type: Literal["room_users"] = "room_users"
+    version: int
+    room_name: str
+    joined: List[str] = []
+    left: List[str] = []
 class WsRoomChatClear(BaseModel):
     event_type: Literal["room_chat_clear"] = "room_chat_clear"
     username: str
@@ -67,6 +176,9 @@ class WsRoomCreateReject(BaseModel):
 class WsRoomSwitchRequest(BaseModel):
     event_type: Literal["room_switch_request"] = "room_switch_request"
     room_name: str
+    # As in WsConnectionRequest, for the room switched to
+    presence_epoch: str | None = None
+    presence_version: int | None = None
 class WsRoomSwitchResponse(BaseModel):
     event_type: Literal["room_switch_response"] = "room_switch_response"
     room_name: str
@@ -82,14 +194,28 @@ WsEvent = Annotated[
         WsConnectionRequest,
         WsConnectionResponse,
         WsConnectionReject,
+        WsRegisterRequest,
+        WsRegisterResponse,
+        WsRegisterReject,
+        WsLoginRequest,
+        WsLoginResponse,
+        WsLoginReject,
         WsMessage,
         WsMessageHistory,
+        WsHistoryRequest,
+        WsHistoryPage,
+        WsSearchRequest,
+        WsSearchResults,
         WsTypingEvent,
+        WsTypingUsers,
         WsSystemMessage,
         WsUsersOnline,
         WsUserJoinEvent,
         WsUserLeaveEvent,
+        WsPresence,
+        WsPresenceDelta,
         WsAllRooms,
+        WsRoomUsersUpdate,
         WsRoomCreate,
         WsRoomCreateReject,
         WsRoomChatClear,
@@ -100,38 +226,53 @@ WsEvent = Annotated[
     Field(discriminator="event_type"),
 ]
 
+# Only sent to clients that enabled the "batch" feature, several events in one frame. It is never
+# part of another batch.
+class WsBatch(BaseModel):
+    event_type: Literal["batch"] = "batch"
+    events: List[WsEvent]
+
 # Pydantic models for request/response with the HTTP API
 class ChatMessage(BaseModel):
     username: str
     message: str
 
+# One message of a bulk send, without room_name it goes to the room of the endpoint
+class BulkChatMessage(BaseModel):
+    username: str
+    message: str
+    room_name: str | None = None
+
+# Outcome of one bulk send item, index is its position in the request
+class BulkItemStatus(BaseModel):
+    index: int
+    status: Literal["success", "error"]
+    detail: str | None = None
+
+class BulkSendResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BulkItemStatus]
+
 class UserConnection(BaseModel):
     username: str
 
 class UserConnectionResponse(BaseModel):
     response: str
 
+class RoomList(BaseModel):
+    rooms: List[RoomInfo]
+    version: int
+
+class SearchResults(BaseModel):
+    results: List[Dict]
+    next_cursor: int | None
+
 class ChatData(BaseModel):
     messages: List[Dict]
     connected_users: List[Dict]
 
 # Unimplemented for now, will be added in case more work is needed!
-## Register
-class WsRegisterRequest(BaseModel):
-    username: str
-    password: str
-class WsRegisterResponse(BaseModel):
-    response: str
-class WsRegisterReject(BaseModel):
-    response: str
-# Login
-class WsLoginRequest(BaseModel):
-    username: str
-    password: str
-class WsLoginResponse(BaseModel):
-    response: str
-class WsLoginReject(BaseModel):
-    response: str
 ## Groups
 class WsCreateGroupRequest(BaseModel):
     group_name: str
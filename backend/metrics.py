@@ -0,0 +1,160 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Default latency buckets in seconds, from 50 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+class Metric:
+    """Base class for metrics with optional labels.
+
+    Each combination of label values gets its own child, which is cached, so recording is a dict
+    lookup plus an addition under an uncontended lock. The lock is needed because room shards
+    record from their own threads."""
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        return type(self)(self.name, self.help)
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        """Yields (suffix, labels, value) for the exposition format"""
+        if not self.label_names:
+            yield from self.own_samples()
+            return
+        for values, child in list(self.children.items()):
+            labels = dict(zip(self.label_names, values))
+            for (suffix, extra_labels, value) in child.own_samples():
+                yield (suffix, {**labels, **extra_labels}, value)
+
+    def own_samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+    def own_samples(self):
+        yield ("", {}, self.value)
+
+class Gauge(Metric):
+    """A gauge that is either set directly or computed when the metrics are scraped"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), collect: Callable[[], Dict[Tuple[str, ...], float]] | None = None):
+        super().__init__(name, help, labels)
+        self.value = 0.0
+        # Returns {label values: value}, so nothing has to be recorded on the hot path
+        self.collect = collect
+
+    def set(self, value: float):
+        self.value = value
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+    def dec(self, amount: float = 1.0):
+        with self.lock:
+            self.value -= amount
+
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        for values, value in self.collect().items():
+            yield ("", dict(zip(self.label_names, values)), value)
+    def own_samples(self):
+        yield ("", {}, self.value)
+
+class Histogram(Metric):
+    """Fixed-bucket histogram, observe() is a binary search and two additions"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # The last count is the +Inf bucket
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def new_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def own_samples(self):
+        with self.lock:
+            (counts, total) = (list(self.counts), self.sum)
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, counts):
+            cumulative += count
+            yield ("_bucket", {"le": format_value(bound)}, cumulative)
+        cumulative += counts[-1]
+        yield ("_bucket", {"le": "+Inf"}, cumulative)
+        yield ("_sum", {}, total)
+        yield ("_count", {}, cumulative)
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format"""
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for (suffix, labels, value) in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{escape_label(str(value))}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+REGISTRY = Registry()
+
+def counter(name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+def gauge(name: str, help: str, labels: Tuple[str, ...] = (), collect: Callable[[], Dict[Tuple[str, ...], float]] | None = None) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labels, collect))
+def histogram(name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
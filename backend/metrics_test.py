@@ -0,0 +1,23 @@
+from metrics import Counter, Histogram, Registry
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.register(Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0)))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        latency.observe(value)
+    rendered = registry.render()
+    assert 'test_latency_seconds_bucket{le="0.1"} 2' in rendered
+    assert 'test_latency_seconds_bucket{le="1"} 3' in rendered
+    assert 'test_latency_seconds_bucket{le="+Inf"} 4' in rendered
+    assert "test_latency_seconds_count 4" in rendered
+
+def test_labeled_counter():
+    registry = Registry()
+    events = registry.register(Counter("test_events_total", "Events", ("event_type",)))
+    events.labels("message").inc()
+    events.labels("message").inc()
+    events.labels("typing").inc()
+    rendered = registry.render()
+    assert "# TYPE test_events_total counter" in rendered
+    assert 'test_events_total{event_type="message"} 2' in rendered
+    assert 'test_events_total{event_type="typing"} 1' in rendered
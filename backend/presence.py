@@ -0,0 +1,89 @@
+import secrets
+from collections import deque
+from typing import Dict, List, Tuple
+
+from message_types import *
+
+# Changes kept per room for delta sync, a client further behind gets a full snapshot
+PRESENCE_LOG_MAX = 1024
+
+class RoomPresence:
+    """Who is in one room, with a version that is bumped on every join and leave.
+
+    The newest changes are kept, so a client that holds an older version of the room only gets the
+    difference. The epoch tells apart versions of different presence sets of the same room, e.g.
+    after a restart, a version of another epoch is never diffed against.
+
+    Joins and leaves only mark the state as changed, take_delta() then collects everything since
+    the previous delta into one WsPresenceDelta, so a burst of joins is one frame per connection
+    instead of one per join. Only used from the room's shard."""
+    __slots__ = ("epoch", "version", "users", "changes", "flushed_version")
+
+    def __init__(self, log_max: int = PRESENCE_LOG_MAX):
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        # username -> connected_at, in the order they joined
+        self.users: Dict[str, str] = {}
+        # (version, username, connected_at or None for a leave), oldest first
+        self.changes: deque = deque(maxlen=log_max)
+        # Version of the last delta taken
+        self.flushed_version = 0
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def join(self, username: str, connected_at: str) -> bool:
+        """Returns whether the user was not in the room yet"""
+        if username in self.users:
+            return False
+        self.users[username] = connected_at
+        self.record(username, connected_at)
+        return True
+
+    def leave(self, username: str) -> bool:
+        if self.users.pop(username, None) is None:
+            return False
+        self.record(username, None)
+        return True
+
+    def record(self, username: str, connected_at: str | None):
+        self.version += 1
+        self.changes.append((self.version, username, connected_at))
+
+    def is_changed(self) -> bool:
+        return self.version != self.flushed_version
+
+    def diff(self, since: int) -> Tuple[List[WsUserStatus], List[str]] | None:
+        """The users that joined and left after version `since`, or None if the changes since
+        then are no longer kept"""
+        if since > self.version or since < self.version - len(self.changes):
+            return None
+        # username -> (whether it was in the room at `since`, connected_at now or None)
+        changed: Dict[str, Tuple[bool, str | None]] = {}
+        for index in range(len(self.changes) - (self.version - since), len(self.changes)):
+            (_, username, connected_at) = self.changes[index]
+            was_in = changed[username][0] if username in changed else connected_at is None
+            changed[username] = (was_in, connected_at)
+        joined = [WsUserStatus(username=username, connected_at=connected_at) for username, (_, connected_at) in changed.items() if connected_at is not None]
+        # Users that joined and left in between were never seen by the client
+        left = [username for username, (was_in, connected_at) in changed.items() if connected_at is None and was_in]
+        return (joined, left)
+
+    def take_delta(self) -> WsPresence | WsPresenceDelta | None:
+        """The changes since the last delta taken, None if there were none. A full snapshot if
+        more changed than is kept."""
+        if not self.is_changed():
+            return None
+        event = self.sync(self.epoch, self.flushed_version)
+        self.flushed_version = self.version
+        return event
+
+    def sync(self, epoch: str | None, since: int | None) -> WsPresence | WsPresenceDelta:
+        """What a client holding version `since` of `epoch` needs to catch up"""
+        diff = self.diff(since) if epoch == self.epoch and since is not None else None
+        if diff is None:
+            return WsPresence(epoch=self.epoch, version=self.version, users=self.snapshot_users())
+        return WsPresenceDelta(epoch=self.epoch, from_version=since, version=self.version, joined=diff[0], left=diff[1])
+
+    def snapshot_users(self) -> List[WsUserStatus]:
+        return [WsUserStatus(username=username, connected_at=connected_at) for username, connected_at in self.users.items()]
@@ -0,0 +1,45 @@
+from presence import RoomPresence
+from message_types import WsPresence, WsPresenceDelta
+
+def test_diff_since_a_version():
+    presence = RoomPresence()
+    presence.join("alice", "t1")
+    presence.join("bob", "t2")
+    version = presence.version
+    presence.join("carol", "t3")
+    presence.leave("bob")
+    presence.leave("carol")
+    presence.join("dave", "t4")
+    assert not presence.join("dave", "t5")
+    (joined, left) = presence.diff(version)
+    assert [user.username for user in joined] == ["dave"]
+    assert left == ["bob"]
+    assert presence.diff(presence.version) == ([], [])
+    assert presence.diff(presence.version + 1) is None
+
+def test_sync_falls_back_to_a_snapshot():
+    presence = RoomPresence(log_max=2)
+    for name in ["a", "b", "c"]:
+        presence.join(name, "t")
+    assert isinstance(presence.sync(presence.epoch, presence.version - 2), WsPresenceDelta)
+    # Older than the kept changes, another epoch, or no version at all
+    for (epoch, since) in [(presence.epoch, 0), ("other", presence.version), (None, None)]:
+        snapshot = presence.sync(epoch, since)
+        assert isinstance(snapshot, WsPresence)
+        assert [user.username for user in snapshot.users] == ["a", "b", "c"]
+
+def test_deltas_batch_changes():
+    presence = RoomPresence()
+    assert presence.take_delta() is None
+    for i in range(10):
+        presence.join(f"user{i}", "t")
+    presence.leave("user3")
+    delta = presence.take_delta()
+    assert (delta.from_version, delta.version) == (0, 11)
+    # user3 joined and left in between
+    assert [user.username for user in delta.joined] == [f"user{i}" for i in range(10) if i != 3]
+    assert delta.left == []
+    presence.leave("user4")
+    delta = presence.take_delta()
+    assert (delta.from_version, delta.left) == (11, ["user4"])
+    assert presence.take_delta() is None
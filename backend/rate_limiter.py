@@ -0,0 +1,100 @@
+import os
+import time
+from typing import Dict, List, Tuple
+
+# Pseudo event_type of the bucket charged for every received frame
+RATE_LIMIT_FRAME = "frame"
+# Tokens per second and bucket size for each event_type, other event types use
+# DEFAULT_RATE_LIMIT. A client can send a burst of up to the bucket size and then one event per
+# 1 / rate seconds.
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    # Every received frame, charged before it is decoded. Above the sum of what a well-behaved
+    # client sends, so only a flood runs into it.
+    RATE_LIMIT_FRAME: (40.0, 100.0),
+    "message": (5.0, 20.0),
+    # Per item of a bulk send, bots and bridges post for many users at once
+    "bulk_message": (50.0, 500.0),
+    "typing": (10.0, 30.0),
+    "history_request": (5.0, 20.0),
+    "search_request": (2.0, 10.0),
+    "room_create": (0.5, 5.0),
+    "room_switch_request": (2.0, 10.0),
+    "room_chat_clear": (0.5, 5.0),
+    # Only charged to the address, so nobody can lock others out of their accounts
+    "login_request": (1.0, 10.0),
+    "register_request": (0.2, 5.0),
+}
+DEFAULT_RATE_LIMIT = (10.0, 40.0)
+# Who a bucket belongs to
+SCOPE_CONNECTION = "connection"
+SCOPE_USER = "user"
+SCOPE_ADDRESS = "address"
+# Several users can share one address, so its buckets are this many times larger
+ADDRESS_RATE_LIMIT_FACTOR = 4
+# Buckets kept before idle ones are swept, a full bucket is the same as no bucket
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, now: float, rate: float, size: float):
+        self.tokens = min(size, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+class RateLimiter:
+    """Token buckets per connection, username and client address, with a separate budget per
+    event_type.
+
+    An event is let through only if every bucket it is charged to has a token left, so one
+    client can not get around the limit by opening more connections or by switching names.
+    Buckets are created on first use and dropped once they have refilled, checking one is O(1).
+    Only used from the server's loop, where events are received."""
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        self.sweep_at = RATE_LIMIT_MAX_BUCKETS
+
+    def acquire(self, event_type: str, keys: List[Tuple[str, str]], now: float | None = None) -> float:
+        """Takes a token from the bucket of every (scope, key) for the event_type. Returns 0 if
+        the event may be handled, otherwise the seconds until it would be allowed."""
+        if not self.enabled:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        (rate, size) = RATE_LIMITS.get(event_type, DEFAULT_RATE_LIMIT)
+        buckets = []
+        retry_after = 0.0
+        for (scope, key) in keys:
+            factor = ADDRESS_RATE_LIMIT_FACTOR if scope == SCOPE_ADDRESS else 1
+            bucket = self.buckets.get((scope, key, event_type))
+            if bucket is None:
+                bucket = self.buckets[(scope, key, event_type)] = TokenBucket(size * factor, now)
+            else:
+                bucket.refill(now, rate * factor, size * factor)
+            if bucket.tokens < 1:
+                retry_after = max(retry_after, (1 - bucket.tokens) / (rate * factor))
+            buckets.append(bucket)
+        if retry_after:
+            return retry_after
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if len(self.buckets) > self.sweep_at:
+            self.sweep(now)
+        return 0.0
+
+    def sweep(self, now: float):
+        for (key, bucket) in list(self.buckets.items()):
+            (rate, size) = RATE_LIMITS.get(key[2], DEFAULT_RATE_LIMIT)
+            factor = ADDRESS_RATE_LIMIT_FACTOR if key[0] == SCOPE_ADDRESS else 1
+            if bucket.tokens + (now - bucket.updated) * rate * factor >= size * factor:
+                del self.buckets[key]
+        # Sweeping again right away would not free much, wait until there are twice as many
+        self.sweep_at = max(RATE_LIMIT_MAX_BUCKETS, 2 * len(self.buckets))
+
+def rate_limiter_from_env() -> RateLimiter:
+    """CHAT_RATE_LIMIT=0 turns rate limiting off"""
+    return RateLimiter(os.environ.get("CHAT_RATE_LIMIT", "1") != "0")
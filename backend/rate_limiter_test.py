@@ -0,0 +1,34 @@
+from rate_limiter import *
+
+def test_bucket_refills_over_time():
+    limiter = RateLimiter()
+    (rate, size) = RATE_LIMITS["message"]
+    keys = [(SCOPE_CONNECTION, "c1")]
+    assert all(limiter.acquire("message", keys, now=0.0) == 0 for _ in range(int(size)))
+    assert limiter.acquire("message", keys, now=0.0) == 1 / rate
+    assert limiter.acquire("message", keys, now=1 / rate) == 0
+    # Other event types have their own budget
+    assert limiter.acquire("typing", keys, now=1 / rate) == 0
+
+def test_every_bucket_must_have_a_token():
+    limiter = RateLimiter()
+    size = int(RATE_LIMITS["message"][1])
+    for i in range(size):
+        assert limiter.acquire("message", [(SCOPE_CONNECTION, f"c{i}"), (SCOPE_USER, "alice")], now=0.0) == 0
+    # A new connection does not help once the user is out of tokens, and nothing is taken from it
+    assert limiter.acquire("message", [(SCOPE_CONNECTION, "new"), (SCOPE_USER, "alice")], now=0.0) > 0
+    assert limiter.buckets[(SCOPE_CONNECTION, "new", "message")].tokens == size
+    # Addresses get a larger budget
+    keys = [(SCOPE_ADDRESS, "10.0.0.1")]
+    assert all(limiter.acquire("message", keys, now=0.0) == 0 for _ in range(size * ADDRESS_RATE_LIMIT_FACTOR))
+    assert limiter.acquire("message", keys, now=0.0) > 0
+
+def test_disabled_and_sweep():
+    assert RateLimiter(enabled=False).acquire("message", [(SCOPE_USER, "bob")]) == 0
+    limiter = RateLimiter()
+    limiter.sweep_at = 2
+    limiter.acquire("message", [(SCOPE_USER, "a")], now=0.0)
+    limiter.acquire("message", [(SCOPE_USER, "b")], now=0.0)
+    # "a" and "b" have refilled by the time "c" shows up
+    limiter.acquire("message", [(SCOPE_USER, "c")], now=100.0)
+    assert list(limiter.buckets) == [(SCOPE_USER, "c", "message")]
@@ -0,0 +1,99 @@
+import threading
+from typing import Dict, List
+
+from message_types import *
+from event_codecs import *
+
+class DirectoryEntry:
+    __slots__ = ("creator", "users", "info")
+
+    def __init__(self, creator: str):
+        self.creator = creator
+        # Used as an ordered set, users are listed in the order they joined
+        self.users: Dict[str, None] = {}
+        # Cached RoomInfo, rebuilt only after this room changed
+        self.info: RoomInfo | None = None
+
+class RoomDirectory:
+    """Every room with its creator and connected users, updated incrementally from join, leave and
+    room creation events instead of being gathered from all managers on every request.
+
+    Each change bumps the version. The WsAllRooms snapshot (and its encodings) and the HTTP body
+    are built at most once per version and shared by every reader. Updates come from the room
+    shards, so every public method takes the lock."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.rooms: Dict[str, DirectoryEntry] = {}
+        self.version = 0
+        self.snapshot: EncodedEvent | None = None
+        self.http_body: bytes | None = None
+
+    def changed(self, entry: DirectoryEntry | None = None):
+        self.version += 1
+        self.snapshot = None
+        self.http_body = None
+        if entry is not None:
+            entry.info = None
+
+    def __contains__(self, room_name: str) -> bool:
+        return room_name in self.rooms
+
+    def get_creator(self, room_name: str) -> str | None:
+        with self.lock:
+            entry = self.rooms.get(room_name)
+            return entry.creator if entry else None
+
+    def add_room(self, room_name: str, creator: str):
+        with self.lock:
+            if room_name not in self.rooms:
+                self.rooms[room_name] = DirectoryEntry(creator)
+                self.changed()
+
+    def set_creator(self, room_name: str, creator: str):
+        with self.lock:
+            entry = self.rooms.get(room_name)
+            if entry is None:
+                self.add_room(room_name, creator)
+            elif entry.creator != creator:
+                entry.creator = creator
+                self.changed(entry)
+
+    def join(self, room_name: str, username: str) -> WsRoomUsersUpdate | None:
+        """Adds the user to the room, returns the update to push or None if nothing changed"""
+        with self.lock:
+            entry = self.rooms.get(room_name)
+            if entry is None or username in entry.users:
+                return None
+            entry.users[username] = None
+            self.changed(entry)
+            return WsRoomUsersUpdate(version=self.version, room_name=room_name, joined=[username])
+
+    def leave(self, room_name: str, username: str) -> WsRoomUsersUpdate | None:
+        with self.lock:
+            entry = self.rooms.get(room_name)
+            if entry is None or username not in entry.users:
+                return None
+            del entry.users[username]
+            self.changed(entry)
+            return WsRoomUsersUpdate(version=self.version, room_name=room_name, left=[username])
+
+    def room_infos(self) -> List[RoomInfo]:
+        with self.lock:
+            infos = []
+            for room_name, entry in self.rooms.items():
+                if entry.info is None:
+                    entry.info = RoomInfo(room_name=room_name, room_creator=entry.creator, connected_users=list(entry.users))
+                infos.append(entry.info)
+            return infos
+
+    def get_snapshot(self) -> EncodedEvent:
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = EncodedEvent(WsAllRooms(rooms=self.room_infos(), version=self.version))
+            return self.snapshot
+
+    def get_http_body(self) -> bytes:
+        with self.lock:
+            if self.http_body is None:
+                self.http_body = RoomList(rooms=self.room_infos(), version=self.version).model_dump_json().encode()
+            return self.http_body
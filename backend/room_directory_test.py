@@ -0,0 +1,29 @@
+from room_directory import *
+
+def test_snapshot_is_cached_per_version():
+    directory = RoomDirectory()
+    directory.add_room("a", "alice")
+    snapshot = directory.get_snapshot()
+    assert directory.get_snapshot() is snapshot
+    assert directory.join("a", "bob").joined == ["bob"]
+    assert directory.get_snapshot() is not snapshot
+    assert directory.get_snapshot().event.rooms[0].connected_users == ["bob"]
+    assert directory.get_snapshot().event.version == directory.version
+
+def test_only_changed_rooms_are_rebuilt():
+    directory = RoomDirectory()
+    directory.add_room("a", "alice")
+    directory.add_room("b", "bob")
+    (a, b) = directory.room_infos()
+    directory.join("b", "carol")
+    assert directory.room_infos()[0] is a
+    assert directory.room_infos()[1] is not b
+
+def test_no_update_without_change():
+    directory = RoomDirectory()
+    directory.add_room("a", "alice")
+    assert directory.leave("a", "bob") is None
+    assert directory.join("missing", "bob") is None
+    update = directory.join("a", "bob")
+    assert directory.join("a", "bob") is None
+    assert directory.leave("a", "bob").version == update.version + 1
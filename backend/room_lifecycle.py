@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+import tempfile
+import threading
+import zlib
+from typing import Dict, List, Tuple
+
+from chat_logging import get_logger
+
+# Rooms without connections or activity for this long are evicted from memory, 0 keeps them all
+ROOM_IDLE_TTL_SECONDS = 60 * 60
+# How often rooms are checked for idleness
+ROOM_SWEEP_INTERVAL_SECONDS = 60.0
+SPILL_COMPRESSION_LEVEL = 6
+
+log = get_logger("room")
+
+class RoomSpill:
+    """Histories of evicted rooms, kept compressed on disk until the room is used again.
+
+    A spilled history is held in memory until write_pending() has written it, which blocks on disk
+    and is meant to run off the event loop. take() hands a history back and forgets it, from memory
+    if it was not written yet and from disk otherwise. Reading it from disk is done by load(), off
+    the event loop, the loaded history is then passed to take(). The entries are (seq, username,
+    message, timestamp) tuples, stored as one zlib compressed JSON array per room. The lock is only
+    held for the bookkeeping, never while reading or writing a file."""
+    def __init__(self, directory: str | None = None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # Every spilled room, written or not, with the generation of its spill. A room that is
+        # spilled again gets a new one, so a history loaded before is not mistaken for it.
+        self.rooms: Dict[str, int] = {}
+        self.generations = itertools.count()
+        # Spilled but not written yet, room_name -> (next_seq, entries)
+        self.pending: Dict[str, Tuple[int, List[Tuple]]] = {}
+
+    def __contains__(self, room_name: str) -> bool:
+        return room_name in self.rooms
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    def add(self, room_name: str, next_seq: int, entries: List[Tuple]):
+        with self.lock:
+            self.rooms[room_name] = next(self.generations)
+            self.pending[room_name] = (next_seq, [entry[:4] for entry in entries])
+
+    def load(self, room_name: str) -> Tuple[int, Tuple] | None:
+        """The (generation, spilled history) of a room for take(), without forgetting it. None if
+        it was not spilled. Blocks on disk if the history was written."""
+        with self.lock:
+            generation = self.rooms.get(room_name)
+            spilled = self.pending.get(room_name)
+        if generation is None or spilled is not None:
+            return None if generation is None else (generation, spilled)
+        try:
+            return (generation, self.read(room_name))
+        except FileNotFoundError:
+            # Taken in the meantime
+            return None
+
+    def take(self, room_name: str, loaded: Tuple[int, Tuple] | None = None) -> Tuple[int, List[Dict]] | None:
+        """Returns (next_seq, messages) of a spilled room, or None if it was not spilled. Without
+        a history from load() of the same spill a written one is read here, which blocks on disk."""
+        with self.lock:
+            generation = self.rooms.pop(room_name, None)
+            if generation is None:
+                return None
+            spilled = self.pending.pop(room_name, None)
+        if spilled is None:
+            spilled = loaded[1] if loaded and loaded[0] == generation else self.read(room_name)
+            os.remove(self.path(room_name))
+        (next_seq, entries) = spilled
+        return (next_seq, [
+            {"seq": seq, "username": username, "message": message, "timestamp": timestamp}
+            for (seq, username, message, timestamp) in entries
+        ])
+
+    def write_pending(self) -> int:
+        """Writes the histories spilled since the last call, returns how many. Blocks on disk."""
+        with self.lock:
+            pending = list(self.pending.items())
+        for (room_name, spilled) in pending:
+            path = self.path(room_name)
+            with open(path + ".tmp", "wb") as file:
+                file.write(zlib.compress(json.dumps(spilled, separators=(",", ":")).encode(), SPILL_COMPRESSION_LEVEL))
+            with self.lock:
+                # Taken back or spilled again in the meantime
+                if self.pending.get(room_name) is not spilled:
+                    os.remove(path + ".tmp")
+                    continue
+                # Only a rename under the lock, a reader sees the whole file or none
+                os.replace(path + ".tmp", path)
+                del self.pending[room_name]
+        return len(pending)
+
+    def read(self, room_name: str) -> Tuple:
+        with open(self.path(room_name), "rb") as file:
+            return json.loads(zlib.decompress(file.read()))
+
+    def path(self, room_name: str) -> str:
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="chat-rooms-")
+            log.info("Spilling evicted rooms to %s", self.directory)
+        # Hex keeps any room name a valid file name
+        return os.path.join(self.directory, room_name.encode().hex() + ".json.z")
+
+def room_idle_ttl_from_env() -> float:
+    """CHAT_ROOM_IDLE_TTL sets the seconds before an idle room is evicted, 0 turns eviction off"""
+    return float(os.environ.get("CHAT_ROOM_IDLE_TTL", ROOM_IDLE_TTL_SECONDS))
+
+def room_spill_from_env() -> RoomSpill:
+    """CHAT_ROOM_SPILL_DIR is where evicted histories are written, a temporary directory if unset"""
+    directory = os.environ.get("CHAT_ROOM_SPILL_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return RoomSpill(directory)
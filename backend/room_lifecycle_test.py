@@ -0,0 +1,87 @@
+import asyncio
+import os
+from room_lifecycle import RoomSpill
+from websocket_handlers import GLOBAL_ROOM_NAME, Storage
+
+def chat(text: str):
+    return {"username": "user", "message": text, "timestamp": "2025-09-26T10:30:00.123456"}
+
+def test_spill_round_trip(tmp_path):
+    spill = RoomSpill(str(tmp_path))
+    spill.add("some room/ü", 4, [(1, "a", "one", "t1", "{}"), (3, "b", "three", "t3", "{}")])
+    assert "some room/ü" in spill
+    assert spill.write_pending() == 1
+    assert len(os.listdir(tmp_path)) == 1
+    (next_seq, messages) = spill.take("some room/ü")
+    assert next_seq == 4
+    assert [(m["seq"], m["message"]) for m in messages] == [(1, "one"), (3, "three")]
+    assert "some room/ü" not in spill
+    assert os.listdir(tmp_path) == []
+    assert spill.take("some room/ü") is None
+
+def test_spill_taken_before_it_was_written(tmp_path):
+    spill = RoomSpill(str(tmp_path))
+    spill.add("room", 1, [])
+    assert spill.take("room") == (1, [])
+    assert spill.write_pending() == 0
+    assert os.listdir(tmp_path) == []
+
+def test_spill_loaded_off_the_lock(tmp_path):
+    spill = RoomSpill(str(tmp_path))
+    spill.add("room", 3, [(1, "a", "one", "t1", "{}"), (2, "b", "two", "t2", "{}")])
+    spill.write_pending()
+    assert os.listdir(tmp_path) == [spill.path("room").rsplit(os.sep, 1)[1]]
+    loaded = spill.load("room")
+    # Still spilled until it is taken
+    assert "room" in spill
+    os.remove(spill.path("room"))
+    open(spill.path("room"), "wb").close()
+    # The loaded history is used, the file is not read again
+    assert spill.take("room", loaded) == (3, [
+        {"seq": 1, "username": "a", "message": "one", "timestamp": "t1"},
+        {"seq": 2, "username": "b", "message": "two", "timestamp": "t2"}])
+    assert os.listdir(tmp_path) == []
+    assert spill.load("room") is None
+
+def test_spill_loaded_before_it_was_spilled_again(tmp_path):
+    spill = RoomSpill(str(tmp_path))
+    spill.add("room", 2, [(1, "a", "old", "t1", "{}")])
+    spill.write_pending()
+    stale = spill.load("room")
+    spill.take("room")
+    spill.add("room", 3, [(1, "a", "old", "t1", "{}"), (2, "a", "new", "t2", "{}")])
+    spill.write_pending()
+    assert spill.take("room", stale)[0] == 3
+
+def test_idle_rooms_are_evicted_and_restored(tmp_path):
+    storage = Storage(spill=RoomSpill(str(tmp_path)), room_idle_ttl=60)
+    storage.get_manager(GLOBAL_ROOM_NAME)
+    (manager, _) = storage.get_manager("quiet_room")
+    storage.set_room_creator(manager, "creator")
+    for i in range(3):
+        storage.add_to_chat("quiet_room", chat(str(i)))
+    (busy, _) = storage.get_manager("busy_room")
+    busy.pending_joins += 1
+    # A history read for a name that is not a room is dropped
+    storage.get_history("no_room")
+
+    now = storage.room_activity["quiet_room"]
+    assert storage.evict_idle_rooms(now + 30) == []
+    assert sorted(storage.evict_idle_rooms(now + 61)) == ["no_room", "quiet_room"]
+    assert "quiet_room" not in storage.managers and "quiet_room" not in storage.chat_messages
+    assert "no_room" not in storage.spill
+    storage.spill.write_pending()
+    # Still listed, with its creator
+    assert "quiet_room" in [room.room_name for room in storage.directory.room_infos()]
+    assert storage.room_exists("quiet_room") and not storage.room_exists("no_room")
+
+    # Read off the loop before the room is used
+    asyncio.run(storage.restore_room("quiet_room"))
+    assert "quiet_room" not in storage.spill and "quiet_room" in storage.chat_messages
+    # Queried without joining, only the history comes back
+    assert [m["message"] for m in storage.get_chat_messages("quiet_room")] == ["0", "1", "2"]
+    (restored, room_is_new) = storage.get_manager("quiet_room")
+    assert not room_is_new
+    assert restored.creator == "creator"
+    assert storage.add_to_chat("quiet_room", chat("3"))["seq"] == 4
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import threading
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+from chat_logging import get_logger
+
+log = get_logger("shards")
+
+class ShardPool:
+    """Runs the work of each room on one of a pool of event loops, each on its own thread.
+
+    Rooms are assigned to a shard by a stable hash of their name, so all events of a room are
+    handled in order by the same loop. A busy room then only delays the rooms sharing its shard,
+    and on free-threaded builds the shards fan out in parallel. Sockets stay on the server's loop,
+    shards hand frames over through the thread-safe delivery queues.
+
+    With a size of 0 sharding is disabled and room work runs inline on the calling loop, which is
+    also what happens once the pool has been stopped."""
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.loops: List[asyncio.AbstractEventLoop] = []
+        self.threads: List[threading.Thread] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        if not self.enabled or self.loops:
+            return
+        for index in range(self.size):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name=f"room-shard-{index}", daemon=True)
+            thread.start()
+            self.loops.append(loop)
+            self.threads.append(thread)
+        log.info("Started %d room shards", self.size)
+
+    async def stop(self):
+        """Lets the work already handed to the shards finish, then stops them. Work submitted
+        after this point (e.g. connections still cleaning up) runs inline."""
+        (loops, threads) = (self.loops, self.threads)
+        self.loops = []
+        self.threads = []
+        for loop in loops:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(drain(), loop))
+            loop.call_soon_threadsafe(loop.stop)
+        for thread in threads:
+            thread.join()
+        for loop in loops:
+            loop.close()
+
+    def shard_for(self, room_name: str) -> int:
+        # crc32 instead of hash(), which is salted per process
+        return zlib.crc32(room_name.encode()) % self.size
+
+    async def run(self, room_name: str, coro: Awaitable) -> Any:
+        """Runs the coroutine on the shard of the room and waits for its result"""
+        if not self.loops:
+            return await coro
+        loop = self.loops[self.shard_for(room_name)]
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    async def run_grouped(self, items: Iterable[Any], room_name: Callable[[Any], str], func: Callable[[List[Any]], Awaitable]):
+        """Calls func once per shard with the items whose room lives on it, the shards run
+        concurrently"""
+        if not self.loops:
+            await func(list(items))
+            return
+        groups: Dict[int, List[Any]] = {}
+        for item in items:
+            groups.setdefault(self.shard_for(room_name(item)), []).append(item)
+        futures = [asyncio.run_coroutine_threadsafe(func(group), self.loops[shard]) for shard, group in groups.items()]
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+
+async def drain():
+    """Waits for every other task of the running loop"""
+    current = asyncio.current_task()
+    while tasks := [task for task in asyncio.all_tasks() if task is not current]:
+        await asyncio.wait(tasks)
+
+def shard_pool_from_env() -> ShardPool:
+    """CHAT_ROOM_SHARDS sets the number of room shards, 0 (the default) keeps every room on the
+    server's event loop"""
+    return ShardPool(int(os.environ.get("CHAT_ROOM_SHARDS", "0")))
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+from room_shards import *
+
+def test_disabled_pool_runs_inline():
+    pool = ShardPool(0)
+    pool.start()
+    async def thread_name():
+        return threading.current_thread().name
+    assert asyncio.run(pool.run("room", thread_name())) == threading.current_thread().name
+
+def test_rooms_run_on_their_shard():
+    pool = ShardPool(3)
+    async def main():
+        pool.start()
+        async def thread_name():
+            return threading.current_thread().name
+        names = [await pool.run(f"room{i}", thread_name()) for i in range(20)]
+        for i, name in enumerate(names):
+            assert name == f"room-shard-{pool.shard_for(f'room{i}')}"
+        assert len(set(names)) > 1
+        await pool.stop()
+    asyncio.run(main())
+
+def test_run_grouped_calls_once_per_shard():
+    pool = ShardPool(2)
+    groups = []
+    async def main():
+        pool.start()
+        async def record(rooms):
+            groups.append((threading.current_thread().name, rooms))
+        await pool.run_grouped([f"room{i}" for i in range(10)], lambda room: room, record)
+        await pool.stop()
+    asyncio.run(main())
+    assert sorted(room for (_, rooms) in groups for room in rooms) == sorted(f"room{i}" for i in range(10))
+    for (name, rooms) in groups:
+        assert {f"room-shard-{pool.shard_for(room)}" for room in rooms} == {name}
+
+def test_stop_finishes_pending_work_then_runs_inline():
+    pool = ShardPool(2)
+    finished = []
+    async def slow():
+        await asyncio.sleep(0.05)
+        finished.append(threading.current_thread().name)
+    async def main():
+        pool.start()
+        pending = asyncio.ensure_future(pool.run("room", slow()))
+        await asyncio.sleep(0.01)
+        await pool.stop()
+        await pending
+        await pool.run("room", slow())
+    asyncio.run(main())
+    assert finished == [f"room-shard-{pool.shard_for('room')}", threading.current_thread().name]
@@ -0,0 +1,266 @@
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Tuple
+
+# Messages kept searchable across all rooms, the oldest are dropped from the index first
+SEARCH_MAX_MESSAGES = int(os.environ.get("CHAT_SEARCH_MAX_MESSAGES", "1000000"))
+SEARCH_PAGE_MAX_SIZE = 100
+# Longer words are indexed by their first characters only
+SEARCH_MAX_TERM_LENGTH = 32
+# A prefix matching more terms than this only matches the first ones, e.g. "a*"
+SEARCH_MAX_PREFIX_TERMS = 64
+# Candidates looked at for one page, so selective filters can not make a query scan the index
+SEARCH_MAX_SCANNED = 20000
+# Terms first seen since the sorted vocabulary was last rebuilt
+SEARCH_NEW_TERMS_MAX = 1024
+
+WORD = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    return [word[:SEARCH_MAX_TERM_LENGTH] for word in WORD.findall(text.lower())]
+
+class RoomIndex:
+    """Inverted index of one room, from terms to the ascending ids of the messages containing them.
+
+    Messages of a room age out oldest first. Their ids are not removed from the postings right
+    away, lookups skip everything below the oldest id still kept and the postings are compacted
+    once most of the room's ids are dropped ones. Postings are plain arrays, so millions of them
+    do not add to the garbage collector's work."""
+    __slots__ = ("postings", "ids", "start")
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        # Ids of the room's messages, the ones before start are dropped
+        self.ids = array("q")
+        self.start = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.ids) - self.start
+
+    def add(self, message_id: int, terms: List[str]) -> List[str]:
+        """Returns the terms that are new to the room"""
+        new_terms = []
+        for term in dict.fromkeys(terms):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array("q")
+                new_terms.append(term)
+            postings.append(message_id)
+        self.ids.append(message_id)
+        return new_terms
+
+    def drop_oldest(self) -> List[str]:
+        """Returns the terms that are gone from the room"""
+        self.start += 1
+        if self.start * 2 <= len(self.ids):
+            return []
+        oldest = self.ids[self.start] if self.size else self.ids[-1] + 1
+        gone = []
+        for term in list(self.postings):
+            postings = self.postings[term]
+            cut = bisect_left(postings, oldest)
+            if cut == len(postings):
+                del self.postings[term]
+                gone.append(term)
+            elif cut:
+                self.postings[term] = postings[cut:]
+        self.ids = self.ids[self.start:]
+        self.start = 0
+        return gone
+
+    def streams(self, words: List[str], prefix_terms: List[str]) -> List[Tuple[array, int]]:
+        """Postings that hold every message of the room that may match, with the index of the
+        oldest id still kept in each. That is the rarest of the words, or all terms of the prefix
+        if there are no words."""
+        if words:
+            postings = [self.postings.get(word) for word in words]
+            if None in postings:
+                return []
+            postings = [min(postings, key=len)]
+        else:
+            postings = [self.postings[term] for term in prefix_terms if term in self.postings]
+        oldest = self.ids[self.start]
+        return [(ids, bisect_left(ids, oldest)) for ids in postings]
+
+class SearchIndex:
+    """Full-text search over the chat messages of every room.
+
+    Each room has an inverted index from lowercased words to the ids of the messages containing
+    them. Ids are assigned in the order messages are added, across all rooms, and serve as the
+    cursor for paging, results come newest first. Only the newest max_messages are kept, the text
+    of the others is gone and their ids are dropped from the postings as they age out.
+
+    The vocabulary of all rooms is kept sorted for prefix lookups. New terms are collected
+    unsorted and merged in batches, inserting each into a long sorted list would dominate
+    indexing.
+
+    Messages are added from the room shards and searched from any loop, so every public method
+    takes the lock. A query looks at no more than SEARCH_MAX_SCANNED candidates per page."""
+    def __init__(self, max_messages: int = SEARCH_MAX_MESSAGES):
+        self.lock = threading.Lock()
+        self.max_messages = max_messages
+        self.rooms: Dict[str, RoomIndex] = {}
+        # (room_name, seq, username, timestamp, message) by id - base_id, None once dropped or
+        # once its room was cleared. The slots before start are dropped and compacted away like
+        # the postings.
+        self.messages: List[Tuple | None] = []
+        self.base_id = 0
+        self.start = 0
+        # Number of rooms using each term
+        self.term_rooms: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.new_terms: List[str] = []
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(room.size for room in self.rooms.values())
+
+    def next_id(self) -> int:
+        return self.base_id + len(self.messages)
+
+    def add(self, room_name: str, message: Dict):
+        """Indexes a message as returned by RoomHistory.append()"""
+        with self.lock:
+            message_id = self.next_id()
+            self.messages.append((room_name, message["seq"], message["username"], message["timestamp"], message["message"]))
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = RoomIndex()
+            for term in room.add(message_id, tokenize(message["message"])):
+                if term not in self.term_rooms:
+                    self.term_rooms[term] = 0
+                    self.new_terms.append(term)
+                self.term_rooms[term] += 1
+            if len(self.new_terms) > SEARCH_NEW_TERMS_MAX:
+                self.rebuild_terms()
+            while len(self.messages) - self.start > self.max_messages:
+                self.drop_oldest()
+
+    def drop_oldest(self):
+        entry = self.messages[self.start]
+        self.messages[self.start] = None
+        self.start += 1
+        if entry is not None:
+            room = self.rooms[entry[0]]
+            self.release_terms(room.drop_oldest())
+            if room.size == 0:
+                self.release_terms(self.rooms.pop(entry[0]).postings)
+        if self.start * 2 > len(self.messages):
+            del self.messages[:self.start]
+            self.base_id += self.start
+            self.start = 0
+
+    def release_terms(self, terms):
+        for term in terms:
+            self.term_rooms[term] -= 1
+            if self.term_rooms[term] == 0:
+                del self.term_rooms[term]
+        # Unused terms are skipped by lookups and left out of the next rebuild
+        if len(self.terms) > 2 * len(self.term_rooms):
+            self.rebuild_terms()
+
+    def rebuild_terms(self):
+        self.terms = sorted(self.term_rooms)
+        self.new_terms = []
+
+    def clear_room(self, room_name: str):
+        with self.lock:
+            room = self.rooms.pop(room_name, None)
+            if room is None:
+                return
+            self.release_terms(room.postings)
+            for index in range(self.start, len(self.messages)):
+                entry = self.messages[index]
+                if entry is not None and entry[0] == room_name:
+                    self.messages[index] = None
+
+    def expand(self, prefix: str) -> List[str]:
+        start = bisect_left(self.terms, prefix)
+        end = start
+        while end < len(self.terms) and self.terms[end].startswith(prefix):
+            end += 1
+        expanded = [term for term in self.terms[start:end] if term in self.term_rooms]
+        expanded += [term for term in self.new_terms if term.startswith(prefix) and term in self.term_rooms]
+        return expanded[:SEARCH_MAX_PREFIX_TERMS]
+
+    def search(self, query: str, room_name: str | None = None, username: str | None = None, since: str | None = None,
+               until: str | None = None, before_id: int | None = None, limit: int = 20) -> Tuple[List[Dict], int | None]:
+        """Messages matching every word of the query, a word ending in "*" matches as a prefix.
+        Without room_name every room is searched, since and until bound the ISO timestamps.
+        Returns a page of results and the cursor for the next one, which is None at the end."""
+        words = []
+        prefixes = []
+        for token in query.split():
+            terms = tokenize(token)
+            if token.endswith("*") and terms:
+                # "don't*" is the word "don" followed by the prefix "t"
+                (words, prefixes) = (words + terms[:-1], prefixes + terms[-1:])
+            else:
+                words += terms
+        if not words and not prefixes:
+            return ([], None)
+        limit = min(max(limit, 0), SEARCH_PAGE_MAX_SIZE)
+        with self.lock:
+            if before_id is None:
+                before_id = self.next_id()
+            if room_name is None:
+                rooms = list(self.rooms.values())
+            else:
+                rooms = [self.rooms[room_name]] if room_name in self.rooms else []
+            # Without words, candidates are the messages with a term starting with the longest prefix
+            prefix_terms = [] if words else self.expand(max(prefixes, key=len))
+            streams = [stream for room in rooms for stream in room.streams(words, prefix_terms)]
+            results = []
+            scanned = 0
+            for message_id in newest_first(streams, before_id, limit + 1):
+                if len(results) == limit or scanned == SEARCH_MAX_SCANNED:
+                    return (results, before_id)
+                scanned += 1
+                before_id = message_id
+                (room, seq, author, timestamp, text) = self.messages[message_id - self.base_id]
+                if username is not None and author != username:
+                    continue
+                if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                    continue
+                if not matches(tokenize(text), words, prefixes):
+                    continue
+                results.append({"id": message_id, "room_name": room, "seq": seq, "username": author, "message": text, "timestamp": timestamp})
+            return (results, None)
+
+def newest_first(streams: List[Tuple[array, int]], before_id: int, count: int) -> Iterator[int]:
+    """Merges the ids below before_id of all streams, newest first and without duplicates.
+
+    Ids are taken a window of ids at a time, a bisection and a slice per stream, instead of one
+    at a time from a heap over all streams (a prefix can have thousands). The first window is
+    sized from the density of the streams to hold about count ids and it doubles every round,
+    so no more than about twice the ids that are looked at are sliced."""
+    # [ids, low, high], ids[low:high] are still to come
+    streams = [[ids, low, bisect_left(ids, before_id, low)] for (ids, low) in streams]
+    streams = [stream for stream in streams if stream[1] < stream[2]]
+    if not streams:
+        return
+    oldest = min(ids[low] for (ids, low, _) in streams)
+    remaining = sum(high - low for (_, low, high) in streams)
+    window = max(count, count * (before_id - oldest) // remaining)
+    while streams:
+        start = before_id - window
+        chunk = []
+        for stream in streams:
+            (ids, low, high) = stream
+            stream[2] = bisect_left(ids, start, low, high)
+            chunk += ids[stream[2]:high]
+        chunk.sort(reverse=True)
+        for message_id in chunk:
+            if message_id < before_id:
+                before_id = message_id
+                yield message_id
+        before_id = start
+        window *= 2
+        streams = [stream for stream in streams if stream[1] < stream[2]]
+
+def matches(terms: List[str], words: List[str], prefixes: List[str]) -> bool:
+    return all(word in terms for word in words) and all(any(term.startswith(prefix) for term in terms) for prefix in prefixes)
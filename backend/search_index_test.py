@@ -0,0 +1,72 @@
+from search_index import *
+
+def message(seq: int, text: str, username: str = "user", timestamp: str = "2025-09-26T10:30:00"):
+    return {"seq": seq, "username": username, "message": text, "timestamp": timestamp}
+
+def texts(results):
+    return [result["message"] for result in results]
+
+def test_terms_and_prefixes():
+    index = SearchIndex()
+    index.add("a", message(1, "Hello world"))
+    index.add("a", message(2, "hello there, World!"))
+    index.add("a", message(3, "help wanted"))
+    assert texts(index.search("world hello")[0]) == ["hello there, World!", "Hello world"]
+    assert texts(index.search("hel*")[0]) == ["help wanted", "hello there, World!", "Hello world"]
+    assert texts(index.search("hel* there")[0]) == ["hello there, World!"]
+    assert index.search("missing")[0] == []
+    assert index.search("  ")[0] == []
+
+def test_room_username_and_time_filters():
+    index = SearchIndex()
+    index.add("a", message(1, "lunch?", "alice", "2025-09-26T10:00:00"))
+    index.add("b", message(1, "lunch!", "bob", "2025-09-26T11:00:00"))
+    index.add("b", message(2, "lunch now", "alice", "2025-09-26T12:00:00"))
+    assert [r["room_name"] for r in index.search("lunch")[0]] == ["b", "b", "a"]
+    assert texts(index.search("lunch", room_name="a")[0]) == ["lunch?"]
+    assert texts(index.search("lunch", username="alice")[0]) == ["lunch now", "lunch?"]
+    assert texts(index.search("lunch", since="2025-09-26T10:30:00", until="2025-09-26T11:30:00")[0]) == ["lunch!"]
+    assert index.search("lunch", room_name="missing")[0] == []
+
+def test_paging_by_cursor():
+    index = SearchIndex()
+    for i in range(5):
+        index.add("a", message(i + 1, f"ping {i}"))
+    (page, cursor) = index.search("ping", limit=2)
+    assert texts(page) == ["ping 4", "ping 3"]
+    (page, cursor) = index.search("ping", before_id=cursor, limit=2)
+    assert texts(page) == ["ping 2", "ping 1"]
+    (page, cursor) = index.search("ping", before_id=cursor, limit=2)
+    assert (texts(page), cursor) == (["ping 0"], None)
+
+def test_prefix_matching_several_terms_is_not_repeated():
+    index = SearchIndex()
+    index.add("a", message(1, "cat cats catalog"))
+    index.add("b", message(1, "cattle"))
+    assert texts(index.search("cat*")[0]) == ["cattle", "cat cats catalog"]
+
+def test_oldest_messages_age_out():
+    index = SearchIndex(max_messages=3)
+    for i in range(10):
+        index.add("a" if i % 2 else "b", message(i + 1, f"word{i} common"))
+    assert len(index) == 3
+    assert texts(index.search("common")[0]) == ["word9 common", "word8 common", "word7 common"]
+    assert index.search("word0")[0] == index.search("word5")[0] == []
+    assert texts(index.search("word*")[0]) == ["word9 common", "word8 common", "word7 common"]
+    # Terms of dropped messages are released when their room is compacted
+    assert "word0" not in index.expand("word")
+    assert len(index.messages) - index.start <= 3
+
+def test_clear_room_prunes_its_messages():
+    index = SearchIndex(max_messages=4)
+    index.add("a", message(1, "keep me"))
+    index.add("b", message(1, "drop me"))
+    index.clear_room("b")
+    assert texts(index.search("me")[0]) == ["keep me"]
+    assert "b" not in index.rooms
+    assert "drop" not in index.expand("dr")
+    index.add("b", message(2, "me again"))
+    for i in range(4):
+        index.add("a", message(i + 2, "filler"))
+    assert texts(index.search("me")[0]) == []
+    assert len(index) == 4
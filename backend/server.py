@@ -1,18 +1,60 @@
-from fastapi import FastAPI, HTTPException, WebSocket
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
+from pydantic import ValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
 import uvicorn
 
 from message_types import *
 from websocket_handlers import *
 from validation import *
+from chat_logging import configure_logging
+from metrics import REGISTRY
 
-app = FastAPI(title="Chat Backend", version="1.0.0")
+configure_logging()
+
+# Messages of one bulk send, they are validated and broadcast BULK_CHUNK_ITEMS at a time
+BULK_MAX_ITEMS = 10000
+BULK_CHUNK_ITEMS = 500
+BULK_MAX_LINE_BYTES = 64 * 1024
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Messages per page of the messages endpoints, and per chunk of an NDJSON export
+MESSAGES_PAGE_DEFAULT_SIZE = 100
+MESSAGES_PAGE_MAX_SIZE = 1000
+EXPORT_CHUNK_SIZE = 500
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    storage.shards.start()
+    storage.writers.start()
+    await storage.backplane.start()
+    tick_task = asyncio.create_task(room_tick_loop())
+    sweep_task = asyncio.create_task(room_sweep_loop()) if storage.room_idle_ttl > 0 else None
+    yield
+    tick_task.cancel()
+    if sweep_task:
+        sweep_task.cancel()
+    # Disconnected users still need the backplane and their room's shard to be removed
+    await storage.wait_for_cleanups()
+    await storage.writers.stop()
+    await storage.backplane.stop()
+    await storage.shards.stop()
+    # Make sure the last batch of messages reaches the disk before exiting
+    storage.flush()
+
+app = FastAPI(title="Chat Backend", version="1.0.0", lifespan=lifespan)
 app.mount("/chat/", StaticFiles(directory="./frontend"), name="chat")
 
 # Insert the global room into the storage and give it a WebSocketManager
-storage.managers[GLOBAL_ROOM_NAME] = WebSocketManager(GLOBAL_ROOM_NAME, UserDatabase())
+storage.get_manager(GLOBAL_ROOM_NAME)
 
 # Enable CORS
 app.add_middleware(
@@ -23,11 +65,24 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-async def https_send_message(username: str, chat_msg: ChatMessage, room_name: str):
+async def https_send_message(username: str, chat_msg: ChatMessage, room_name: str, address: str | None = None,
+                             session_token: str | None = None):
     """Send a message to the chat"""
     username = chat_msg.username.strip()
     message = chat_msg.message.strip()
 
+    keys = [(SCOPE_USER, username)]
+    if address:
+        keys.append((SCOPE_ADDRESS, address))
+    retry_after = storage.rate_limiter.acquire("message", keys)
+    if retry_after:
+        rate_limited.labels("message").inc()
+        raise HTTPException(status_code=429, detail="Too many messages, slow down", headers={"Retry-After": str(math.ceil(retry_after))})
+
+    room_validation = validate_room_name(room_name)
+    if room_validation  != "":
+        raise HTTPException(status_code=400, detail=room_validation)
+
     if not username:
         raise HTTPException(status_code=400, detail="Username cannot be empty")
     if username_too_long(username):
@@ -38,63 +93,321 @@ async def https_send_message(username: str, chat_msg: ChatMessage, room_name: st
     if not message:
         raise HTTPException(status_code=400, detail="Message cannot be empty")
 
+    sender_error = await validate_sender(username, session_token)
+    if sender_error:
+        raise HTTPException(status_code=401, detail=sender_error, headers={"WWW-Authenticate": "Bearer"})
+
     (manager, _) = await create_and_broadcast_new_room(room_name, username)
     await manager.server_broadcast(WsMessage(username=username, message=message))
 
     return {"status": "success", "message": "Message sent"}
 
+async def https_send_messages(request: Request, room_name: str):
+    """Bulk send, the body is a JSON array of messages or NDJSON with one message per line"""
+    address = client_address(request)
+    if request.headers.get("content-type", "").split(";")[0].strip() == NDJSON_MEDIA_TYPE:
+        statuses = await ingest_ndjson(request, room_name, address)
+        body = "".join(status.model_dump_json(exclude_none=True) + "\n" for status in statuses)
+        return Response(body, media_type=NDJSON_MEDIA_TYPE)
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"No more than {BULK_MAX_ITEMS} messages at a time")
+    statuses = []
+    for start in range(0, len(items), BULK_CHUNK_ITEMS):
+        statuses += await bulk_send_messages(items[start:start + BULK_CHUNK_ITEMS], room_name, address, start, bearer_token(request))
+    accepted = sum(1 for status in statuses if status.status == "success")
+    return BulkSendResponse(accepted=accepted, rejected=len(statuses) - accepted, results=statuses)
+
+async def ingest_ndjson(request: Request, room_name: str, address: str | None) -> List[BulkItemStatus]:
+    """Publishes the lines of an NDJSON body BULK_CHUNK_ITEMS at a time, while it is still being
+    received. A line that is too long is replaced by None, its item fails. Reading stops with 413
+    once there are more than BULK_MAX_ITEMS lines, the chunks before were already published."""
+    session_token = bearer_token(request)
+    statuses = []
+    lines = []
+    buffer = b""
+    oversized = False
+    async for chunk in request.stream():
+        (*complete, buffer) = (buffer + chunk).split(b"\n")
+        if complete and oversized:
+            # The rest of a line that was dropped
+            (complete[0], oversized) = (None, False)
+        for line in complete:
+            if line is None or len(line) > BULK_MAX_LINE_BYTES:
+                lines.append(None)
+            elif line.strip():
+                lines.append(line)
+        if len(statuses) + len(lines) > BULK_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"No more than {BULK_MAX_ITEMS} messages at a time")
+        if len(buffer) > BULK_MAX_LINE_BYTES:
+            (buffer, oversized) = (b"", True)
+        if len(lines) >= BULK_CHUNK_ITEMS:
+            statuses += await bulk_send_messages(lines, room_name, address, len(statuses), session_token)
+            lines = []
+    if oversized:
+        lines.append(None)
+    elif buffer.strip():
+        lines.append(buffer)
+    if len(statuses) + len(lines) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"No more than {BULK_MAX_ITEMS} messages at a time")
+    if lines:
+        statuses += await bulk_send_messages(lines, room_name, address, len(statuses), session_token)
+    return statuses
+
+async def bulk_send_messages(items: List, room_name: str, address: str | None, first_index: int,
+                             session_token: str | None = None) -> List[BulkItemStatus]:
+    """Validates and rate limits every item, then broadcasts the accepted ones as one batch per
+    room. Items are parsed objects, or NDJSON lines."""
+    statuses: List[BulkItemStatus | None] = [None] * len(items)
+    rooms: Dict[str, List[Tuple[int, WsMessage]]] = {}
+    # username -> why it may not send, a bulk send usually repeats a few usernames
+    senders: Dict[str, str] = {}
+    for (offset, item) in enumerate(items):
+        index = first_index + offset
+        chat_msg = parse_bulk_item(item)
+        if isinstance(chat_msg, str):
+            error = chat_msg
+        else:
+            (username, message, target_room) = (chat_msg.username.strip(), chat_msg.message.strip(), chat_msg.room_name or room_name)
+            error = validate_room_name(target_room) or validate_username_format(username) or validate_chat_message(message)
+            if not error:
+                if username not in senders:
+                    senders[username] = await validate_sender(username, session_token)
+                error = senders[username]
+            if not error:
+                keys = [(SCOPE_USER, username)]
+                if address:
+                    keys.append((SCOPE_ADDRESS, address))
+                if storage.rate_limiter.acquire("bulk_message", keys):
+                    rate_limited.labels("bulk_message").inc()
+                    error = "Too many messages, slow down"
+        if error:
+            statuses[offset] = BulkItemStatus(index=index, status="error", detail=error)
+        else:
+            rooms.setdefault(target_room, []).append((offset, WsMessage(username=username, message=message)))
+
+    for (target_room, messages) in rooms.items():
+        try:
+            (manager, _) = await create_and_broadcast_new_room(target_room, messages[0][1].username)
+            await manager.server_broadcast_batch([message for (_, message) in messages])
+            failure = None
+        except ConnectionError as e:
+            storage_log.warning("Bulk send to room %s failed: %s", target_room, e)
+            failure = "Message could not be delivered, try again later"
+        for (offset, _) in messages:
+            statuses[offset] = BulkItemStatus(index=first_index + offset, status="error" if failure else "success", detail=failure)
+    return statuses
+
+async def validate_sender(username: str, session_token: str | None) -> str:
+    """Registered usernames can only send with a session token of theirs, like on WebSockets"""
+    if await storage.is_registered(username) and not (session_token and storage.sessions.resume(username, session_token)):
+        return "Username is registered, log in to use it"
+    return ""
+
+def bearer_token(request: Request) -> str | None:
+    """The session token of an `Authorization: Bearer` header"""
+    (scheme, _, token) = request.headers.get("authorization", "").partition(" ")
+    return (token.strip() or None) if scheme.lower() == "bearer" else None
+
+def parse_bulk_item(item: Any) -> BulkChatMessage | str:
+    """Returns the parsed item, or why it could not be parsed"""
+    if item is None:
+        return "Line is too long"
+    try:
+        if isinstance(item, bytes):
+            return BulkChatMessage.model_validate_json(item)
+        return BulkChatMessage.model_validate(item)
+    except ValidationError as e:
+        return f"Invalid message: {e.errors()[0]['msg']}"
+
 @app.get("/")
 async def root():
     return RedirectResponse(url="/chat/index.html")
 
+def client_address(request: Request) -> str | None:
+    return request.client.host if request.client else None
+
 @app.post("/send-message")
-async def send_message(chat_msg: ChatMessage):
-    return await https_send_message(chat_msg.username, chat_msg, GLOBAL_ROOM_NAME)
+async def send_message(chat_msg: ChatMessage, request: Request):
+    return await https_send_message(chat_msg.username, chat_msg, GLOBAL_ROOM_NAME, client_address(request), bearer_token(request))
 
 @app.post("/{room_name}/send-message")
-async def send_message_room(chat_msg: ChatMessage, room_name: str):
+async def send_message_room(chat_msg: ChatMessage, room_name: str, request: Request):
+    return await https_send_message(chat_msg.username, chat_msg, room_name, client_address(request), bearer_token(request))
+
+@app.post("/send-messages")
+async def send_messages(request: Request) -> BulkSendResponse:
+    return await https_send_messages(request, GLOBAL_ROOM_NAME)
+
+@app.post("/{room_name}/send-messages")
+async def send_messages_room(room_name: str, request: Request) -> BulkSendResponse:
     room_validation = validate_room_name(room_name)
     if room_validation  != "":
         raise HTTPException(status_code=400, detail=room_validation)
-    return await https_send_message(chat_msg.username, chat_msg, room_name)
+    return await https_send_messages(request, room_name)
 
 @app.get("/messages")
-async def get_all_messages():
-    """Get all chat messages"""
-    return {"messages": storage.chat_messages[GLOBAL_ROOM_NAME]}
+async def get_all_messages(request: Request, after: int | None = None, before: int | None = None, limit: int | None = None,
+                           output: str = Query("json", alias="format")):
+    """Get all chat messages, or a page of them"""
+    return await messages_response(request, GLOBAL_ROOM_NAME, after, before, limit, output)
 
 @app.get("/{room_name}/messages/")
-async def get_all_messages_room(room_name: str):
-    """Get all chat messages"""
+async def get_all_messages_room(room_name: str, request: Request, after: int | None = None, before: int | None = None,
+                                limit: int | None = None, output: str = Query("json", alias="format")):
+    """Get all chat messages, or a page of them"""
+    room_validation = validate_room_name(room_name)
+    if room_validation  != "":
+        raise HTTPException(status_code=400, detail=room_validation)
+    return await messages_response(request, room_name, after, before, limit, output)
+
+async def messages_response(request: Request, room_name: str, after: int | None, before: int | None, limit: int | None, output: str):
+    """Without parameters the whole history, with after the messages that followed that seq
+    (for polling), otherwise the newest page before the before seq. Unchanged histories get a
+    304 for the ETag they were sent with."""
+    await storage.restore_room(room_name)
+    # Taken before the messages, a message added in between only makes the next poll a 200
+    etag = storage.get_messages_etag(room_name)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    if output == "ndjson":
+        return StreamingResponse(export_ndjson(room_name, after, before, limit), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    if output != "json":
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    if after is None and before is None and limit is None:
+        # Pre-rendered, only rebuilt when the history changed
+        return Response(storage.get_messages_body(room_name), media_type="application/json", headers=headers)
+
+    limit = min(max(limit or MESSAGES_PAGE_DEFAULT_SIZE, 1), MESSAGES_PAGE_MAX_SIZE)
+    if after is not None:
+        # Rendered when the messages were added, the next poll continues from next_cursor. Older
+        # messages may come from the message log.
+        (entries, has_more) = await storage.get_page_after(room_name, after, limit)
+        next_cursor = entries[-1][0] if entries else after
+        body = '{"messages":' + render_entries(entries) + ',"has_more":' + ("true" if has_more else "false") + ',"next_cursor":' + str(next_cursor) + "}"
+        return Response(body, media_type="application/json", headers=headers)
+    # Older pages may come from the message log
+    (messages, has_more) = await storage.get_history_page(room_name, before if before is not None else sys.maxsize, limit)
+    next_cursor = messages[0]["seq"] if messages and has_more else None
+    return Response(to_json({"messages": messages, "has_more": has_more, "next_cursor": next_cursor}), media_type="application/json", headers=headers)
+
+async def export_ndjson(room_name: str, after: int | None, before: int | None, limit: int | None):
+    """One message per line, oldest first, from after up to before (both exclusive). Read a chunk
+    at a time, the export is never in memory as a whole and only covers the messages that were
+    there when it started."""
+    cursor = after or 0
+    end = before if before is not None else storage.get_history(room_name).next_seq
+    remaining = limit if limit is not None else sys.maxsize
+    while remaining > 0:
+        (entries, _) = await storage.get_page_after(room_name, cursor, min(remaining, EXPORT_CHUNK_SIZE))
+        entries = [entry for entry in entries if entry[0] < end]
+        if not entries:
+            return
+        yield "".join(entry[4] + "\n" for entry in entries)
+        cursor = entries[-1][0]
+        remaining -= len(entries)
+
+@app.get("/search")
+async def search_messages(q: str, room_name: str | None = None, username: str | None = None, since: str | None = None,
+                          until: str | None = None, before: int | None = None, limit: int = 20) -> SearchResults:
+    """Search the messages of all rooms, or of one room with room_name"""
+    (results, next_cursor) = storage.search_index.search(q, room_name, username, since, until, before, limit)
+    return SearchResults(results=results, next_cursor=next_cursor)
+
+@app.get("/{room_name}/search")
+async def search_messages_room(room_name: str, q: str, username: str | None = None, since: str | None = None,
+                               until: str | None = None, before: int | None = None, limit: int = 20) -> SearchResults:
+    """Search the messages of a room"""
     room_validation = validate_room_name(room_name)
     if room_validation  != "":
         raise HTTPException(status_code=400, detail=room_validation)
-    return {"messages": storage.get_chat_messages(room_name)}
+    return await search_messages(q, room_name, username, since, until, before, limit)
+
+@app.get("/events")
+async def room_events(request: Request, last_event_id: int | None = None):
+    """Server-Sent Events of the global room"""
+    return await events_response(request, GLOBAL_ROOM_NAME, last_event_id)
+
+@app.get("/{room_name}/events")
+async def room_events_room(room_name: str, request: Request, last_event_id: int | None = None):
+    """Server-Sent Events of a room, read-only"""
+    room_validation = validate_room_name(room_name)
+    if room_validation  != "":
+        raise HTTPException(status_code=400, detail=room_validation)
+    return await events_response(request, room_name, last_event_id)
+
+async def events_response(request: Request, room_name: str, last_event_id: int | None) -> StreamingResponse:
+    """Resumes after the Last-Event-ID header that EventSource sends when reconnecting, or the
+    last_event_id query parameter"""
+    if not storage.room_exists(room_name):
+        raise HTTPException(status_code=404, detail=f"Room {room_name} not found")
+    await storage.restore_room(room_name)
+    (manager, _) = storage.get_manager(room_name)
+    header = request.headers.get("last-event-id", "")
+    if header.isdigit():
+        last_event_id = int(header)
+    # No buffering by proxies, events should go out as they happen
+    return StreamingResponse(event_stream(manager, last_event_id), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/rooms")
 async def get_all_rooms():
     """Get all chat rooms"""
-    return {"rooms": gather_rooms(storage.managers)}
+    # Pre-rendered, only rebuilt when the room directory changed
+    return Response(content=storage.directory.get_http_body(), media_type="application/json")
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.delete("/clear-chat")
 async def clear_chat():
     """Clear all messages and users (useful for testing)"""
     global chat_messages, connected_users
-    storage.chat_messages[GLOBAL_ROOM_NAME] = []
+    # Goes through the backplane like a clear from a client, so every worker clears its history
+    (manager, _) = storage.get_manager(GLOBAL_ROOM_NAME)
+    await manager.server_broadcast(WsRoomChatClear(room_name=GLOBAL_ROOM_NAME, username="server"))
     connected_users = {}
     return {"status": "success", "message": "Chat cleared"}
 
 # Global room, this is just a shortcut for /ws/{GLOBAL_ROOM_NAME}
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    print(f"New websocket connection with default room_name: {GLOBAL_ROOM_NAME}")
+    connection_log.debug("New websocket connection with default room_name: %s", GLOBAL_ROOM_NAME)
     await ws_connect_user(websocket, GLOBAL_ROOM_NAME)
 
 @app.websocket("/ws/{room_name}")
 async def websocket_endpoint_room(websocket: WebSocket, room_name: str):
-    print(f"New websocket connection with room_name: {room_name}")
+    connection_log.debug("New websocket connection with room_name: %s", room_name)
     await ws_connect_user(websocket, room_name)
 
 
+def start_broker(path: str):
+    """Runs the backplane broker in a child process and waits until it accepts connections"""
+    if os.path.exists(path):
+        os.unlink(path)
+    multiprocessing.Process(target=run_broker, args=(path,), daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.05)
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    workers = int(os.environ.get("CHAT_WORKERS", "1"))
+    # Transport compression, negotiated with every client that offers it. Frames of the "+deflate"
+    # subprotocols are already compressed, so it can be turned off when clients use those.
+    ws_per_message_deflate = os.environ.get("CHAT_WS_PER_MESSAGE_DEFLATE", "1") != "0"
+    if workers > 1:
+        # The workers find the broker through CHAT_BACKPLANE, which they inherit
+        os.environ.setdefault("CHAT_BACKPLANE", DEFAULT_BROKER_PATH)
+        start_broker(os.environ["CHAT_BACKPLANE"])
+        uvicorn.run("server:app", host="0.0.0.0", port=5000, workers=workers, ws_per_message_deflate=ws_per_message_deflate)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=5000, ws_per_message_deflate=ws_per_message_deflate)
@@ -0,0 +1,126 @@
+import itertools
+import secrets
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+from event_codecs import *
+from user_database import token_hash
+
+# Room events kept for resuming clients, a client that missed more gets a full snapshot
+RESUME_LOG_MAX_EVENTS = 64
+# How long a disconnected client can resume, its username stays taken until then
+RESUME_GRACE_SECONDS = 60.0
+
+# Event sequence numbers are unique across all rooms of this process. A room's log that was
+# dropped and created again (e.g. an evicted room) starts above every seq a client saw before, so
+# an old seq is never mistaken for one of the new log.
+event_seqs = itertools.count(1)
+
+class RoomEventLog:
+    """The newest events delivered to one room, with their event_seq.
+
+    Events are logged as SequencedEvents, the same frames that were sent to resumable connections,
+    so a replay does not encode anything again. Only used from the room's shard."""
+    __slots__ = ("events", "floor", "max_events")
+
+    def __init__(self, max_events: int = RESUME_LOG_MAX_EVENTS):
+        self.events: deque = deque()
+        # Events of this room up to this seq are no longer in the log
+        self.floor = next(event_seqs)
+        self.max_events = max_events
+
+    def append(self, frame: EncodedEvent) -> "SequencedEvent":
+        event = SequencedEvent(frame, next(event_seqs))
+        self.events.append(event)
+        if len(self.events) > self.max_events:
+            self.floor = self.events.popleft().seq
+        return event
+
+    def since(self, seq: int, limit: int) -> List["SequencedEvent"] | None:
+        """The events after seq, or None if some of them are gone or there are more than limit"""
+        if seq < self.floor:
+            return None
+        events = list(itertools.dropwhile(lambda event: event.seq <= seq, self.events))
+        return events if len(events) <= limit else None
+
+class SequencedEvent(EncodedEvent):
+    """A room event as sent to resumable connections, its frames carry the event_seq.
+
+    The frames are built from the ones of the shared event, the event itself is not encoded
+    again. The event is the original one, so delivery queues treat both the same."""
+    __slots__ = ("inner", "seq")
+
+    def __init__(self, inner: EncodedEvent, seq: int):
+        super().__init__(inner.event)
+        self.inner = inner
+        self.seq = seq
+
+    def encode(self, codec: EventCodec) -> str | bytes:
+        frame = self._frames.get(codec.name)
+        if frame is None:
+            if isinstance(codec, DeflateCodec):
+                frame = codec.compress(self.encode(codec.inner))
+            else:
+                frame = codec.add_seq(self.inner.encode(codec), self.seq)
+            self._frames[codec.name] = frame
+        return frame
+
+class ResumeSession:
+    __slots__ = ("username", "room_name", "connection", "expiry")
+
+    def __init__(self, username: str, room_name: str, connection: Any):
+        self.username = username
+        self.room_name = room_name
+        # The live connection, None once it is gone and the session waits to be resumed
+        self.connection = connection
+        self.expiry = float("inf")
+
+class ResumeSessions:
+    """Resume tokens of the connections of this worker.
+
+    A token belongs to one connection. When it disconnects the session is kept for grace seconds,
+    with its username still claimed, and a new connection presenting the token takes it over. Every
+    token is used once, the resumed connection gets a new one. Only the tokens' hashes are stored.
+    Only used from the server's loop."""
+    def __init__(self, grace: float = RESUME_GRACE_SECONDS):
+        self.grace = grace
+        self.sessions: Dict[bytes, ResumeSession] = {}
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def issue(self, connection: Any) -> str:
+        token = secrets.token_urlsafe(32)
+        self.sessions[token_hash(token)] = ResumeSession(connection.username, connection.room_name, connection)
+        return token
+
+    def detach(self, token: str, connection: Any) -> bool:
+        """Called when the connection is gone. Returns False if its session was taken over or
+        does not exist, otherwise the session can be resumed for grace seconds."""
+        session = self.sessions.get(token_hash(token))
+        if session is None or session.connection is not connection:
+            return False
+        session.connection = None
+        session.room_name = connection.room_name
+        session.expiry = time.monotonic() + self.grace
+        return True
+
+    def take(self, token: str, username: str) -> ResumeSession | None:
+        """Hands out the session of the token, whether or not its connection is still there"""
+        key = token_hash(token)
+        session = self.sessions.get(key)
+        # An expired session is left to expire(), which gives back its username
+        if session is None or session.username != username or session.expiry < time.monotonic():
+            return None
+        del self.sessions[key]
+        return session
+
+    def expire(self, token: str) -> ResumeSession | None:
+        """Removes the session if it was not resumed and returns it"""
+        key = token_hash(token)
+        session = self.sessions.get(key)
+        if session is None or session.connection is not None:
+            return None
+        del self.sessions[key]
+        return session
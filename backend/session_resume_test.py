@@ -0,0 +1,55 @@
+import json
+import time
+from session_resume import *
+
+class Connection:
+    def __init__(self, username: str, room_name: str = "room"):
+        self.username = username
+        self.room_name = room_name
+
+def test_event_log_replays_what_was_missed():
+    log = RoomEventLog(max_events=3)
+    events = [log.append(EncodedEvent(WsMessage(username="alice", message=str(i)))) for i in range(5)]
+    # The first two were dropped, a client that saw the first one missed the second
+    assert log.since(events[0].seq, 10) is None
+    assert [event.event.message for event in log.since(events[1].seq, 10)] == ["2", "3", "4"]
+    assert log.since(events[4].seq, 10) == []
+    assert log.since(events[1].seq, 2) is None
+    # A new log of the same room never replays from an old seq
+    assert RoomEventLog().since(events[4].seq, 10) is None
+
+def test_sequenced_frames_carry_the_event_seq():
+    message = WsMessage(username="alice", message="hello " * 200)
+    for codec in CODECS.values():
+        sequenced = SequencedEvent(EncodedEvent(message), 42)
+        frame = sequenced.encode(codec)
+        assert frame is sequenced.encode(codec)
+        assert codec.decode(frame) == message
+    frame = SequencedEvent(EncodedEvent(message), 42).encode(JSON_CODEC)
+    assert json.loads(frame)["event_seq"] == 42
+
+def test_resume_tokens():
+    sessions = ResumeSessions(grace=60)
+    alice = Connection("alice")
+    token = sessions.issue(alice)
+    assert sessions.take(token, "mallory") is None
+    # Expired only after it was detached
+    assert sessions.expire(token) is None
+    # Resumes in the room the connection was in when it went away
+    alice.room_name = "other"
+    assert sessions.detach(token, alice)
+    session = sessions.take(token, "alice")
+    assert (session.username, session.room_name, session.connection) == ("alice", "other", None)
+    # Used once
+    assert sessions.take(token, "alice") is None
+    assert not sessions.detach(token, alice)
+
+def test_expired_resume_token():
+    sessions = ResumeSessions(grace=0)
+    bob = Connection("bob")
+    token = sessions.issue(bob)
+    sessions.detach(token, bob)
+    time.sleep(0.001)
+    assert sessions.take(token, "bob") is None
+    assert sessions.expire(token).username == "bob"
+    assert len(sessions) == 0
@@ -0,0 +1,45 @@
+import time
+from typing import Dict, List
+
+# Typing state is sent to the room at most once per tick, and only when it changed
+TYPING_TICK_SECONDS = 0.25
+# A typing flag that is not refreshed or cleared by the client within this time is dropped
+TYPING_EXPIRY_SECONDS = 5.0
+
+class RoomTypingState:
+    """Who is typing in one room.
+
+    Updates only mark the state as changed, the aggregated WsTypingUsers frame is built by the
+    typing tick, so keystrokes no longer turn into one frame per user in the room."""
+    __slots__ = ("typing", "changed")
+
+    def __init__(self):
+        # Maps username to the time (time.monotonic) its typing flag expires
+        self.typing: Dict[str, float] = {}
+        self.changed = False
+
+    def update(self, username: str, is_typing: bool, now: float | None = None):
+        if is_typing:
+            if username not in self.typing:
+                self.changed = True
+            self.typing[username] = (time.monotonic() if now is None else now) + TYPING_EXPIRY_SECONDS
+        else:
+            self.remove(username)
+
+    def remove(self, username: str):
+        if self.typing.pop(username, None) is not None:
+            self.changed = True
+
+    def expire(self, now: float):
+        for username in [username for username, expires in self.typing.items() if expires <= now]:
+            self.remove(username)
+
+    def is_active(self) -> bool:
+        return self.changed or bool(self.typing)
+
+    def take_snapshot(self) -> List[str] | None:
+        """Returns the typing users if they changed since the last snapshot, otherwise None"""
+        if not self.changed:
+            return None
+        self.changed = False
+        return sorted(self.typing)
@@ -0,0 +1,22 @@
+from typing_indicators import RoomTypingState, TYPING_EXPIRY_SECONDS
+
+def test_snapshot_only_when_changed():
+    state = RoomTypingState()
+    state.update("alice", True, now=0)
+    state.update("bob", True, now=0)
+    assert state.take_snapshot() == ["alice", "bob"]
+    # Repeated keystrokes do not produce a new frame
+    state.update("alice", True, now=1)
+    assert state.take_snapshot() is None
+    state.update("bob", False)
+    assert state.take_snapshot() == ["alice"]
+
+def test_stale_flags_expire():
+    state = RoomTypingState()
+    state.update("alice", True, now=0)
+    state.take_snapshot()
+    state.expire(TYPING_EXPIRY_SECONDS - 1)
+    assert state.take_snapshot() is None
+    state.expire(TYPING_EXPIRY_SECONDS)
+    assert state.take_snapshot() == []
+    assert not state.is_active()
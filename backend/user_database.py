@@ -1,19 +1,107 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
 import bcrypt
 
+# bcrypt takes 100-300 ms per hash at the default cost, so it runs on a small pool of threads
+# (bcrypt releases the GIL) and hashes beyond AUTH_MAX_PENDING are refused instead of queued
+AUTH_HASH_WORKERS = int(os.environ.get("CHAT_AUTH_WORKERS", "4"))
+AUTH_MAX_PENDING = int(os.environ.get("CHAT_AUTH_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.environ.get("CHAT_BCRYPT_ROUNDS", "12"))
+SESSION_TTL_SECONDS = 24 * 60 * 60
+SESSION_MAX_TOKENS = 100000
+
+class AuthBusy(Exception):
+    """Raised when too many hashes are already in flight"""
+
 class UserDatabase:
-    def __init__(self):
-        self.users = {}
+    """Registered users and their bcrypt hashes, one for the whole server.
+
+    Hashing and checking run on a bounded thread pool, so a login does not block the event loop,
+    and no more than max_pending of them are in flight at a time. A name is held while it is
+    being registered, so it can not be registered twice concurrently. Only used from the server's
+    loop, where connections are set up."""
+    def __init__(self, workers: int = AUTH_HASH_WORKERS, max_pending: int = AUTH_MAX_PENDING, rounds: int = BCRYPT_ROUNDS):
+        # A username maps to None while its registration is being hashed
+        self.users: Dict[str, bytes | None] = {}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="auth")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rounds = rounds
 
-    def add_user(self, username: str, password: str):
+    def __contains__(self, username: str) -> bool:
+        return username in self.users
+
+    def restore(self, users: List[Tuple[str, bytes]]):
+        for (username, hashed_password) in users:
+            self.users[username] = hashed_password
+
+    def get_hash(self, username: str) -> bytes | None:
+        return self.users.get(username)
+
+    async def add_user(self, username: str, password: str) -> bytes:
+        """Returns the new hash. Raises ValueError if the user exists and AuthBusy if too many
+        hashes are in flight."""
         if username in self.users:
             raise ValueError(f"User {username} already exists")
-
-        hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+        self.users[username] = None
+        try:
+            hashed_password = await self.run(bcrypt.hashpw, password.encode(), bcrypt.gensalt(self.rounds))
+        except BaseException:
+            self.users.pop(username, None)
+            raise
         self.users[username] = hashed_password
+        return hashed_password
 
-    def check_user(self, username: str, password: str):
-        if username not in self.users:
+    async def check_user(self, username: str, password: str) -> bool:
+        hashed_password = self.users.get(username)
+        if hashed_password is None:
+            return False
+        return await self.run(bcrypt.checkpw, password.encode(), hashed_password)
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise AuthBusy()
+        self.pending += 1
+        try:
+            return await asyncio.wrap_future(self.executor.submit(func, *args))
+        finally:
+            self.pending -= 1
+
+class SessionCache:
+    """Session tokens handed out after a login, a reconnect with one skips bcrypt.
+
+    Tokens expire after ttl seconds and only the newest max_tokens are kept. Only the tokens'
+    hashes are stored."""
+    def __init__(self, ttl: float = SESSION_TTL_SECONDS, max_tokens: int = SESSION_MAX_TOKENS):
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        # Token hash -> (username, expiry), oldest first
+        self.sessions: OrderedDict[bytes, Tuple[str, float]] = OrderedDict()
+
+    def issue(self, username: str) -> str:
+        token = secrets.token_urlsafe(32)
+        self.sessions[token_hash(token)] = (username, time.monotonic() + self.ttl)
+        while len(self.sessions) > self.max_tokens:
+            self.sessions.popitem(last=False)
+        return token
+
+    def resume(self, username: str, token: str) -> bool:
+        key = token_hash(token)
+        session = self.sessions.get(key)
+        if session is None:
+            return False
+        if session[1] < time.monotonic():
+            del self.sessions[key]
             return False
+        return session[0] == username
 
-        hashed_password = self.users[username]
-        return bcrypt.checkpw(password.encode(), hashed_password)
+def token_hash(token: str) -> bytes:
+    # Tokens are random, a fast hash is enough
+    return hashlib.sha256(token.encode()).digest()
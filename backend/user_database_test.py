@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+
+from user_database import *
+
+def test_register_and_check():
+    async def run():
+        database = UserDatabase(rounds=4)
+        await database.add_user("alice", "secret")
+        with pytest.raises(ValueError):
+            await database.add_user("alice", "other")
+        assert await database.check_user("alice", "secret")
+        assert not await database.check_user("alice", "wrong")
+        assert not await database.check_user("bob", "secret")
+    asyncio.run(run())
+
+def test_hashing_does_not_block_the_loop():
+    async def run():
+        database = UserDatabase(rounds=10)
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+        ticker = asyncio.create_task(tick())
+        await database.add_user("carol", "secret")
+        ticker.cancel()
+        assert ticks > 5
+    asyncio.run(run())
+
+def test_in_flight_hashes_are_bounded():
+    async def run():
+        database = UserDatabase(workers=1, max_pending=2, rounds=4)
+        results = await asyncio.gather(*(database.add_user(f"user{i}", "secret") for i in range(4)), return_exceptions=True)
+        assert [isinstance(result, AuthBusy) for result in results] == [False, False, True, True]
+        # Refused registrations do not keep their name
+        assert "user3" not in database
+        await database.add_user("user3", "secret")
+    asyncio.run(run())
+
+def test_sessions():
+    sessions = SessionCache(max_tokens=2)
+    token = sessions.issue("alice")
+    assert sessions.resume("alice", token)
+    assert not sessions.resume("bob", token)
+    assert not sessions.resume("alice", "guessed")
+    sessions.issue("bob")
+    sessions.issue("carol")
+    # Only the newest tokens are kept
+    assert not sessions.resume("alice", token)
+    expired = SessionCache(ttl=-1)
+    assert not expired.resume("dave", expired.issue("dave"))
@@ -0,0 +1,62 @@
+import threading
+from typing import Any, Dict, List
+
+class UserRegistry:
+    """The connections of this worker by username.
+
+    Usernames are claimed before the connection exists, so a name can not be handed out twice
+    while a handshake is in progress. Every method takes the lock, the registry is read from the
+    room shards while connections come and go on the server's loop."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # A claimed username maps to None until its connection is added
+        self.users: Dict[str, Any] = {}
+        # Connections that enabled the room_updates feature
+        self.room_update_subscribers: Dict[str, Any] = {}
+
+    def __contains__(self, username: str) -> bool:
+        with self.lock:
+            return username in self.users
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.users)
+
+    def claim(self, username: str) -> bool:
+        """Returns False if the username is already claimed"""
+        with self.lock:
+            if username in self.users:
+                return False
+            self.users[username] = None
+            return True
+
+    def add(self, user: Any):
+        with self.lock:
+            self.users[user.username] = user
+            if user.room_updates:
+                self.room_update_subscribers[user.username] = user
+
+    def hold(self, username: str) -> bool:
+        """Keeps the username claimed without a connection, returns False if it was not claimed"""
+        with self.lock:
+            if username not in self.users:
+                return False
+            self.users[username] = None
+            self.room_update_subscribers.pop(username, None)
+            return True
+
+    def release(self, username: str, connection: Any = None) -> bool:
+        """Returns True if the username was claimed. With a connection, only releases it if it
+        belongs to that connection."""
+        with self.lock:
+            if connection is not None and self.users.get(username) is not connection:
+                return False
+            self.room_update_subscribers.pop(username, None)
+            return self.users.pop(username, False) is not False
+
+    def get(self, username: str) -> Any:
+        with self.lock:
+            return self.users.get(username)
+
+    def subscribers(self) -> List[Any]:
+        with self.lock:
+            return list(self.room_update_subscribers.values())
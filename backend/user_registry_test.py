@@ -0,0 +1,33 @@
+import threading
+
+from user_registry import *
+
+class FakeConnection:
+    def __init__(self, username: str, room_updates: bool = False):
+        self.username = username
+        self.room_updates = room_updates
+
+def test_claim_is_exclusive_until_released():
+    registry = UserRegistry()
+    assert registry.claim("alice")
+    assert not registry.claim("alice")
+    assert "alice" in registry and registry.get("alice") is None
+    registry.add(FakeConnection("alice", room_updates=True))
+    assert registry.subscribers()[0].username == "alice"
+    assert registry.release("alice")
+    assert not registry.release("alice")
+    assert registry.subscribers() == [] and len(registry) == 0
+    assert registry.claim("alice")
+
+def test_concurrent_claims():
+    registry = UserRegistry()
+    winners = []
+    def claim():
+        if registry.claim("bob"):
+            winners.append(threading.current_thread().name)
+    threads = [threading.Thread(target=claim) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
@@ -2,6 +2,8 @@ import re
 
 MAX_MESSAGE_LENGTH = 1000
 MAX_USERNAME_LENGTH = 20
+# bcrypt only looks at the first 72 bytes of a password
+MAX_PASSWORD_BYTES = 72
 
 def username_too_long(username: str) -> bool:
     """Checks that the username is not too long"""
@@ -11,6 +13,32 @@ def contains_invalid_characters(username: str) -> bool:
     """Checks that the username only contains valid characters"""
     return not re.match(r'^[a-zA-ZåäöÅÄÖ0-9_ -]+$', username)
 
+def validate_username_format(username: str) -> str:
+    """Checks that the username is valid"""
+    if not username:
+        return "Username cannot be empty"
+    if username_too_long(username):
+        return "Username is too long"
+    if contains_invalid_characters(username):
+        return "Username contains invalid characters"
+    return ""
+
+def validate_chat_message(message: str) -> str:
+    """Checks that the message can be broadcast"""
+    if not message:
+        return "Message cannot be empty"
+    if len(message) > MAX_MESSAGE_LENGTH:
+        return "Message is too long"
+    return ""
+
+def validate_password(password: str) -> str:
+    """Checks that the password can be hashed"""
+    if not password:
+        return "Password cannot be empty"
+    if len(password.encode()) > MAX_PASSWORD_BYTES:
+        return "Password is too long"
+    return ""
+
 def validate_room_name(room_name: str) -> str:
     """Checks that the room name is valid"""
     if len(room_name) > MAX_USERNAME_LENGTH:
@@ -1,273 +1,976 @@
 from fastapi import  WebSocket, WebSocketDisconnect
-from pydantic import ValidationError, TypeAdapter
 from typing import Callable, Any, Tuple
 from datetime import datetime
 import uuid
 import asyncio
+import itertools
+import threading
+import time
 
 from message_types import *
+from event_codecs import *
+from chat_history import *
+from message_log import *
+from backplane import *
+from chat_logging import get_logger
+from metrics import counter, gauge, histogram
+from typing_indicators import *
+from delivery_queue import *
+from event_stream import *
+from room_directory import *
+from room_lifecycle import *
+from presence import *
+from session_resume import *
+from rate_limiter import *
+from room_shards import *
+from search_index import *
+from user_registry import *
 from user_database import *
+from writer_pool import *
 from validation import *
 
 QUEUE_MAX_SIZE = 50
+QUEUE_MAX_BYTES = 1024 * 1024
+# Used for connections that did not ask for a policy of their own
+DEFAULT_OVERFLOW_POLICY = OVERFLOW_DROP_EPHEMERAL
+# Protocol features a client can ask for in its WsConnectionRequest
+FEATURE_BATCH = "batch"
+# Pushes a WsRoomUsersUpdate whenever the user list of any room changes
+FEATURE_ROOM_UPDATES = "room_updates"
+# Versioned presence, WsPresence and batched WsPresenceDelta instead of the full WsUsersOnline and
+# one WsUserJoinEvent or WsUserLeaveEvent per change
+FEATURE_PRESENCE = "presence"
+# A resume token in the WsConnectionResponse and an event_seq on every room event, a reconnect with
+# both only gets the events it missed
+FEATURE_RESUME = "resume"
+SUPPORTED_FEATURES = [FEATURE_BATCH, FEATURE_ROOM_UPDATES, FEATURE_PRESENCE, FEATURE_RESUME]
+# Limits for one WsBatch frame. With a flush window above 0 the sender waits that long for more
+# events before sending a batch, otherwise it only takes what is already queued.
+BATCH_MAX_EVENTS = 64
+BATCH_MAX_BYTES = 256 * 1024
+BATCH_FLUSH_WINDOW_SECONDS = 0.0
+# A shared writer gives up on a connection whose send takes longer, and closes it
+WRITER_SEND_TIMEOUT_SECONDS = 10.0
+# Messages of a bulk broadcast queued for each connection at a time, and how long to wait for a
+# connection's sender to make room for the next chunk
+BULK_DELIVERY_CHUNK = 16
+# Queue slots kept free by a batch delivery for the events that follow it
+BULK_DELIVERY_HEADROOM = 16
+BULK_DRAIN_TIMEOUT_SECONDS = 1.0
+BULK_DRAIN_POLL_SECONDS = 0.001
 GLOBAL_ROOM_NAME = "Global"
+# Events that are not about the room a connection is in, they survive a room switch
+GLOBAL_EVENT_TYPES = {"room_create", "room_users", "all_rooms"}
+# Creator of a room whose creation has not been completed yet
+ROOM_CREATOR_PENDING = "<IN PROGRESS>"
+
+connection_log = get_logger("connection")
+broadcast_log = get_logger("broadcast")
+# One line per recipient per event, only enabled at DEBUG and usually sampled
+delivery_log = get_logger("delivery")
+room_log = get_logger("room")
+storage_log = get_logger("storage")
+event_stream_log = get_logger("event_stream")
+
+events_received = counter("chat_events_received_total", "Events received from clients", ("event_type",))
+events_sent = counter("chat_events_sent_total", "Events sent to clients", ("event_type",))
+bytes_sent = counter("chat_bytes_sent_total", "Encoded bytes (characters for text frames) sent to clients")
+queue_full = counter("chat_queue_full_total", "Events that did not fit in a delivery queue")
+events_dropped = counter("chat_events_dropped_total", "Queued events dropped by a connection's overflow policy")
+slow_consumer_disconnects = counter("chat_slow_consumer_disconnects_total", "Connections closed because their delivery queue was full")
+enqueue_to_send_seconds = histogram("chat_enqueue_to_send_seconds", "Time from queueing an event until it was handed to the socket")
+send_seconds = histogram("chat_send_seconds", "Time spent sending one frame on the socket")
+broadcast_seconds = histogram("chat_broadcast_seconds", "Time to queue one event for every local connection in a room")
+rate_limited = counter("chat_rate_limited_total", "Events rejected by the rate limiter", ("event_type",))
+sessions_resumed = counter("chat_sessions_resumed_total", "Reconnects with a resume token, by whether the missed events were replayed", ("outcome",))
+handshake_seconds = histogram("chat_handshake_seconds", "Time from accepting a WebSocket until the startup data was queued")
 
 class Storage:
-    def __init__(self):
-         # In-memory storage, maps room_name to the rooms' chat messages
-        self.chat_messages: Dict[str, List[Dict]] = { GLOBAL_ROOM_NAME: [] }
+    def __init__(self, history_max_messages: int = HISTORY_MAX_MESSAGES, history_max_bytes: int = HISTORY_MAX_BYTES,
+                 message_log: MessageLog | None = None, backplane: Backplane | None = None, shards: ShardPool | None = None,
+                 writers: WriterPool | None = None, spill: RoomSpill | None = None, room_idle_ttl: float = 0.0):
+        self.history_max_messages = history_max_messages
+        self.history_max_bytes = history_max_bytes
+        # In-memory storage, maps room_name to the rooms' bounded chat history
+        self.chat_messages: Dict[str, RoomHistory] = {}
+        # Histories are written by the room shards and read by HTTP requests on the server's loop
+        self.lock = threading.RLock()
         # Maps room_name to the rooms' WebSocketManager
         self.managers: Dict[str, WebSocketManager] = {}
-        self.all_users: Dict[str, Any] = {}
+        # Rooms unused for room_idle_ttl seconds are evicted, their history spilled to disk. They stay
+        # in the directory and are brought back by get_manager() and get_history(), after
+        # restore_room() has read their history off the event loop.
+        self.room_idle_ttl = room_idle_ttl
+        self.spill = spill or RoomSpill()
+        # room_name -> monotonic time its history or connections were last used
+        self.room_activity: Dict[str, float] = {}
+        self.users = UserRegistry()
+        # Registered accounts, shared by all rooms, and the session tokens of logged in users
+        self.user_database = UserDatabase()
+        self.sessions = SessionCache()
+        # Resume tokens of connections, a reconnect gets its username back and the events it missed
+        self.resumes = ResumeSessions()
+        # Rooms and their users across all workers, built from the room events of the backplane
+        self.directory = RoomDirectory()
+        self.search_index = SearchIndex()
+        self.rate_limiter = rate_limiter_from_env()
+        # Room events are delivered on the shard of their room
+        self.shards = shards or ShardPool()
+        # Sockets are written by shared writer tasks when enabled, see WebSocketConnection
+        self.writers = writers or WriterPool()
+        # Connections being cleaned up, waited for before the shards are stopped
+        self.cleanups: set[asyncio.Task] = set()
+        # Every room event goes through the backplane, so that all workers deliver it
+        self.backplane = backplane or InProcessBackplane()
+        self.backplane.set_handler(self.deliver)
+        # Optional durable storage, the in-memory history is a cache of its newest messages
+        self.message_log = message_log
+        if message_log:
+            self.restore_from_log()
 
-    def is_username_taken(self, username: str) -> bool:
-        return username in self.all_users
+    def restore_from_log(self):
+        self.user_database.restore(self.message_log.load_users())
+        rooms = self.message_log.load_rooms(self.history_max_messages)
+        for room_name, (creator, next_seq, messages) in rooms.items():
+            self.get_history(room_name).restore(messages, next_seq)
+            for message in messages:
+                self.search_index.add(room_name, message)
+            (manager, _) = self.get_manager(room_name)
+            if creator:
+                manager.creator = creator
+                self.directory.set_creator(room_name, creator)
+        storage_log.info("Restored %d rooms from %s", len(rooms), self.message_log.path)
+    def flush(self):
+        if self.message_log:
+            self.message_log.flush()
+
+    async def reserve_username(self, username: str) -> bool:
+        """Claims the username on every worker, returns False if it is already taken"""
+        if not self.users.claim(username):
+            return False
+        if not await self.backplane.reserve(USERNAME_NAMESPACE, username):
+            self.users.release(username)
+            return False
+        return True
     def add_user(self, user: Any):
-        self.all_users[user.username] = user
+        self.users.add(user)
         return user
-    def remove_user(self, username: str):
-        if username in self.all_users:
-            self.all_users.pop(username)
-
-    def get_chat_messages(self, room_name: str):
-        if room_name not in self.chat_messages:
-            self.chat_messages[room_name] = []
-        return self.chat_messages[room_name]
-    def add_to_chat(self, room_name: str, message: Dict):
-        if room_name not in self.chat_messages:
-            self.chat_messages[room_name] = []
-        self.chat_messages[room_name].append(message)
+    async def remove_user(self, username: str, connection: Any = None):
+        """Gives back the username, only if it still belongs to connection when one is given"""
+        if self.users.release(username, connection):
+            await self.backplane.release(USERNAME_NAMESPACE, username)
+    def hold_username(self, token: str):
+        """Keeps the username of a resumable connection that went away for the grace period"""
+        asyncio.get_running_loop().call_later(self.resumes.grace, lambda: self.track_cleanup(self.expire_resume(token)))
+    async def expire_resume(self, token: str):
+        session = self.resumes.expire(token)
+        if session:
+            await self.remove_user(session.username)
+
+    async def is_registered(self, username: str) -> bool:
+        if username in self.user_database:
+            return True
+        # Another worker may have registered it
+        if self.message_log:
+            password_hash = await asyncio.to_thread(self.message_log.read_user, username)
+            if password_hash:
+                self.user_database.restore([(username, password_hash)])
+                return True
+        return False
+    async def register(self, username: str, password: str):
+        """Raises ValueError if the username is registered and AuthBusy if too many passwords are
+        being hashed"""
+        if await self.is_registered(username):
+            raise ValueError(f"User {username} already exists")
+        password_hash = await self.user_database.add_user(username, password)
+        if self.message_log:
+            self.message_log.add_user(username, password_hash)
+    async def login(self, username: str, password: str) -> bool:
+        return await self.is_registered(username) and await self.user_database.check_user(username, password)
+
+    def track_cleanup(self, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self.cleanups.add(task)
+        task.add_done_callback(self.cleanups.discard)
+        return task
+    async def wait_for_cleanups(self):
+        while self.cleanups:
+            await asyncio.wait(list(self.cleanups))
+
+    async def deliver(self, room_name: str | None, frame: EncodedEvent | List[EncodedEvent]):
+        """Backplane handler, delivers an event to the local connections of a room (or of every
+        room if room_name is None)"""
+        if isinstance(frame, list):
+            # A batch of chat messages of one room, see WebSocketManager.server_broadcast_batch()
+            await self.restore_room(room_name)
+            (manager, _) = self.get_manager(room_name)
+            await self.shards.run(room_name, manager.deliver_batch(frame))
+            return
+        if isinstance(frame.event, WsRoomCreate):
+            # Rooms created on other workers must exist here as well
+            (manager, _) = self.get_manager(frame.event.room.room_name)
+            if manager.creator == ROOM_CREATOR_PENDING:
+                manager.creator = frame.event.room.room_creator
+                self.directory.set_creator(manager.room_name, manager.creator)
+        elif isinstance(frame.event, WsRoomChatClear):
+            # Applied on every worker, so their histories and sequence numbers stay the same
+            self.clear_chat(frame.event.room_name)
+        if room_name is None:
+            await broadcast_all_rooms(self.managers, frame)
+            return
+        # Managers are only created on the server's loop
+        await self.restore_room(room_name)
+        (manager, _) = self.get_manager(room_name)
+        await self.shards.run(room_name, self.deliver_to_room(manager, frame))
+
+    async def deliver_to_room(self, manager: "WebSocketManager", frame: EncodedEvent):
+        room_name = manager.room_name
+        await manager.deliver(frame)
+        # Joins and leaves arrive from every worker, so the directory covers the whole cluster
+        if isinstance(frame.event, WsUserJoinEvent):
+            await self.push_room_update(self.directory.join(room_name, frame.event.username))
+        elif isinstance(frame.event, WsUserLeaveEvent):
+            await self.push_room_update(self.directory.leave(room_name, frame.event.username))
+
+    async def push_room_update(self, update: WsRoomUsersUpdate | None):
+        if update is None:
+            return
+        frame = EncodedEvent(update)
+        for user in self.users.subscribers():
+            await user.queue_message(frame)
+
+    def get_history(self, room_name: str) -> RoomHistory:
+        with self.lock:
+            history = self.chat_messages.get(room_name)
+            if history is None:
+                history = self.restore_history(room_name)
+            self.room_activity[room_name] = time.monotonic()
+            return history
+    async def restore_room(self, room_name: str):
+        """Brings back the history of an evicted room, read from disk off the event loop. Called
+        before a room is used, get_history() would otherwise read it on the loop under the lock."""
+        if room_name in self.chat_messages or room_name not in self.spill:
+            return
+        loaded = await asyncio.to_thread(self.spill.load, room_name)
+        with self.lock:
+            if room_name not in self.chat_messages:
+                self.restore_history(room_name, loaded)
+    def restore_history(self, room_name: str, loaded: Tuple | None = None) -> RoomHistory:
+        """Creates the history of a room, with the spilled messages if it was evicted"""
+        history = self.chat_messages[room_name] = RoomHistory(self.history_max_messages, self.history_max_bytes)
+        spilled = self.spill.take(room_name, loaded)
+        if spilled:
+            history.restore(spilled[1], spilled[0])
+            room_log.info("Restored evicted room %s", room_name)
+        return history
+    def get_chat_messages(self, room_name: str) -> List[Dict]:
+        with self.lock:
+            return self.get_history(room_name).all()
+    def get_latest(self, room_name: str, count: int) -> Tuple[List[Dict], bool]:
+        with self.lock:
+            return self.get_history(room_name).latest(count)
+    def get_join_snapshot(self, room_name: str) -> EncodedEvent:
+        with self.lock:
+            return self.get_history(room_name).get_join_snapshot()
+    def get_messages_body(self, room_name: str) -> bytes:
+        with self.lock:
+            return self.get_history(room_name).get_http_body()
+    def get_messages_etag(self, room_name: str) -> str:
+        with self.lock:
+            return self.get_history(room_name).etag()
+    def get_entries_after(self, room_name: str, after_seq: int, limit: int) -> Tuple[List[Tuple], bool]:
+        with self.lock:
+            return self.get_history(room_name).entries_after(after_seq, limit)
+    async def get_page_after(self, room_name: str, after_seq: int, limit: int) -> Tuple[List[Tuple], bool]:
+        """Like get_entries_after, but messages evicted from memory come from the log"""
+        with self.lock:
+            history = self.get_history(room_name)
+            first_seq = history.first_seq()
+            if not self.message_log or after_seq >= first_seq - 1:
+                return history.entries_after(after_seq, limit)
+        # Read off the event loop, the rest of the page comes from memory
+        (older, has_more) = await asyncio.to_thread(self.message_log.read_after, room_name, after_seq, first_seq, limit)
+        entries = [make_entry(m["seq"], m["username"], m["message"], m["timestamp"]) for m in older]
+        if has_more:
+            return (entries, True)
+        (newer, has_more) = self.get_entries_after(room_name, max(after_seq, first_seq - 1), limit - len(entries))
+        return (entries + newer, has_more)
+    async def get_history_page(self, room_name: str, before_seq: int, limit: int) -> Tuple[List[Dict], bool]:
+        with self.lock:
+            history = self.get_history(room_name)
+            (messages, has_more) = history.before(before_seq, limit)
+            cursor = min(before_seq, history.first_seq())
+        # Messages evicted from memory are still available in the log, read off the event loop
+        if self.message_log and not has_more:
+            (older, has_more) = await asyncio.to_thread(self.message_log.read_before, room_name, cursor, limit - len(messages))
+            messages = older + messages
+        return (messages, has_more)
+    def add_to_chat(self, room_name: str, message: Dict) -> Dict:
+        with self.lock:
+            message = self.get_history(room_name).append(message)
+            # Under the lock as well, so a clear can not slip in between history and index
+            self.search_index.add(room_name, message)
+            # Under the lock so the log sees the messages of a room in seq order
+            if self.message_log:
+                self.message_log.append(room_name, message)
+        return message
+    def add_many_to_chat(self, room_name: str, messages: List[Dict]) -> List[Dict]:
+        with self.lock:
+            messages = self.get_history(room_name).extend(messages)
+            for message in messages:
+                self.search_index.add(room_name, message)
+                if self.message_log:
+                    self.message_log.append(room_name, message)
+        return messages
     def clear_chat(self, room_name: str):
-        self.chat_messages[room_name] = []
+        with self.lock:
+            history = self.get_history(room_name)
+            history.clear()
+            self.search_index.clear_room(room_name)
+            if self.message_log:
+                self.message_log.truncate(room_name, history.next_seq)
 
     def get_manager(self, room_name: str):
         room_is_new = False
         if room_name not in self.managers:
-            self.managers[room_name] = WebSocketManager(room_name, UserDatabase())
-            room_is_new = True
-            print(f"Created new room: {room_name}")
+            manager = self.managers[room_name] = WebSocketManager(room_name)
+            if room_name in self.directory:
+                # An evicted room, its directory entry was kept
+                manager.creator = self.directory.get_creator(room_name) or ROOM_CREATOR_PENDING
+                room_log.info("Restoring evicted room: %s", room_name)
+            else:
+                self.directory.add_room(room_name, ROOM_CREATOR_PENDING)
+                room_is_new = True
+                room_log.info("Created new room: %s", room_name)
+        self.room_activity[room_name] = time.monotonic()
         return (self.managers[room_name], room_is_new)
+    def room_exists(self, room_name: str) -> bool:
+        return room_name in self.managers or room_name in self.directory
+    def touch_room(self, room_name: str):
+        self.room_activity[room_name] = time.monotonic()
+
+    def evict_idle_rooms(self, now: float) -> List[str]:
+        """Evicts the rooms that had no connections, listeners or activity for room_idle_ttl
+        seconds, returns their names. Runs on the server's loop, where managers are created."""
+        evicted = []
+        for room_name in list(self.managers.keys() | self.chat_messages.keys()):
+            if room_name == GLOBAL_ROOM_NAME or now - self.room_activity.get(room_name, now) < self.room_idle_ttl:
+                continue
+            manager = self.managers.get(room_name)
+            if manager and (manager.websockets or manager.listeners or manager.pending_joins or manager.presence
+                            or room_name in typing_rooms or room_name in presence_rooms):
+                continue
+            self.evict_room(room_name)
+            evicted.append(room_name)
+        return evicted
+    def evict_room(self, room_name: str):
+        """Drops the manager and history of a room. The history of a room in the directory is
+        spilled, others are only histories that were read for a name no room ever had."""
+        self.managers.pop(room_name, None)
+        with self.lock:
+            history = self.chat_messages.pop(room_name, None)
+            self.room_activity.pop(room_name, None)
+            if room_name in self.directory:
+                self.spill.add(room_name, history.next_seq if history else 1, list(history.entries) if history else [])
+        room_log.info("Evicted idle room %s", room_name)
+    def set_room_creator(self, manager: "WebSocketManager", creator: str):
+        manager.creator = creator
+        self.directory.set_creator(manager.room_name, creator)
+        if self.message_log:
+            self.message_log.add_room(manager.room_name, creator)
+
+async def send_event(websocket: WebSocket, codec: EventCodec, event: WsEvent):
+    """Sends an event directly on the socket, bypassing the delivery queue"""
+    frame = codec.encode(event)
+    if codec.binary:
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+async def receive_handshake_event(websocket: WebSocket, codec: EventCodec) -> WsEvent | None:
+    frame = await receive_frame(websocket)
+    if not frame:
+        return None
+    try:
+        return codec.decode(frame)
+    except ValueError as e:
+        connection_log.info("Invalid connection request: %s", e)
+        await send_event(websocket, codec, WsConnectionReject(response=f"Invalid request {e}"))
+        return None
 
-storage = Storage()
+async def receive_frame(websocket: WebSocket) -> str | bytes:
+    """Receives the next text or binary frame"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes") or ""
 
 class WebSocketConnection:
-    def __init__(self, websocket: WebSocket, uuid: str, username: str, broadcast_func: Callable):
+    # Slots instead of an instance dict, there can be 100k+ of these and most of them are idle
+    __slots__ = ("websocket", "codec", "features", "batching", "room_updates", "presence_sync", "presence_since", "resumable", "resume_token",
+                 "resume_from", "replayed", "user_uuid", "username", "room_name", "address", "rate_limited", "loop", "delivery_queue",
+                 "sender_task", "scheduled", "closed", "join_time")
+
+    def __init__(self, websocket: WebSocket, uuid: str, username: str, room_name: str, codec: EventCodec = DEFAULT_CODEC, features: List[str] = [],
+                 overflow_policy: str = DEFAULT_OVERFLOW_POLICY):
         self.websocket = websocket
+        self.codec = codec
+        self.features = features
+        self.batching = FEATURE_BATCH in features
+        self.room_updates = FEATURE_ROOM_UPDATES in features
+        self.presence_sync = FEATURE_PRESENCE in features
+        # (epoch, version) of the presence the client holds of the room it joins next
+        self.presence_since: Tuple[str | None, int | None] = (None, None)
+        # Resumable connections get SequencedEvents of their room
+        self.resumable = FEATURE_RESUME in features
+        self.resume_token: str | None = None
+        # The last event_seq the client saw when resuming, and whether the events after it were
+        # replayed instead of the room's history and user list
+        self.resume_from: int | None = None
+        self.replayed = False
         self.user_uuid = uuid
         self.username = username
-        self.broadcast_func = broadcast_func
+        self.room_name = room_name
+        self.address = websocket.client.host if websocket.client else None
+        # Event types the client was told it is sending too many of, until one gets through
+        self.rate_limited: set[str] = set()
 
-        self.delivery_queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
-        self.sender_task = asyncio.create_task(self.sender_loop())
+        # Room shards queue events from their own threads, the sender runs on this loop. Either
+        # the shared writers send the events, or a sender task of the connection's own.
+        self.loop = asyncio.get_running_loop()
+        self.scheduled = False
         self.closed = False
+        if storage.writers.running_on(self.loop):
+            self.delivery_queue = DeliveryQueue(codec, QUEUE_MAX_SIZE, QUEUE_MAX_BYTES, overflow_policy, self.loop, self.schedule)
+            self.sender_task = None
+        else:
+            self.delivery_queue = DeliveryQueue(codec, QUEUE_MAX_SIZE, QUEUE_MAX_BYTES, overflow_policy, self.loop)
+            self.sender_task = asyncio.create_task(self.sender_loop())
         self.join_time = datetime.now()
 
     def id(self) -> str:
         return f"'{self.username}' ({self.user_uuid})"
 
+    async def broadcast(self, message: WsEvent):
+        """Broadcasts to the room the connection is currently in"""
+        await storage.managers[self.room_name].broadcast(self, message)
+
     async def sender_loop(self):
         try:
             while True:
-                message_json = await self.delivery_queue.get()
-                try:
-                    await self.websocket.send_text(message_json)
-                finally:
-                    self.delivery_queue.task_done()
+                items = [await self.delivery_queue.get()]
+                if self.batching:
+                    await self.collect_batch(items)
+                await self.send_items(items)
         except asyncio.CancelledError:
-            print("Sender loop cancelled")
+            connection_log.debug("Sender loop cancelled", user_uuid=self.user_uuid)
         except Exception as e:
-            print(f"Error sending message: {e}")
+            connection_log.warning("Error sending message: %s", e, user_uuid=self.user_uuid)
         finally:
-            print(f"Sender loop finished for {self.id()}")
+            connection_log.debug("Sender loop finished for %s", self.username, user_uuid=self.user_uuid)
+
+    def schedule(self):
+        # Called on the server's loop whenever an event is queued. The flush window starts with
+        # the first event, the ones queued until the writer gets to the connection join its batch.
+        storage.writers.schedule(self, BATCH_FLUSH_WINDOW_SECONDS if self.batching else 0.0)
+
+    async def write_pending(self) -> bool:
+        """Sends what is queued, as one batch if the client takes them. Called by the shared
+        writers, returns whether there is more to send."""
+        if self.delivery_queue.empty():
+            return False
+        items = [self.delivery_queue.get_nowait()]
+        if self.batching:
+            size = items[0][2]
+            while len(items) < BATCH_MAX_EVENTS and size < BATCH_MAX_BYTES and not self.delivery_queue.empty():
+                items.append(self.delivery_queue.get_nowait())
+                size += items[-1][2]
+        try:
+            # A writer serves many connections, one that stopped reading must not keep it waiting
+            async with asyncio.timeout(WRITER_SEND_TIMEOUT_SECONDS):
+                await self.send_items(items)
+        except TimeoutError:
+            connection_log.warning("Send timed out, closing connection for %s", self.username, user_uuid=self.user_uuid)
+            slow_consumer_disconnects.inc()
+            asyncio.ensure_future(self.close())
+            return False
+        except Exception as e:
+            # Same as a sender loop ending, nothing more is sent until the receive loop notices the
+            # socket is gone
+            connection_log.warning("Error sending message: %s", e, user_uuid=self.user_uuid)
+            self.delivery_queue.notify = lambda: None
+            return False
+        return not self.delivery_queue.empty()
+
+    async def send_items(self, items: List):
+        if len(items) == 1:
+            data = items[0][0].encode(self.codec)
+        else:
+            data = self.codec.encode_batch([frame.encode(self.codec.batch_codec) for (frame, _, _) in items])
+        started = time.perf_counter()
+        for (frame, queued_at, _) in items:
+            enqueue_to_send_seconds.observe(started - queued_at)
+            events_sent.labels(frame.event.event_type).inc()
+        if self.codec.binary:
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+        send_seconds.observe(time.perf_counter() - started)
+        bytes_sent.inc(len(data))
+
+    async def collect_batch(self, items: List):
+        """Adds queued events to items until the batch limits or the flush window are reached"""
+        size = items[0][2]
+        deadline = time.perf_counter() + BATCH_FLUSH_WINDOW_SECONDS
+        while len(items) < BATCH_MAX_EVENTS and size < BATCH_MAX_BYTES:
+            if self.delivery_queue.empty():
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return
+                try:
+                    item = await asyncio.wait_for(self.delivery_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    return
+            else:
+                item = self.delivery_queue.get_nowait()
+            items.append(item)
+            size += item[2]
 
     async def receive_loop(self) -> None | WsRoomSwitchRequest:
         try:
             while True:
-                user_msg = await self.websocket.receive_text()
+                user_msg = await receive_frame(self.websocket)
                 if not user_msg:
-                    print(f"Received empty message from {self.id()}, ignoring")
+                    connection_log.debug("Received empty message from %s, ignoring", self.username, user_uuid=self.user_uuid)
+                    continue
+                # Before the frame is decoded, so a flood of large valid events costs one bucket
+                # check per frame and not a full validation
+                if await self.rate_limit(RATE_LIMIT_FRAME, per_user=False):
                     continue
 
                 try:
-                    user_msg = TypeAdapter(WsEvent).validate_json(user_msg)
-                except ValidationError as e:
-                    print(f"Invalid message {e}")
-                    await self.websocket.send_text(
+                    user_msg = self.codec.decode(user_msg)
+                    events_received.labels(user_msg.event_type).inc()
+                except ValueError as e:
+                    if await self.rate_limit("invalid"):
+                        continue
+                    connection_log.info("Invalid message from %s: %s", self.username, e, user_uuid=self.user_uuid)
+                    await self.send_event(
                         WsSystemMessage(
                             message="Invalid message format",
                             severity="error"
-                        ).model_dump_json()
+                        )
                     )
                     continue
+                # Before anything is handled or broadcast, each event type has a budget of its own
+                if await self.rate_limit(user_msg.event_type):
+                    continue
 
                 if isinstance(user_msg, WsMessage):
                     if user_msg.username == self.username:
                         await self.send_message(user_msg)
                     else:
-                        await self.broadcast_func(self, WsSystemMessage(message=f"{self.username} tried sending a message as {user_msg.username}. They're not getting away with it!", severity="warning"))
+                        await self.broadcast(WsSystemMessage(message=f"{self.username} tried sending a message as {user_msg.username}. They're not getting away with it!", severity="warning"))
                 elif isinstance(user_msg, WsTypingEvent):
                     if user_msg.username == self.username:
-                        await self.broadcast_func(self, user_msg)
+                        await self.broadcast(user_msg)
                     else:
-                        await self.broadcast_func(self, WsSystemMessage(message=f"{self.username} tried typing as {user_msg.username}. They're not getting away with it!", severity="warning"))
+                        await self.broadcast(WsSystemMessage(message=f"{self.username} tried typing as {user_msg.username}. They're not getting away with it!", severity="warning"))
                 elif isinstance(user_msg, WsRoomSwitchRequest):
                     return user_msg
+                elif isinstance(user_msg, WsHistoryRequest):
+                    limit = min(max(user_msg.limit, 0), HISTORY_PAGE_MAX_SIZE)
+                    (messages, has_more) = await storage.get_history_page(self.room_name, user_msg.before_seq, limit)
+                    await self.queue_message(EncodedEvent(WsHistoryPage(room_name=self.room_name, messages=messages, has_more=has_more)))
+                elif isinstance(user_msg, WsSearchRequest):
+                    (results, next_cursor) = storage.search_index.search(user_msg.query, None if user_msg.all_rooms else self.room_name,
+                        user_msg.username, user_msg.since, user_msg.until, user_msg.before_id, user_msg.limit)
+                    await self.queue_message(EncodedEvent(WsSearchResults(query=user_msg.query, results=results, next_cursor=next_cursor)))
                 elif isinstance(user_msg, WsRoomCreate):
                     room_validation = validate_room_name(user_msg.room.room_name)
                     if room_validation  != "":
-                        await self.websocket.send_text(WsRoomCreateReject(response=f"{self.username} tried creating a room with an invalid name: {room_validation}").model_dump_json())
+                        await self.send_event(WsRoomCreateReject(response=f"{self.username} tried creating a room with an invalid name: {room_validation}"))
                         continue
                     (_, room_is_new) = await create_and_broadcast_new_room(user_msg.room.room_name, self.username)
                     if not room_is_new:
-                        await self.websocket.send_text(WsRoomCreateReject(response=f"{self.username} tried creating a room that already exists!").model_dump_json())
+                        await self.send_event(WsRoomCreateReject(response=f"{self.username} tried creating a room that already exists!"))
                 elif isinstance(user_msg, WsRoomChatClear):
                     if user_msg.room_name == GLOBAL_ROOM_NAME:
-                        await self.broadcast_func(self, WsSystemMessage(message=f"{self.username} tried clearing the global room!", severity="error"))
+                        await self.broadcast(WsSystemMessage(message=f"{self.username} tried clearing the global room!", severity="error"))
                         continue
-                    storage.clear_chat(user_msg.room_name)
-                    await self.broadcast_func(self, WsRoomChatClear(room_name=user_msg.room_name, username=self.username))
+                    # Cleared by every worker when the event comes back from the backplane
+                    await self.broadcast(WsRoomChatClear(room_name=user_msg.room_name, username=self.username))
                     if self.username != user_msg.username:
-                        await self.broadcast_func(self, WsSystemMessage(message=f"{self.username} tried clearing the chat as {user_msg.username}", severity="warning"))
+                        await self.broadcast(WsSystemMessage(message=f"{self.username} tried clearing the chat as {user_msg.username}", severity="warning"))
                 else:
-                    print(f"Got unhandled event: {user_msg}")
+                    connection_log.warning("Got unhandled event: %s", user_msg.event_type, user_uuid=self.user_uuid)
         except WebSocketDisconnect:
-            print(f"User {self.id()} disconnected, exiting receive_loop")
+            connection_log.debug("User %s disconnected, exiting receive_loop", self.username, user_uuid=self.user_uuid)
 
-    async def queue_message(self, message_json: str):
-        try:
-            self.delivery_queue.put_nowait(message_json)
-        except asyncio.QueueFull:
-            print(f"Message queue is full, closing connection for {self.id()}")
-            if not self.closed:
-                asyncio.create_task(self.close())
+    async def send_event(self, event: WsEvent):
+        await send_event(self.websocket, self.codec, event)
+
+    async def rate_limit(self, event_type: str, per_user: bool = True) -> bool:
+        """Returns True if the event has to be dropped. The client is told once, not for every
+        dropped event, until one gets through again."""
+        keys = [(SCOPE_CONNECTION, self.user_uuid)]
+        if per_user:
+            keys.append((SCOPE_USER, self.username))
+        if self.address:
+            keys.append((SCOPE_ADDRESS, self.address))
+        if not storage.rate_limiter.acquire(event_type, keys):
+            self.rate_limited.discard(event_type)
+            return False
+        rate_limited.labels(event_type).inc()
+        if event_type not in self.rate_limited:
+            self.rate_limited.add(event_type)
+            connection_log.info("Rate limiting %s events of %s", event_type, self.username, user_uuid=self.user_uuid)
+            await self.send_event(WsSystemMessage(message=f"Too many {event_type} events, slow down", severity="error"))
+        return True
+
+    async def queue_message(self, frame: EncodedEvent):
+        dropped_before = self.delivery_queue.dropped
+        accepted = self.delivery_queue.put(frame)
+        if self.delivery_queue.dropped != dropped_before:
+            events_dropped.inc(self.delivery_queue.dropped - dropped_before)
+        if not accepted:
+            self.queue_overflowed()
+
+    def queue_overflowed(self):
+        queue_full.inc()
+        connection_log.warning("Message queue is full, closing connection for %s", self.username, user_uuid=self.user_uuid)
+        if not self.closed:
+            slow_consumer_disconnects.inc()
+            # The overflow may happen on a room shard, the connection is closed on its own loop
+            self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.close()))
+
+    def free_slots(self) -> int:
+        return self.delivery_queue.free_slots()
+
+    async def queue_messages(self, frames: List[EncodedEvent]):
+        dropped_before = self.delivery_queue.dropped
+        accepted = self.delivery_queue.put_many(frames)
+        if self.delivery_queue.dropped != dropped_before:
+            events_dropped.inc(self.delivery_queue.dropped - dropped_before)
+        if not accepted:
+            self.queue_overflowed()
 
     async def send_message(self, user_msg: WsMessage):
         if len(user_msg.message) > MAX_MESSAGE_LENGTH:
-            await self.websocket.send_text(WsSystemMessage(message="Message too long, I refuse to broadcast this", severity="error").model_dump_json())
+            await self.send_event(WsSystemMessage(message="Message too long, I refuse to broadcast this", severity="error"))
             return
 
-        print(f"Received message from {self.id()}: {user_msg}")
-        await self.broadcast_func(self, user_msg)
+        broadcast_log.debug("Received message from %s", self.username, user_uuid=self.user_uuid, length=len(user_msg.message))
+        await self.broadcast(user_msg)
 
     async def close(self):
         if self.closed:
-            print(f"Connection for {self.id()} already closed, skipping")
+            connection_log.debug("Connection for %s already closed, skipping", self.username, user_uuid=self.user_uuid)
             return
         self.closed = True
         try:
             # Broadcast that the user has left before closing anything
-            print(f"Closing connection for {self.id()} ")
-            await self.broadcast_func(self, WsUserLeaveEvent(username=self.username))
+            connection_log.debug("Closing connection for %s", self.username, user_uuid=self.user_uuid)
+            await self.broadcast(WsUserLeaveEvent(username=self.username))
 
-            if not self.sender_task.done():
+            if self.sender_task and not self.sender_task.done():
                 self.sender_task.cancel()
                 await self.sender_task
         except Exception as e:
-            print(f"Error closing websocket: {e}")
+            connection_log.warning("Error closing websocket: %s", e, user_uuid=self.user_uuid)
 
 class WebSocketManager:
-    def __init__(self, room_name: str, user_database: UserDatabase):
+    def __init__(self, room_name: str):
         self.websockets = {}
-        self.database = user_database
-        self.creator = "<IN PROGRESS>"
+        # Read-only Server-Sent Events subscribers, they are not users of the room
+        self.listeners: Dict[int, EventStreamListener] = {}
+        self.creator = ROOM_CREATOR_PENDING
         self.room_name = room_name
+        self.typing = RoomTypingState()
+        # Connections between get_manager() and add_connection(), the room is not evicted meanwhile
+        self.pending_joins = 0
+        # Versioned user list, built from the join and leave events of every worker
+        self.presence = RoomPresence()
+        # The newest events of the room, replayed to clients that resume
+        self.event_log = RoomEventLog()
 
-    async def setup_user(self, websocket: WebSocket):
+    async def setup_user(self, websocket: WebSocket, codec: EventCodec = DEFAULT_CODEC):
+        # 0. The client may register or log in first
+        # 0.1 The server will send a confirmation/rejection with a session token
         # 1. A connection request must be sent from client client
         # 1.1 The server will send a confirmation/rejection
         # 2. The client may now send messages
         # 2.1 The server will broadcast messages to all users
 
-        userConnectionReq = await websocket.receive_text()
-        if not userConnectionReq:
-            return None
-        try:
-            userConnectionReq = WsConnectionRequest.model_validate_json(userConnectionReq)
-        except ValidationError as e:
-            print(f"userConnectionReq {e}")
-            await websocket.send_text(WsConnectionReject(response=f"Invalid request {e}").model_dump_json())
-            return None
-        if not await self.validate_username(websocket, userConnectionReq.username):
+        userConnectionReq = await receive_handshake_event(websocket, codec)
+        authenticated = None
+        if isinstance(userConnectionReq, (WsRegisterRequest, WsLoginRequest)):
+            authenticated = await self.authenticate(websocket, codec, userConnectionReq)
+            if authenticated is None:
+                return None
+            userConnectionReq = await receive_handshake_event(websocket, codec)
+        if not isinstance(userConnectionReq, WsConnectionRequest):
+            if userConnectionReq is not None:
+                await send_event(websocket, codec, WsConnectionReject(response=f"Expected a connection request, got {userConnectionReq.event_type}"))
             return None
-
         username = userConnectionReq.username.strip()
+        if authenticated is not None and username != authenticated:
+            await send_event(websocket, codec, WsConnectionReject(response=f"Logged in as {authenticated}"))
+            return None
+        features = [feature for feature in userConnectionReq.features if feature in SUPPORTED_FEATURES]
+        # A resumed session still holds its username, which was checked when it was first taken
+        session = None
+        if userConnectionReq.resume_token and FEATURE_RESUME in features:
+            session = await resume_session(userConnectionReq.resume_token, username)
+        if session is None:
+            if authenticated is None and await storage.is_registered(username):
+                await send_event(websocket, codec, WsConnectionReject(response="Username is registered, log in to use it"))
+                return None
+            if not await self.validate_username(websocket, codec, username):
+                return None
 
-        broadcast_func = lambda user, message : self.broadcast(user, message)
         # Give this user a UUID
-        user = WebSocketConnection(websocket, str(uuid.uuid4()), username, broadcast_func)
-        self.websockets[user.user_uuid] = user
+        user = WebSocketConnection(websocket, str(uuid.uuid4()), username, self.room_name, codec, features,
+            userConnectionReq.overflow_policy or DEFAULT_OVERFLOW_POLICY)
+        user.presence_since = (userConnectionReq.presence_epoch, userConnectionReq.presence_version)
+        if user.resumable:
+            user.resume_token = storage.resumes.issue(user)
+        # The missed events can only be replayed from the log of the room the client was in
+        if session and session.room_name == self.room_name:
+            user.resume_from = userConnectionReq.last_event_seq
+        await storage.shards.run(self.room_name, self.add_connection(user))
+        if session:
+            sessions_resumed.labels("replayed" if user.replayed else "snapshot").inc()
         storage.add_user(user)
 
         return user
 
-    async def send_startup_data(self, user: WebSocketConnection, managers: Dict[str, Any]):
-        print(f"User '{user.username}' connected, sending startup data")
-        await self.send_connection_response(user)
-        await self.send_rooms(user, managers)
+    async def authenticate(self, websocket: WebSocket, codec: EventCodec, request: WsRegisterRequest | WsLoginRequest) -> str | None:
+        """Returns the username once registered or logged in, the password is hashed off the loop"""
+        username = request.username.strip()
+        reject = WsRegisterReject if isinstance(request, WsRegisterRequest) else WsLoginReject
+        if websocket.client and storage.rate_limiter.acquire(request.event_type, [(SCOPE_ADDRESS, websocket.client.host)]):
+            rate_limited.labels(request.event_type).inc()
+            await send_event(websocket, codec, reject(response="Too many attempts, try again later"))
+            return None
+        try:
+            if isinstance(request, WsRegisterRequest):
+                problem = validate_username_format(username) or validate_password(request.password)
+                if problem:
+                    await send_event(websocket, codec, reject(response=problem))
+                    return None
+                await storage.register(username, request.password)
+                connection_log.info("Registered '%s'", username)
+                response = WsRegisterResponse(response="Registered", session_token=storage.sessions.issue(username))
+            elif request.session_token is not None:
+                # Reconnects skip bcrypt
+                if not storage.sessions.resume(username, request.session_token):
+                    await send_event(websocket, codec, reject(response="Session expired, log in again"))
+                    return None
+                response = WsLoginResponse(response="Logged in", session_token=request.session_token)
+            else:
+                if request.password is None or validate_password(request.password) or not await storage.login(username, request.password):
+                    connection_log.info("Failed login for '%s'", username[0:MAX_USERNAME_LENGTH])
+                    await send_event(websocket, codec, reject(response="Invalid username or password"))
+                    return None
+                response = WsLoginResponse(response="Logged in", session_token=storage.sessions.issue(username))
+        except ValueError as e:
+            await send_event(websocket, codec, reject(response=str(e)))
+            return None
+        except AuthBusy:
+            connection_log.warning("Too many passwords being hashed, rejecting '%s'", username[0:MAX_USERNAME_LENGTH])
+            await send_event(websocket, codec, reject(response="Server is busy, try again later"))
+            return None
+        await send_event(websocket, codec, response)
+        return username
+
+    # The members of a room are only changed on the room's shard, where they are also delivered to
+    async def add_connection(self, user: WebSocketConnection):
+        if user.resume_from is not None:
+            # Replayed and subscribed on the room's shard without a pause, so no event is missed
+            # or sent twice in between. More than the queue holds is not worth replaying.
+            events = self.event_log.since(user.resume_from, user.free_slots())
+            user.resume_from = None
+            if events is not None:
+                if user.presence_sync:
+                    # They catch up with a presence delta instead
+                    events = [event for event in events if not isinstance(event.event, (WsUserJoinEvent, WsUserLeaveEvent))]
+                user.replayed = True
+                # Queued from here, it has to be ahead of the replay when the room is on a shard
+                await self.send_connection_response(user)
+                await user.queue_messages(events)
+        self.websockets[user.user_uuid] = user
+    async def remove_connection(self, user: WebSocketConnection):
+        self.websockets.pop(user.user_uuid, None)
+        storage.touch_room(self.room_name)
+
+    async def add_listener(self, listener: EventStreamListener, last_event_id: int | None):
+        """Queues the chat messages after last_event_id (the newest ones if None) and subscribes
+        the listener. Both happen on the room's shard without a pause, so no message is missed or
+        sent twice in between."""
+        next_seq = storage.get_history(self.room_name).next_seq
+        if last_event_id is None:
+            cursor = next_seq - 1 - JOIN_HISTORY_SIZE
+        else:
+            cursor = max(last_event_id, next_seq - 1 - EVENT_STREAM_REPLAY_MAX)
+        (entries, _) = storage.get_entries_after(self.room_name, cursor, EVENT_STREAM_REPLAY_MAX)
+        if entries:
+            listener.push(event_stream_replay(entries), replay=True)
+        self.listeners[listener.listener_id] = listener
+    def remove_listener(self, listener: EventStreamListener):
+        # A plain dict removal, deliveries only iterate over a copy
+        self.listeners.pop(listener.listener_id, None)
+        storage.touch_room(self.room_name)
+
+    async def send_startup_data(self, user: WebSocketConnection):
+        connection_log.info("User '%s' connected, sending startup data", user.username, user_uuid=user.user_uuid)
+        # A resumed connection already got it, with its replay
+        if not user.replayed:
+            await self.send_connection_response(user)
+        # The room creations were replayed, room_users updates were not
+        if not user.replayed or user.room_updates:
+            await self.send_rooms(user)
 
     async def join_chat(self, user: WebSocketConnection, shouldSendChatState: bool) -> None | WsRoomSwitchRequest:
-        print(f"User '{user.username}' connected, starting the WebSocket handler")
+        connection_log.debug("User '%s' joined %s", user.username, self.room_name, user_uuid=user.user_uuid)
         # Send past chats and notify other users that a new user has joined
         if shouldSendChatState:
-            await self.send_past_chats(user)
-            await self.send_online_users(user)
+            # A resumed client got what it missed instead, only on its first join
+            (replayed, user.replayed) = (user.replayed, False)
+            if not replayed:
+                await self.send_past_chats(user)
+            if user.presence_sync:
+                # The presence belongs to the room's shard
+                await storage.shards.run(self.room_name, self.send_presence(user))
+            elif not replayed:
+                await self.send_online_users(user)
             await self.broadcast(user, WsUserJoinEvent(username=user.username))
         return await user.receive_loop()
 
-    async def validate_username(self, user_websocket, username: str) -> bool:
+    async def validate_username(self, user_websocket, codec: EventCodec, username: str) -> bool:
         if username_too_long(username):
-            print(f"Username is too long: '{username[0:MAX_USERNAME_LENGTH]}'...")
-            await user_websocket.send_text(WsConnectionReject(response="Username is too long").model_dump_json())
+            connection_log.info("Username is too long: '%s'...", username[0:MAX_USERNAME_LENGTH])
+            await send_event(user_websocket, codec, WsConnectionReject(response="Username is too long"))
             return False
         # Checks that the username only contains valid characters
         if contains_invalid_characters(username):
-            print(f"Username contains invalid characters: '{username[0:MAX_USERNAME_LENGTH]}'...")
-            await user_websocket.send_text(WsConnectionReject(response="Username contains invalid characters").model_dump_json())
+            connection_log.info("Username contains invalid characters: '%s'...", username[0:MAX_USERNAME_LENGTH])
+            await send_event(user_websocket, codec, WsConnectionReject(response="Username contains invalid characters"))
             return False
-        if storage.is_username_taken(username):
-            print(f"Username '{username[0:MAX_USERNAME_LENGTH]}' is already taken")
-            await user_websocket.send_text(WsConnectionReject(response="Username is already taken").model_dump_json())
+        if not await storage.reserve_username(username):
+            connection_log.info("Username '%s' is already taken", username[0:MAX_USERNAME_LENGTH])
+            await send_event(user_websocket, codec, WsConnectionReject(response="Username is already taken"))
             return False
 
         return True
 
     async def send_connection_response(self, user: WebSocketConnection):
-        await user.queue_message(WsConnectionResponse(username=user.username, user_id=user.user_uuid).model_dump_json())
+        await user.queue_message(EncodedEvent(WsConnectionResponse(username=user.username, user_id=user.user_uuid, features=user.features,
+            resume_token=user.resume_token, resumed=user.replayed)))
     async def send_past_chats(self, sender: WebSocketConnection):
-        chats = storage.get_chat_messages(self.room_name).copy()
-        await sender.queue_message(WsMessageHistory(messages=chats).model_dump_json())
+        # Only the newest messages are sent, older ones can be paged in with WsHistoryRequest
+        # Shared by every joiner until a message is added or the room is cleared
+        await sender.queue_message(storage.get_join_snapshot(self.room_name))
     async def send_online_users(self, sender: WebSocketConnection):
         users = self.get_users_online()
         users = [user for user in users if user.username != sender.username]
-        await sender.queue_message(WsUsersOnline(users=users).model_dump_json())
-    async def send_rooms(self, sender: WebSocketConnection, managers: Dict[str, Any]):
-        rooms = gather_rooms(managers)
-        await sender.queue_message(WsAllRooms(rooms=rooms).model_dump_json())
+        await sender.queue_message(EncodedEvent(WsUsersOnline(users=users)))
+    async def send_presence(self, sender: WebSocketConnection):
+        """Only what changed since the version the client holds, or the full list"""
+        (epoch, since) = sender.presence_since
+        sender.presence_since = (None, None)
+        await sender.queue_message(EncodedEvent(self.presence.sync(epoch, since)))
+    async def send_rooms(self, sender: WebSocketConnection):
+        # Shared by every connection until the directory changes
+        await sender.queue_message(storage.directory.get_snapshot())
 
     async def broadcast(self, sender: WebSocketConnection, message: WsEvent):
-        print(f"Broadcasting event {message} from: {sender.username} ({sender.user_uuid})")
+        broadcast_log.debug("Broadcasting %s from %s", message.event_type, sender.username, room_name=self.room_name)
         await self.server_broadcast(message)
 
-    async def server_broadcast(self, message: WsEvent):
-        self.add_to_history(message=message)
+    async def server_broadcast(self, message: WsEvent | EncodedEvent):
+        # Serialize once, every recipient shares the same encoded frame
+        frame = message if isinstance(message, EncodedEvent) else EncodedEvent(message)
+        # Delivery happens when the event comes back from the backplane, on every worker
+        await storage.backplane.publish(self.room_name, frame)
+
+    async def server_broadcast_batch(self, messages: List[WsMessage]):
+        """Broadcasts chat messages together, they are stored and fanned out in one pass"""
+        await storage.backplane.publish_batch(self.room_name, [EncodedEvent(message) for message in messages])
+
+    async def deliver_batch(self, frames: List[EncodedEvent]):
+        timestamp = datetime.now().isoformat()
+        messages = storage.add_many_to_chat(self.room_name, [{"username": frame.event.username, "message": frame.event.message, "timestamp": timestamp}
+            for frame in frames])
+        sequenced = [self.event_log.append(frame) for frame in frames]
+        started = time.perf_counter()
+        if self.listeners:
+            text = event_stream_messages(messages)
+            for listener in list(self.listeners.values()):
+                listener.push(text)
+        broadcast_log.debug("Delivering a batch of %d messages to %d users", len(frames), len(self.websockets), room_name=self.room_name)
+        # Handed over a chunk at a time, waiting for the senders to make room in between, so a big
+        # batch does not overflow every delivery queue in the room
+        for start in range(0, len(frames), BULK_DELIVERY_CHUNK):
+            users = list(self.websockets.values())
+            # With room to spare, the events after the batch (e.g. the next room of a bulk send
+            # being created) must not overflow the queues it filled
+            await wait_for_queue_room(users, BULK_DELIVERY_CHUNK + BULK_DELIVERY_HEADROOM)
+            for user in users:
+                await user.queue_messages((sequenced if user.resumable else frames)[start:start + BULK_DELIVERY_CHUNK])
+        broadcast_seconds.observe(time.perf_counter() - started)
+
+    async def deliver(self, frame: EncodedEvent):
+        # Typing events only update the room's typing state, it is sent out by the typing tick
+        if isinstance(frame.event, WsTypingEvent):
+            self.typing.update(frame.event.username, frame.event.is_typing)
+            typing_rooms.add(self.room_name)
+            return
+        presence_change = False
+        if isinstance(frame.event, WsUserJoinEvent):
+            presence_change = True
+            if self.presence.join(frame.event.username, datetime.now().isoformat()):
+                presence_rooms.add(self.room_name)
+        elif isinstance(frame.event, WsUserLeaveEvent):
+            presence_change = True
+            self.typing.remove(frame.event.username)
+            typing_rooms.add(self.room_name)
+            if self.presence.leave(frame.event.username):
+                presence_rooms.add(self.room_name)
+        message = self.add_to_history(message=frame.event)
+        # Typing state is not worth replaying
+        sequenced = frame if frame.event.event_type in EPHEMERAL_EVENT_TYPES else self.event_log.append(frame)
 
+        started = time.perf_counter()
+        if self.listeners:
+            text = event_stream_frame(frame) if message is None else event_stream_messages([message])
+            for listener in list(self.listeners.values()):
+                listener.push(text)
         users = list(self.websockets.keys())
-        print(f"Broadcasting event {message} from: SERVER, to: {users}")
+        broadcast_log.debug("Delivering %s to %d users", frame.event.event_type, len(users), room_name=self.room_name)
         for user in users:
             if user not in self.websockets:
                 continue
             user = self.websockets[user]
-            print(f"Broadcasting message {message} to: {user.username} ({user.user_uuid})" )
-            await user.queue_message(message.model_dump_json())
+            # They get the batched WsPresenceDelta instead
+            if presence_change and user.presence_sync:
+                continue
+            delivery_log.debug("Delivering %s to %s", frame.event.event_type, user.username, user_uuid=user.user_uuid)
+            await user.queue_message(sequenced if user.resumable else frame)
+        broadcast_seconds.observe(time.perf_counter() - started)
 
-    def add_to_history(self, message: WsEvent):
+    def add_to_history(self, message: WsEvent) -> Dict | None:
+        """Stores chat messages, returns them with their sequence number"""
         if isinstance(message, WsMessage):
             new_message = {
                 "username": message.username,
                 "message": message.message,
                 "timestamp": datetime.now().isoformat()
             }
-            storage.add_to_chat(self.room_name, new_message)
+            return storage.add_to_chat(self.room_name, new_message)
+        return None
 
     def get_users_online(self) -> List[WsUserStatus]:
         users: List[WsUserStatus] = []
@@ -279,27 +982,52 @@ class WebSocketManager:
         return users
 
 
+async def event_stream(manager: WebSocketManager, last_event_id: int | None):
+    """Body of an SSE response, subscribed when the response starts and unsubscribed when the
+    client goes away or falls too far behind"""
+    listener = EventStreamListener(next(listener_ids))
+    await storage.shards.run(manager.room_name, manager.add_listener(listener, last_event_id))
+    event_stream_log.debug("Listener %d subscribed", listener.listener_id, room_name=manager.room_name)
+    try:
+        yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+        while (text := await listener.read()) is not None:
+            yield text
+        event_stream_log.info("Listener %d fell behind, closing its stream", listener.listener_id, room_name=manager.room_name)
+    finally:
+        manager.remove_listener(listener)
+
 async def ws_connect_user(websocket: WebSocket, room_name: str):
     user = None
     manager = None
+    started = time.perf_counter()
     try:
-        await websocket.accept()
+        # The client picks the wire format through the WebSocket subprotocol, JSON is the default
+        (codec, subprotocol) = negotiate_codec(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
         if validate_room_name(room_name) != "":
-            await websocket.send_text(WsConnectionReject(response=validate_room_name(room_name)).model_dump_json())
+            await send_event(websocket, codec, WsConnectionReject(response=validate_room_name(room_name)))
             return
+        await storage.restore_room(room_name)
         (manager, room_is_new) = storage.get_manager(room_name)
-        user = await manager.setup_user(websocket)
+        manager.pending_joins += 1
+        try:
+            room_is_new = room_is_new and await storage.backplane.reserve(ROOM_NAMESPACE, room_name)
+            user = await manager.setup_user(websocket, codec)
+        finally:
+            manager.pending_joins -= 1
         if not user:
             return
-        await manager.send_startup_data(user, storage.managers)
+        await manager.send_startup_data(user)
+        handshake_seconds.observe(time.perf_counter() - started)
         if room_is_new:
-            manager.creator = user.username
+            storage.set_room_creator(manager, user.username)
             await broadcast_new_room_all(storage.managers, room_name, user.username)
 
         shouldSendChatState = True
         while True:
             exit_reason = await manager.join_chat(user, shouldSendChatState)
             if isinstance(exit_reason, WsRoomSwitchRequest):
+                user.presence_since = (exit_reason.presence_epoch, exit_reason.presence_version)
                 newManager = await switch_room_for_user(user, manager.room_name, exit_reason.room_name)
                 if newManager:
                     manager = newManager
@@ -307,56 +1035,193 @@ async def ws_connect_user(websocket: WebSocket, room_name: str):
                 else:
                     shouldSendChatState = False
             else:
-                print(f"User '{user.username}' disconnected, exiting ws_connect_user")
+                connection_log.debug("User '%s' disconnected, exiting ws_connect_user", user.username, user_uuid=user.user_uuid)
                 return
     except Exception as e:
-        print(f"ws_connect_user: Connection error {e}")
+        connection_log.warning("Connection error: %s", e)
     finally:
         if user:
-            print(f"User '{user.username}' disconnected, cleaning up")
-            await user.close()
-            storage.remove_user(user.username)
-            if manager:
-                manager.websockets.pop(user.user_uuid)
+            # Shielded, a cancelled handler must still give back its username and room membership
+            await asyncio.shield(storage.track_cleanup(cleanup_connection(user, manager)))
 
+async def cleanup_connection(user: WebSocketConnection, manager: WebSocketManager | None):
+    connection_log.info("User '%s' disconnected, cleaning up", user.username, user_uuid=user.user_uuid)
+    await user.close()
+    if manager:
+        await storage.shards.run(manager.room_name, manager.remove_connection(user))
+    if user.resume_token and storage.resumes.detach(user.resume_token, user):
+        # Still claimed, the client may come back with its token
+        storage.users.hold(user.username)
+        storage.hold_username(user.resume_token)
+    else:
+        await storage.remove_user(user.username, user)
 
-def gather_rooms(managers: Dict[str, WebSocketManager]) -> List[RoomInfo]:
-    rooms: List[RoomInfo] = []
-    for room_name, manager in managers.items():
-        users = [user.username for user in manager.get_users_online()]
-        rooms.append(RoomInfo(room_name=room_name, room_creator=manager.creator, connected_users=users))
-    return rooms
+async def resume_session(token: str, username: str) -> ResumeSession | None:
+    """Takes over the session of a resume token, with its username reservation"""
+    session = storage.resumes.take(token, username)
+    # The grace period may have run out in the meantime
+    if session is None or not storage.users.hold(username):
+        return None
+    if session.connection is not None:
+        # The client came back before its old connection was noticed to be gone
+        await take_over_connection(session.connection)
+    return session
+
+async def take_over_connection(old: WebSocketConnection):
+    """Closes a connection whose client resumed on a new one. Its own cleanup then leaves the
+    username, which is held for the new connection, alone."""
+    old.resume_token = None
+    await old.close()
+    manager = storage.managers.get(old.room_name)
+    if manager:
+        await storage.shards.run(old.room_name, manager.remove_connection(old))
+    try:
+        await old.websocket.close()
+    except Exception as e:
+        connection_log.debug("Closing a resumed connection failed: %s", e, user_uuid=old.user_uuid)
+
+
+async def wait_for_queue_room(users: List[WebSocketConnection], count: int):
+    """Waits until the delivery queues of users have room for count more events. A queue that is
+    still too full after BULK_DRAIN_TIMEOUT_SECONDS is left to its overflow policy."""
+    deadline = time.monotonic() + BULK_DRAIN_TIMEOUT_SECONDS
+    while True:
+        users = [user for user in users if user.free_slots() < count]
+        if not users or time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(BULK_DRAIN_POLL_SECONDS)
 
 async def create_and_broadcast_new_room(room_name: str, username: str) -> Tuple[WebSocketManager, bool]:
     (manager, room_is_new) = storage.get_manager(room_name)
+    # Another worker may have created the same room at the same time
+    room_is_new = room_is_new and await storage.backplane.reserve(ROOM_NAMESPACE, room_name)
     if room_is_new:
-        manager.creator = username
+        storage.set_room_creator(manager, username)
         await broadcast_new_room_all(storage.managers, room_name, username)
     else:
-        print(f"Room {room_name} already exists")
+        room_log.debug("Room %s already exists", room_name)
     return (manager, room_is_new)
 
 async def broadcast_new_room_all(managers: Dict[str, WebSocketManager], room_name: str, username: str):
-    await broadcast_all_rooms(managers, WsRoomCreate(room=RoomInfo(room_name=room_name, room_creator=username, connected_users=[username])))
+    # Published once for all rooms, every worker delivers it with broadcast_all_rooms
+    await storage.backplane.publish(None, EncodedEvent(WsRoomCreate(room=RoomInfo(room_name=room_name, room_creator=username, connected_users=[username]))))
+
+async def broadcast_all_rooms(managers: Dict[str, WebSocketManager], message: WsEvent | EncodedEvent):
+    # The frame is shared by every room, so it is only encoded once
+    frame = message if isinstance(message, EncodedEvent) else EncodedEvent(message)
+    async def deliver_to_rooms(room_managers: List[WebSocketManager]):
+        for manager in room_managers:
+            await manager.deliver(frame)
+    # Each shard delivers to its own rooms, all shards at the same time
+    await storage.shards.run_grouped(list(managers.values()), lambda manager: manager.room_name, deliver_to_rooms)
+
+storage = Storage(message_log=message_log_from_env(), backplane=backplane_from_env(), shards=shard_pool_from_env(), writers=writer_pool_from_env(),
+    spill=room_spill_from_env(), room_idle_ttl=room_idle_ttl_from_env())
+listener_ids = itertools.count()
+# Rooms whose typing state has to be looked at by the typing tick
+typing_rooms: set[str] = set()
+
+async def flush_typing(now: float):
+    """Sends one WsTypingUsers frame to each room whose typing state changed, expiring stale flags"""
+    for room_name in list(typing_rooms):
+        manager = storage.managers.get(room_name)
+        if manager is None:
+            typing_rooms.discard(room_name)
+            continue
+        # The typing state belongs to the room's shard
+        if not await storage.shards.run(room_name, flush_room_typing(manager, now)):
+            typing_rooms.discard(room_name)
 
-async def broadcast_all_rooms(managers: Dict[str, WebSocketManager], message: WsEvent):
-    for room_name in managers:
-        await managers[room_name].server_broadcast(message)
+async def flush_room_typing(manager: WebSocketManager, now: float) -> bool:
+    """Returns whether the room still has typing state to look at"""
+    manager.typing.expire(now)
+    usernames = manager.typing.take_snapshot()
+    if usernames is not None:
+        # Every worker runs its own tick, so this goes to the local connections only
+        await manager.deliver(EncodedEvent(WsTypingUsers(usernames=usernames)))
+    return manager.typing.is_active()
+
+async def room_sweep_loop():
+    """Evicts idle rooms, then writes their histories to disk off the event loop"""
+    while True:
+        await asyncio.sleep(ROOM_SWEEP_INTERVAL_SECONDS)
+        try:
+            storage.evict_idle_rooms(time.monotonic())
+            await asyncio.to_thread(storage.spill.write_pending)
+        except Exception as e:
+            room_log.error("Room sweep failed: %s", e)
+
+# Rooms whose presence changed since their last WsPresenceDelta
+presence_rooms: set[str] = set()
+
+async def flush_presence():
+    """Sends the joins and leaves of each room since the last tick as one WsPresenceDelta"""
+    for room_name in list(presence_rooms):
+        presence_rooms.discard(room_name)
+        manager = storage.managers.get(room_name)
+        if manager is not None:
+            await storage.shards.run(room_name, flush_room_presence(manager))
+
+async def flush_room_presence(manager: WebSocketManager):
+    event = manager.presence.take_delta()
+    if event is None:
+        return
+    frame = EncodedEvent(event)
+    for user in list(manager.websockets.values()):
+        if user.presence_sync:
+            await user.queue_message(frame)
+
+async def room_tick_loop():
+    """Sends the typing state and presence deltas that changed since the last tick"""
+    while True:
+        await asyncio.sleep(TYPING_TICK_SECONDS)
+        try:
+            await flush_typing(time.monotonic())
+            await flush_presence()
+        except Exception as e:
+            room_log.error("Room tick failed: %s", e)
+
+# Computed when scraped, so keeping them costs nothing on the hot path
+gauge("chat_connections", "Connections per room", ("room",),
+    collect=lambda: {(name,): len(manager.websockets) for name, manager in storage.managers.items()})
+gauge("chat_resume_sessions", "Resume tokens of connected and recently disconnected clients",
+    collect=lambda: {(): len(storage.resumes)})
+gauge("chat_rooms_evicted", "Rooms whose history is spilled to disk until they are used again",
+    collect=lambda: {(): len(storage.spill)})
+gauge("chat_event_stream_listeners", "Server-Sent Events listeners per room", ("room",),
+    collect=lambda: {(name,): len(manager.listeners) for name, manager in storage.managers.items()})
+gauge("chat_delivery_queue_depth", "Events waiting in delivery queues per room", ("room",),
+    collect=lambda: {(name,): sum(user.delivery_queue.qsize() for user in list(manager.websockets.values())) for name, manager in storage.managers.items()})
+gauge("chat_delivery_queue_depth_max", "Deepest delivery queue per room", ("room",),
+    collect=lambda: {(name,): max((user.delivery_queue.qsize() for user in list(manager.websockets.values())), default=0) for name, manager in storage.managers.items()})
 
 async def switch_room_for_user(user: WebSocketConnection, old_room_name: str, new_room_name: str) -> WebSocketManager | None:
-    print(f"Attempting to switch user {user.username} from room {old_room_name} to {new_room_name}")
-    if new_room_name not in storage.managers:
-        print(f"Room {new_room_name} not found, failing room switch for user ")
-        await user.queue_message(WsRoomSwitchReject(response=f"Room {new_room_name} not found").model_dump_json())
+    room_log.debug("Attempting to switch user %s from room %s to %s", user.username, old_room_name, new_room_name)
+    if not storage.room_exists(new_room_name):
+        room_log.info("Room %s not found, failing room switch for user %s", new_room_name, user.username)
+        await user.queue_message(EncodedEvent(WsRoomSwitchReject(response=f"Room {new_room_name} not found")))
         return None
 
-    storage.managers[old_room_name].websockets.pop(user.user_uuid)
-    await storage.managers[old_room_name].broadcast(user, WsUserLeaveEvent(username=user.username))
+    old_manager = storage.managers[old_room_name]
+    # Brought back if it was evicted
+    await storage.restore_room(new_room_name)
+    (new_manager, _) = storage.get_manager(new_room_name)
+    new_manager.pending_joins += 1
+    try:
+        # Removed on the old room's shard, so no delivery of the old room is still in progress once
+        # the queue is cleaned up below
+        await storage.shards.run(old_room_name, old_manager.remove_connection(user))
+        await old_manager.broadcast(user, WsUserLeaveEvent(username=user.username))
 
-    broadcast_func = lambda user, message : storage.managers[new_room_name].broadcast(user, message)
-    user.broadcast_func = broadcast_func
-    storage.managers[new_room_name].websockets[user.user_uuid] = user
+        # From now on the user broadcasts to the new room
+        user.room_name = new_room_name
+        # Events of the old room that were not sent yet would show up in the new room, events about
+        # every room are kept
+        user.delivery_queue.drop_where(lambda event: event.event_type not in GLOBAL_EVENT_TYPES)
+        await storage.shards.run(new_room_name, new_manager.add_connection(user))
+    finally:
+        new_manager.pending_joins -= 1
     # Notify the user that the room has changed
-    await user.queue_message(WsRoomSwitchResponse(room_name=new_room_name).model_dump_json())
+    await user.queue_message(EncodedEvent(WsRoomSwitchResponse(room_name=new_room_name)))
 
-    return storage.managers[new_room_name]
+    return new_manager
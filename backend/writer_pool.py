@@ -0,0 +1,91 @@
+import asyncio
+import os
+from collections import deque
+from typing import Any, List
+
+from chat_logging import get_logger
+
+log = get_logger("writers")
+
+class WriterPool:
+    """A fixed number of writer tasks sending the queued events of every connection.
+
+    Instead of each connection running a sender task of its own, a connection with events pending
+    is put on the ready queue and the next free writer sends what it has queued. An idle connection
+    then costs no task, coroutine or event, only its (empty) delivery queue.
+
+    A connection is on the ready queue at most once, and only put back once its writer is done
+    with it, so its frames are never sent by two writers at the same time and stay in order.
+    Writers send one batch per turn and put a connection that still has events at the back, so a
+    busy connection does not hold up the others.
+
+    Connections need a `scheduled` flag, a `closed` flag and `write_pending()`, which sends one
+    batch and returns whether more is queued. Only used from the loop it was started on, the
+    server's loop. With a size of 0 the pool is disabled and connections run their own sender."""
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.ready: deque = deque()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.wakeup: asyncio.Event | None = None
+        self.tasks: List[asyncio.Task] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def running_on(self, loop: asyncio.AbstractEventLoop) -> bool:
+        return self.loop is loop
+
+    def start(self):
+        if not self.enabled or self.tasks:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.writer_loop(), name=f"writer-{index}") for index in range(self.size)]
+        log.info("Started %d writers", self.size)
+
+    async def stop(self):
+        (tasks, self.tasks) = (self.tasks, [])
+        self.loop = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for connection in self.ready:
+            connection.scheduled = False
+        self.ready.clear()
+
+    def schedule(self, connection: Any, delay: float = 0.0):
+        """Puts the connection on the ready queue, after delay seconds if that is above 0"""
+        if connection.scheduled or connection.closed:
+            return
+        connection.scheduled = True
+        if delay > 0:
+            self.loop.call_later(delay, self.make_ready, connection)
+        else:
+            self.make_ready(connection)
+
+    def make_ready(self, connection: Any):
+        self.ready.append(connection)
+        self.wakeup.set()
+
+    async def writer_loop(self):
+        while True:
+            if not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            connection = self.ready.popleft()
+            more = False
+            try:
+                more = not connection.closed and await connection.write_pending()
+            except Exception as e:
+                log.error("Writer failed: %s", e)
+            if more:
+                self.ready.append(connection)
+            else:
+                connection.scheduled = False
+
+def writer_pool_from_env() -> WriterPool:
+    """CHAT_WRITERS sets the number of shared writer tasks, 0 (the default) gives every connection
+    a sender task of its own"""
+    return WriterPool(int(os.environ.get("CHAT_WRITERS", "0")))
@@ -0,0 +1,67 @@
+import asyncio
+
+from writer_pool import *
+
+class FakeConnection:
+    """Sends one queued frame per write, like a connection without batching"""
+    def __init__(self, name: str, sent: list, frames: int):
+        self.name = name
+        self.sent = sent
+        self.pending = frames
+        self.scheduled = False
+        self.closed = False
+        self.writing = False
+
+    async def write_pending(self) -> bool:
+        assert not self.writing
+        self.writing = True
+        await asyncio.sleep(0)
+        self.sent.append(self.name)
+        self.pending -= 1
+        self.writing = False
+        return self.pending > 0
+
+def test_writers_take_turns_between_connections():
+    sent = []
+    async def main():
+        pool = WriterPool(1)
+        pool.start()
+        busy = FakeConnection("busy", sent, 3)
+        quiet = FakeConnection("quiet", sent, 1)
+        pool.schedule(busy)
+        pool.schedule(quiet)
+        # Already on the ready queue, not added twice
+        pool.schedule(busy)
+        await asyncio.sleep(0.05)
+        assert not busy.scheduled and not quiet.scheduled
+        await pool.stop()
+    asyncio.run(main())
+    assert sent == ["busy", "quiet", "busy", "busy"]
+
+def test_a_connection_is_written_by_one_writer_at_a_time():
+    sent = []
+    async def main():
+        pool = WriterPool(4)
+        pool.start()
+        connections = [FakeConnection(f"c{i}", sent, 5) for i in range(3)]
+        for _ in range(3):
+            for connection in connections:
+                pool.schedule(connection)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        await pool.stop()
+    asyncio.run(main())
+    assert sorted(sent) == sorted([f"c{i}" for i in range(3)] * 5)
+
+def test_closed_connections_are_skipped():
+    sent = []
+    async def main():
+        pool = WriterPool(2)
+        pool.start()
+        connection = FakeConnection("closed", sent, 1)
+        connection.closed = True
+        pool.schedule(connection)
+        await asyncio.sleep(0.01)
+        await pool.stop()
+    asyncio.run(main())
+    assert sent == []
@@ -1,3 +1,4 @@
+import json
 import pytest
 from pydantic import ValidationError, TypeAdapter
 from contextlib import contextmanager, ExitStack
@@ -12,6 +13,36 @@ def client():
     with TestClient(app) as c:
         yield c
 
+@pytest.fixture
+def sharded_client():
+    from websocket_handlers import storage, ShardPool
+    unsharded = storage.shards
+    storage.shards = ShardPool(3)
+    try:
+        with TestClient(app) as c:
+            yield c
+    finally:
+        storage.shards = unsharded
+
+@pytest.fixture
+def pooled_client():
+    from websocket_handlers import storage, WriterPool
+    dedicated = storage.writers
+    storage.writers = WriterPool(2)
+    try:
+        with TestClient(app) as c:
+            yield c
+    finally:
+        storage.writers = dedicated
+
+@pytest.fixture(autouse=True)
+def no_rate_limit():
+    # Most tests send faster than any client should, rate limiting has tests of its own
+    from websocket_handlers import storage
+    storage.rate_limiter.enabled = False
+    yield
+    storage.rate_limiter.enabled = True
+
 @contextmanager
 def ws_for(client: TestClient, username: str, room_name: str = GLOBAL_ROOM_NAME):
     url = f"/ws"
@@ -154,3 +185,528 @@ def test_ws_join_new_room(client):
     user = "test_user1234"
     with ws_for(client, user, room_name) as ws:
         pass
+
+def test_broadcast_encodes_once():
+    from websocket_handlers import WebSocketManager, EncodedEvent, broadcast_all_rooms, JSON_CODEC
+    import asyncio
+
+    class RecordingConnection:
+        def __init__(self, index: int):
+            self.username = f"user{index}"
+            self.user_uuid = str(index)
+            self.resumable = False
+            self.frames = []
+        async def queue_message(self, frame: EncodedEvent):
+            self.frames.append(frame)
+
+    managers = {}
+    for room in ["room_a", "room_b"]:
+        managers[room] = WebSocketManager(room)
+        for i in range(5):
+            managers[room].websockets[f"{room}{i}"] = RecordingConnection(i)
+
+    asyncio.run(broadcast_all_rooms(managers, WsRoomCreate(room=RoomInfo(room_name="x", room_creator="y", connected_users=["y"]))))
+
+    frames = [frame for manager in managers.values() for user in manager.websockets.values() for frame in user.frames]
+    assert len(frames) == 10
+    # Every recipient in every room shares the very same encoded frame
+    assert all(frame is frames[0] for frame in frames)
+    assert frames[0].encode(JSON_CODEC) is frames[-1].encode(JSON_CODEC)
+
+def test_ws_msgpack_subprotocol(client):
+    import msgpack
+    with client.websocket_connect("/ws", subprotocols=["chat.msgpack"]) as ws:
+        assert ws.accepted_subprotocol == "chat.msgpack"
+        ws.send_bytes(msgpack.packb(WsConnectionRequest(username="msgpack_user").model_dump()))
+        response = WsConnectionResponse.model_validate(msgpack.unpackb(ws.receive_bytes()))
+        assert response.username == "msgpack_user"
+        WsAllRooms.model_validate(msgpack.unpackb(ws.receive_bytes()))
+        WsMessageHistory.model_validate(msgpack.unpackb(ws.receive_bytes()))
+        WsUsersOnline.model_validate(msgpack.unpackb(ws.receive_bytes()))
+        WsUserJoinEvent.model_validate(msgpack.unpackb(ws.receive_bytes()))
+
+        ws.send_bytes(msgpack.packb(WsMessage(username="msgpack_user", message="binary hello").model_dump()))
+        message = WsMessage.model_validate(msgpack.unpackb(ws.receive_bytes()))
+        assert message.message == "binary hello"
+
+def test_ws_unknown_subprotocol_defaults_to_json(client):
+    with client.websocket_connect("/ws", subprotocols=["chat.unknown"]) as ws:
+        assert ws.accepted_subprotocol is None
+        ws.send_text(WsConnectionRequest(username="json_default_user").model_dump_json())
+        assert WsConnectionResponse.model_validate_json(ws.receive_text()).username == "json_default_user"
+
+def test_ws_history_paging(client):
+    from websocket_handlers import JOIN_HISTORY_SIZE
+    room_name = "history_paging"
+    for i in range(JOIN_HISTORY_SIZE + 5):
+        client.post(f"/{room_name}/send-message", json={"username": "history_bot", "message": f"message {i}"})
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        ws.send_text(WsConnectionRequest(username="history_reader").model_dump_json())
+        WsConnectionResponse.model_validate_json(ws.receive_text())
+        WsAllRooms.model_validate_json(ws.receive_text())
+        history = WsMessageHistory.model_validate_json(ws.receive_text())
+        assert len(history.messages) == JOIN_HISTORY_SIZE
+        assert history.has_more
+        assert history.messages[-1]["message"] == f"message {JOIN_HISTORY_SIZE + 4}"
+        WsUsersOnline.model_validate_json(ws.receive_text())
+        WsUserJoinEvent.model_validate_json(ws.receive_text())
+
+        ws.send_text(WsHistoryRequest(before_seq=history.messages[0]["seq"], limit=10).model_dump_json())
+        page = WsHistoryPage.model_validate_json(ws.receive_text())
+        assert [m["message"] for m in page.messages] == [f"message {i}" for i in range(5)]
+        assert not page.has_more
+
+def test_search(client):
+    room_name = "search_room"
+    for text in ["the quick fox", "a lazy dog", "quicker still"]:
+        client.post(f"/{room_name}/send-message", json={"username": "search_bot", "message": text})
+    client.post("/send-message", json={"username": "search_bot", "message": "quick elsewhere"})
+
+    body = client.get(f"/{room_name}/search", params={"q": "quick*"}).json()
+    assert [r["message"] for r in body["results"]] == ["quicker still", "the quick fox"]
+    assert body["next_cursor"] is None
+    assert "quick elsewhere" in [r["message"] for r in client.get("/search", params={"q": "quick"}).json()["results"]]
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        ws.send_text(WsConnectionRequest(username="searcher").model_dump_json())
+        WsConnectionResponse.model_validate_json(ws.receive_text())
+        WsAllRooms.model_validate_json(ws.receive_text())
+        WsMessageHistory.model_validate_json(ws.receive_text())
+        WsUsersOnline.model_validate_json(ws.receive_text())
+        WsUserJoinEvent.model_validate_json(ws.receive_text())
+        ws.send_text(WsSearchRequest(query="quick", limit=1).model_dump_json())
+        page = WsSearchResults.model_validate_json(ws.receive_text())
+        assert [r["message"] for r in page.results] == ["the quick fox"]
+        ws.send_text(WsSearchRequest(query="lazy", all_rooms=True, username="nobody").model_dump_json())
+        assert WsSearchResults.model_validate_json(ws.receive_text()).results == []
+
+    client.delete("/clear-chat")
+    assert client.get("/search", params={"q": "elsewhere"}).json()["results"] == []
+
+def test_ws_rate_limit(client):
+    from websocket_handlers import storage, RATE_LIMITS
+    storage.rate_limiter.enabled = True
+    burst = int(RATE_LIMITS["message"][1])
+    with ws_for(client, "flooder") as ws:
+        receive_on_join_messages(ws)
+        for i in range(burst + 5):
+            ws.send_text(WsMessage(username="flooder", message=f"flood {i}").model_dump_json())
+        # The warning is sent right away, it may overtake the queued messages
+        events = [TypeAdapter(WsEvent).validate_json(ws.receive_text()) for _ in range(burst + 1)]
+        assert [event.message for event in events if isinstance(event, WsMessage)] == [f"flood {i}" for i in range(burst)]
+        # Reported once, not for every dropped message
+        [warning] = [event for event in events if isinstance(event, WsSystemMessage)]
+        assert (warning.severity, warning.message) == ("error", "Too many message events, slow down")
+        ws.send_text(WsTypingEvent(username="flooder", is_typing=True).model_dump_json())
+        assert WsTypingUsers.model_validate_json(ws.receive_text()).usernames == ["flooder"]
+    assert 'chat_rate_limited_total{event_type="message"} ' in client.get("/metrics").text
+
+def test_ws_frame_rate_limit(client, monkeypatch):
+    from websocket_handlers import storage, RATE_LIMITS, RATE_LIMIT_FRAME
+    monkeypatch.setitem(RATE_LIMITS, RATE_LIMIT_FRAME, (0.1, 5.0))
+    storage.rate_limiter.enabled = True
+    with ws_for(client, "frame_flooder") as ws:
+        receive_on_join_messages(ws)
+        # Within the message budget, but not within the one for frames
+        for i in range(8):
+            ws.send_text(WsMessage(username="frame_flooder", message=f"flood {i}").model_dump_json())
+        events = [TypeAdapter(WsEvent).validate_json(ws.receive_text()) for _ in range(6)]
+        assert [event.message for event in events if isinstance(event, WsMessage)] == [f"flood {i}" for i in range(5)]
+        [warning] = [event for event in events if isinstance(event, WsSystemMessage)]
+        assert warning.message == "Too many frame events, slow down"
+
+def test_http_rate_limit(client):
+    from websocket_handlers import storage, RATE_LIMITS
+    storage.rate_limiter.enabled = True
+    burst = int(RATE_LIMITS["message"][1])
+    for i in range(burst):
+        assert client.post("/rate_limited/send-message", json={"username": "http_flooder", "message": str(i)}).status_code == 200
+    response = client.post("/rate_limited/send-message", json={"username": "http_flooder", "message": "one more"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+def test_http_bulk_send(client):
+    with ws_for(client, "bulk_watcher", "bulk_room") as ws:
+        receive_on_join_messages(ws)
+        items = [{"username": "bulk_bot", "message": f"bulk {i}"} for i in range(100)]
+        items[10] = {"username": "bulk_bot", "message": "  "}
+        items[20] = {"username": "bad/name", "message": "hello"}
+        items[30] = {"username": "bulk_bot", "message": "elsewhere", "room_name": "bulk_other"}
+        items[40] = "not a message"
+        response = client.post("/bulk_room/send-messages", json=items)
+        assert response.status_code == 200
+        body = BulkSendResponse.model_validate(response.json())
+        assert (body.accepted, body.rejected) == (97, 3)
+        assert [status.index for status in body.results] == list(range(100))
+        assert [(status.index, status.detail) for status in body.results if status.status == "error"] == [
+            (10, "Message cannot be empty"), (20, "Username contains invalid characters"), (40, "Invalid message: Input should be a valid dictionary or instance of BulkChatMessage")]
+
+        expected = [item["message"] for (i, item) in enumerate(items) if i not in (10, 20, 30, 40)]
+        assert [WsMessage.model_validate_json(ws.receive_text()).message for _ in expected] == expected
+        assert [message["message"] for message in client.get("/bulk_room/messages/").json()["messages"]] == expected
+        assert [message["message"] for message in client.get("/bulk_other/messages/").json()["messages"]] == ["elsewhere"]
+
+    assert client.post("/send-messages", json={"username": "bulk_bot"}).status_code == 400
+
+def test_http_bulk_send_ndjson(client):
+    lines = [WsMessage(username="ndjson_bot", message=f"line {i}").model_dump_json() for i in range(3)]
+    lines.insert(1, '{"username": "ndjson_bot", "message": "' + "x" * 70000 + '"}')
+    lines.insert(3, "")
+    response = client.post("/ndjson_room/send-messages", content="\n".join(lines), headers={"content-type": "application/x-ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    statuses = [BulkItemStatus.model_validate_json(line) for line in response.text.splitlines()]
+    assert [(status.index, status.status, status.detail) for status in statuses] == [
+        (0, "success", None), (1, "error", "Line is too long"), (2, "success", None), (3, "success", None)]
+    assert [message["message"] for message in client.get("/ndjson_room/messages/").json()["messages"]] == ["line 0", "line 1", "line 2"]
+
+def test_http_bulk_send_ndjson_is_capped(client, monkeypatch):
+    import server
+    monkeypatch.setattr(server, "BULK_MAX_ITEMS", 4)
+    monkeypatch.setattr(server, "BULK_CHUNK_ITEMS", 2)
+    lines = [WsMessage(username="ndjson_flooder", message=f"line {i}").model_dump_json() for i in range(6)]
+    response = client.post("/ndjson_capped/send-messages", content="\n".join(lines), headers={"content-type": "application/x-ndjson"})
+    assert (response.status_code, response.json()["detail"]) == (413, "No more than 4 messages at a time")
+
+def test_http_messages_pagination_and_etag(client):
+    items = [{"username": "pager", "message": f"page {i}"} for i in range(30)]
+    assert client.post("/paged_room/send-messages", json=items).json()["accepted"] == 30
+
+    full = client.get("/paged_room/messages/")
+    assert len(full.json()["messages"]) == 30
+    assert client.get("/paged_room/messages/", headers={"If-None-Match": full.headers["ETag"]}).status_code == 304
+
+    # Polling with after only returns what is new
+    page = client.get("/paged_room/messages/?after=0&limit=20").json()
+    assert ([message["seq"] for message in page["messages"]], page["has_more"]) == (list(range(1, 21)), True)
+    page = client.get(f"/paged_room/messages/?after={page['next_cursor']}&limit=20")
+    assert [message["seq"] for message in page.json()["messages"]] == list(range(21, 31))
+    assert page.json()["has_more"] is False
+    poll = client.get(f"/paged_room/messages/?after={page.json()['next_cursor']}", headers={"If-None-Match": page.headers["ETag"]})
+    assert poll.status_code == 304
+    client.post("/paged_room/send-message", json={"username": "pager", "message": "new"})
+    poll = client.get(f"/paged_room/messages/?after={page.json()['next_cursor']}", headers={"If-None-Match": page.headers["ETag"]})
+    assert [message["message"] for message in poll.json()["messages"]] == ["new"]
+
+    # Paging back from the newest
+    page = client.get("/paged_room/messages/?limit=10").json()
+    assert [message["seq"] for message in page["messages"]] == list(range(22, 32))
+    page = client.get(f"/paged_room/messages/?before={page['next_cursor']}&limit=10").json()
+    assert [message["seq"] for message in page["messages"]] == list(range(12, 22))
+
+    export = client.get("/paged_room/messages/?format=ndjson&after=25")
+    assert export.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["seq"] for line in export.text.splitlines()] == list(range(26, 32))
+    assert len(client.get("/paged_room/messages/?format=ndjson").text.splitlines()) == 31
+
+def test_http_events_need_an_existing_room(client):
+    assert client.get("/no_such_room/events").status_code == 404
+    assert client.get("/bad!room/events").status_code == 400
+
+def test_ws_register_and_login(client):
+    from websocket_handlers import storage
+    storage.user_database.rounds = 4
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsRegisterRequest(username="member", password="hunter2").model_dump_json())
+        ws.send_text(WsConnectionRequest(username="member").model_dump_json())
+        token = WsRegisterResponse.model_validate_json(ws.receive_text()).session_token
+        assert WsConnectionResponse.model_validate_json(ws.receive_text()).username == "member"
+
+    # Registered names need a login
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsConnectionRequest(username="member").model_dump_json())
+        assert WsConnectionReject.model_validate_json(ws.receive_text()).response == "Username is registered, log in to use it"
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsLoginRequest(username="member", password="wrong").model_dump_json())
+        assert WsLoginReject.model_validate_json(ws.receive_text()).response == "Invalid username or password"
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsLoginRequest(username="member", password="hunter2").model_dump_json())
+        ws.send_text(WsConnectionRequest(username="someone_else").model_dump_json())
+        WsLoginResponse.model_validate_json(ws.receive_text())
+        assert WsConnectionReject.model_validate_json(ws.receive_text()).response == "Logged in as member"
+    # Reconnecting with the session token
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsLoginRequest(username="member", session_token=token).model_dump_json())
+        ws.send_text(WsConnectionRequest(username="member").model_dump_json())
+        assert WsLoginResponse.model_validate_json(ws.receive_text()).session_token == token
+        assert WsConnectionResponse.model_validate_json(ws.receive_text()).username == "member"
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsLoginRequest(username="member", session_token="forged").model_dump_json())
+        assert WsLoginReject.model_validate_json(ws.receive_text()).response == "Session expired, log in again"
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsRegisterRequest(username="member", password="again").model_dump_json())
+        assert WsRegisterReject.model_validate_json(ws.receive_text()).response == "User member already exists"
+
+def test_http_send_needs_session_of_registered_user(client):
+    from websocket_handlers import storage
+    storage.user_database.rounds = 4
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsRegisterRequest(username="http_member", password="hunter2").model_dump_json())
+        token = WsRegisterResponse.model_validate_json(ws.receive_text()).session_token
+    message = {"username": "http_member", "message": "signed"}
+
+    response = client.post("/send-message", json=message)
+    assert (response.status_code, response.json()["detail"]) == (401, "Username is registered, log in to use it")
+    assert client.post("/send-message", json=message, headers={"Authorization": "Bearer forged"}).status_code == 401
+    assert client.post("/send-message", json=message, headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+    items = [message, {"username": "http_guest", "message": "unsigned"}]
+    results = client.post("/send-messages", json=items).json()["results"]
+    assert [(r["status"], r["detail"]) for r in results] == [("error", "Username is registered, log in to use it"), ("success", None)]
+    response = client.post("/send-messages", content=json.dumps(message), headers={"content-type": "application/x-ndjson", "Authorization": f"Bearer {token}"})
+    assert json.loads(response.text)["status"] == "success"
+
+def test_metrics_endpoint(client):
+    with ws_for(client, "metrics_user") as ws:
+        receive_on_join_messages(ws)
+        ws.send_text(WsMessage(username="metrics_user", message="counted").model_dump_json())
+        WsMessage.model_validate_json(ws.receive_text())
+        metrics = client.get("/metrics").text
+    assert 'chat_events_received_total{event_type="message"}' in metrics
+    assert 'chat_events_sent_total{event_type="message"}' in metrics
+    assert "chat_handshake_seconds_count" in metrics
+    assert 'chat_connections{room="Global"}' in metrics
+
+def test_ws_typing_is_coalesced(client):
+    with ws_for(client, "typist") as typist, ws_for(client, "watcher") as watcher:
+        receive_on_join_messages(typist)
+        receive_on_join_messages(watcher)
+        WsUserJoinEvent.model_validate_json(typist.receive_text())
+        for _ in range(5):
+            typist.send_text(WsTypingEvent(username="typist", is_typing=True).model_dump_json())
+        # Five keystrokes become a single aggregated frame
+        typing = WsTypingUsers.model_validate_json(watcher.receive_text())
+        assert typing.usernames == ["typist"]
+        typist.send_text(WsTypingEvent(username="typist", is_typing=False).model_dump_json())
+        assert WsTypingUsers.model_validate_json(watcher.receive_text()).usernames == []
+
+def test_ws_batched_delivery(client):
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsConnectionRequest(username="batch_user", features=["batch", "unknown"]).model_dump_json())
+        events = []
+        while len(events) < 5:
+            frame = TypeAdapter(WsEvent | WsBatch).validate_json(ws.receive_text())
+            events += frame.events if isinstance(frame, WsBatch) else [frame]
+        # Everything queued during the handshake fits in one batch, in the original order
+        assert [type(event) for event in events] == [WsConnectionResponse, WsAllRooms, WsMessageHistory, WsUsersOnline, WsUserJoinEvent]
+        assert events[0].features == ["batch"]
+
+def test_ws_shared_writers(pooled_client):
+    from websocket_handlers import storage
+    client = pooled_client
+    with ws_for(client, "pooled_a") as a, client.websocket_connect("/ws") as b:
+        receive_on_join_messages(a)
+        b.send_text(WsConnectionRequest(username="pooled_b", features=["batch"]).model_dump_json())
+        events = []
+        while len(events) < 5:
+            frame = TypeAdapter(WsEvent | WsBatch).validate_json(b.receive_text())
+            events += frame.events if isinstance(frame, WsBatch) else [frame]
+        assert [type(event) for event in events] == [WsConnectionResponse, WsAllRooms, WsMessageHistory, WsUsersOnline, WsUserJoinEvent]
+        assert WsUserJoinEvent.model_validate_json(a.receive_text()).username == "pooled_b"
+        # No sender task per connection, the pool's writers send for everyone
+        assert all(user.sender_task is None for user in storage.managers[GLOBAL_ROOM_NAME].websockets.values())
+        for i in range(20):
+            a.send_text(WsMessage(username="pooled_a", message=f"message {i}").model_dump_json())
+        assert [WsMessage.model_validate_json(a.receive_text()).message for _ in range(20)] == [f"message {i}" for i in range(20)]
+        received = []
+        while len(received) < 20:
+            frame = TypeAdapter(WsEvent | WsBatch).validate_json(b.receive_text())
+            received += [event.message for event in (frame.events if isinstance(frame, WsBatch) else [frame])]
+        assert received == [f"message {i}" for i in range(20)]
+
+def test_ws_room_directory_updates(client):
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsConnectionRequest(username="directory_user", features=["room_updates"]).model_dump_json())
+        assert WsConnectionResponse.model_validate_json(ws.receive_text()).features == ["room_updates"]
+        snapshot = WsAllRooms.model_validate_json(ws.receive_text())
+        receive_on_join_messages(ws)
+        update = WsRoomUsersUpdate.model_validate_json(ws.receive_text())
+        assert update.version > snapshot.version
+        assert (update.room_name, update.joined) == (GLOBAL_ROOM_NAME, ["directory_user"])
+
+        with ws_for(client, "directory_other", "directory_room"):
+            # The room creation reaches every room, before the creator joins it
+            assert WsRoomCreate.model_validate_json(ws.receive_text()).room.room_name == "directory_room"
+            update = WsRoomUsersUpdate.model_validate_json(ws.receive_text())
+            assert (update.room_name, update.joined) == ("directory_room", ["directory_other"])
+            rooms = client.get("/rooms").json()
+            assert rooms["version"] == update.version
+            room = next(room for room in rooms["rooms"] if room["room_name"] == "directory_room")
+            assert room["connected_users"] == ["directory_other"]
+            assert room["room_creator"] == "directory_other"
+        update = WsRoomUsersUpdate.model_validate_json(ws.receive_text())
+        assert (update.room_name, update.left) == ("directory_room", ["directory_other"])
+
+        # Switching rooms must not lose the updates about leaving the old room
+        ws.send_text(WsRoomSwitchRequest(room_name="directory_room").model_dump_json())
+        updates = []
+        while len(updates) < 2:
+            event = TypeAdapter(WsEvent).validate_json(ws.receive_text())
+            if isinstance(event, WsRoomUsersUpdate):
+                updates.append((event.room_name, event.joined, event.left))
+        assert updates == [(GLOBAL_ROOM_NAME, [], ["directory_user"]), ("directory_room", ["directory_user"], [])]
+
+def test_ws_sharded_rooms(sharded_client):
+    client = sharded_client
+    for attempt in range(2):
+        # The second attempt reuses the usernames, so the first connections must be fully cleaned up
+        with ws_for(client, "shard_a") as a, ws_for(client, "shard_b") as b:
+            receive_on_join_messages(a)
+            receive_on_join_messages(b)
+            WsUserJoinEvent.model_validate_json(a.receive_text())
+            a.send_text(WsMessage(username="shard_a", message=f"hello {attempt}").model_dump_json())
+            for ws in (a, b):
+                assert WsMessage.model_validate_json(ws.receive_text()).message == f"hello {attempt}"
+
+            room_name = f"shard_room_{attempt}"
+            send_room_create(a, "shard_a", room_name)
+            WsRoomCreate.model_validate_json(b.receive_text())
+            a.send_text(WsRoomSwitchRequest(room_name=room_name).model_dump_json())
+            receive_room_switch_msgs(a, room_name)
+            # b only sees a leave, nothing of the new room
+            assert WsUserLeaveEvent.model_validate_json(b.receive_text()).username == "shard_a"
+            a.send_text(WsMessage(username="shard_a", message="in the new room").model_dump_json())
+            assert WsUserJoinEvent.model_validate_json(a.receive_text()).username == "shard_a"
+            assert WsMessage.model_validate_json(a.receive_text()).message == "in the new room"
+
+def test_http_clear_chat_is_broadcast(client):
+    with ws_for(client, "clear_watcher") as ws:
+        receive_on_join_messages(ws)
+        client.post("/send-message", json={"username": "clear_sender", "message": "soon gone"})
+        assert WsMessage.model_validate_json(ws.receive_text()).message == "soon gone"
+        assert client.delete("/clear-chat").status_code == 200
+        assert WsRoomChatClear.model_validate_json(ws.receive_text()).room_name == GLOBAL_ROOM_NAME
+        assert client.get("/messages").json()["messages"] == []
+
+def test_ws_deflate_subprotocol(client):
+    import zlib
+    for i in range(30):
+        client.post("/deflate_room/send-message", json={"username": "deflate_bot", "message": f"a fairly repetitive message {i}"})
+    with client.websocket_connect("/ws/deflate_room", subprotocols=["chat.json+deflate"]) as ws:
+        assert ws.accepted_subprotocol == "chat.json+deflate"
+        ws.send_text(WsConnectionRequest(username="deflate_user").model_dump_json())
+        def receive():
+            frame = ws.receive_bytes()
+            return frame[:1], (zlib.decompress(frame[1:], -15) if frame[:1] == b"\x01" else frame[1:])
+        (kind, data) = receive()
+        assert kind == b"\x00" and WsConnectionResponse.model_validate_json(data).username == "deflate_user"
+        WsAllRooms.model_validate_json(receive()[1])
+        (kind, data) = receive()
+        # The history is large and repetitive, so it is compressed
+        assert kind == b"\x01" and len(WsMessageHistory.model_validate_json(data).messages) == 30
+
+def test_ws_deflate_bomb_is_rejected(client):
+    import zlib
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    # About 10 KB on the wire, 16 MB once inflated
+    bomb = compressor.compress(b'{"event_type":"connection_request","username":"' + b"a" * 16 * 1024 * 1024) + compressor.flush()
+    with client.websocket_connect("/ws", subprotocols=["chat.json+deflate"]) as ws:
+        ws.send_bytes(b"\x01" + bomb)
+        frame = ws.receive_bytes()
+        assert frame[:1] == b"\x00"
+        assert "inflates to more than" in WsConnectionReject.model_validate_json(frame[1:]).response
+
+def test_ws_evicted_room_is_restored(client):
+    from websocket_handlers import storage
+    room_name = "evicted_room"
+    for i in range(3):
+        client.post(f"/{room_name}/send-message", json={"username": "evict_bot", "message": f"message {i}"})
+    storage.evict_room(room_name)
+    assert room_name not in storage.managers
+    assert room_name in [room["room_name"] for room in client.get("/rooms").json()["rooms"]]
+    storage.spill.write_pending()
+
+    with ws_for(client, "evict_reader") as ws:
+        receive_on_join_messages(ws)
+        ws.send_text(WsRoomSwitchRequest(room_name=room_name).model_dump_json())
+        WsRoomSwitchResponse.model_validate_json(ws.receive_text())
+        history = WsMessageHistory.model_validate_json(ws.receive_text())
+        assert [m["message"] for m in history.messages] == ["message 0", "message 1", "message 2"]
+        assert storage.managers[room_name].creator == "evict_bot"
+
+def test_ws_presence_deltas(client):
+    room_name = "presence_room"
+    def connect(ws, username: str, epoch: str | None = None, version: int | None = None, features: List[str] = ["presence"]):
+        ws.send_text(WsConnectionRequest(username=username, features=features,
+            presence_epoch=epoch, presence_version=version).model_dump_json())
+        assert WsConnectionResponse.model_validate_json(ws.receive_text()).features == features
+        WsAllRooms.model_validate_json(ws.receive_text())
+        event = TypeAdapter(WsEvent).validate_json(ws.receive_text())
+        if isinstance(event, WsRoomCreate):
+            event = TypeAdapter(WsEvent).validate_json(ws.receive_text())
+        assert isinstance(event, WsMessageHistory)
+        return TypeAdapter(WsEvent).validate_json(ws.receive_text())
+
+    def receive_presence(ws, usernames: set):
+        # Joins only reach the client as deltas, batched per tick
+        users = set()
+        while users != usernames:
+            event = TypeAdapter(WsEvent).validate_json(ws.receive_text())
+            assert isinstance(event, WsPresenceDelta)
+            users |= {user.username for user in event.joined}
+            users -= set(event.left)
+        return event
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        snapshot = connect(ws, "presence_a")
+        assert isinstance(snapshot, WsPresence) and snapshot.users == []
+        receive_presence(ws, {"presence_a"})
+        with client.websocket_connect(f"/ws/{room_name}") as other:
+            # Without the feature nothing changes
+            online = connect(other, "presence_b", features=[])
+            assert isinstance(online, WsUsersOnline)
+            assert [user.username for user in online.users] == ["presence_a"]
+            delta = receive_presence(ws, {"presence_b"})
+    held = (delta.epoch, delta.version)
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        # Only what changed since the held version, presence_a and presence_b left in between
+        catch_up = connect(ws, "presence_a", *held)
+        assert isinstance(catch_up, WsPresenceDelta)
+        assert catch_up.from_version == held[1]
+        assert sorted(catch_up.left) == ["presence_a", "presence_b"]
+
+def test_ws_resume_replays_missed_events(client):
+    room_name = "resume_room"
+    def receive(ws):
+        frame = ws.receive_text()
+        return (TypeAdapter(WsEvent).validate_json(frame), json.loads(frame).get("event_seq"))
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        ws.send_text(WsConnectionRequest(username="resume_user", features=["resume"]).model_dump_json())
+        token = WsConnectionResponse.model_validate_json(ws.receive_text()).resume_token
+        assert token
+        while not isinstance((event := receive(ws))[0], WsUserJoinEvent):
+            pass
+        last_seen = event[1]
+        assert last_seen is not None
+
+    # The username is held for the client while it is away
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(WsConnectionRequest(username="resume_user").model_dump_json())
+        assert WsConnectionReject.model_validate_json(ws.receive_text()).response == "Username is already taken"
+    for i in range(2):
+        client.post(f"/{room_name}/send-message", json={"username": "resume_bot", "message": f"missed {i}"})
+
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        ws.send_text(WsConnectionRequest(username="resume_user", features=["resume"], resume_token=token,
+            last_event_seq=last_seen).model_dump_json())
+        response = WsConnectionResponse.model_validate_json(ws.receive_text())
+        assert response.resumed and response.resume_token not in (None, token)
+        # Only what was missed, no room list, history or user list
+        replayed = [receive(ws) for _ in range(3)]
+        assert isinstance(replayed[0][0], WsUserLeaveEvent)
+        assert [event.message for (event, _) in replayed[1:]] == ["missed 0", "missed 1"]
+        seqs = [seq for (_, seq) in replayed]
+        assert last_seen < seqs[0] < seqs[1] < seqs[2]
+        assert isinstance(receive(ws)[0], WsUserJoinEvent)
+        token = response.resume_token
+
+    # A token that is too old for the log still gets the username back, with a full snapshot
+    with client.websocket_connect(f"/ws/{room_name}") as ws:
+        ws.send_text(WsConnectionRequest(username="resume_user", features=["resume"], resume_token=token,
+            last_event_seq=0).model_dump_json())
+        response = WsConnectionResponse.model_validate_json(ws.receive_text())
+        assert not response.resumed
+        WsAllRooms.model_validate_json(ws.receive_text())
+        WsMessageHistory.model_validate_json(ws.receive_text())